@@ -1,9 +1,16 @@
 # migrate_sqlite_to_mysql.py
 # SQLite -> MySQL 一次搬移（可重跑；採用 UPSERT 避免重複）
+import os
 import sqlite3
+import tempfile
 import pymysql
 from datetime import datetime
 
+try:
+    import pandas as pd  # 選用：整欄時間字串一次轉換（需 pandas >= 2.0）
+except ImportError:
+    pd = None
+
 SQLITE_PATH = "line_center.db"
 
 MYSQL_HOST = "127.0.0.1"
@@ -13,21 +20,156 @@ MYSQL_USER = "root"
 MYSQL_PASS = "tmu2012"
 MYSQL_CHARSET = "utf8mb4"
 
+# 每批 UPSERT 筆數（pymysql executemany 會改寫成單一多列 INSERT，需低於 65535 個 placeholder）
+BATCH_SIZE = 1000
+
+# identities / members 改走 LOAD DATA LOCAL INFILE → 暫存表 → INSERT ... SELECT
+# （MySQL 需開 local_infile；設 False 則退回 executemany）
+# 伺服器沒開 local_infile 時會自動退回 executemany，並關掉後續表的 LOAD DATA
+USE_LOAD_DATA = True
+# ER_NOT_ALLOWED_COMMAND / ER_CLIENT_LOCAL_FILES_DISABLED（MySQL 8 預設 local_infile=OFF）
+LOCAL_INFILE_DISABLED = (1148, 3948)
+
+# 大量匯入期間暫停外鍵檢查（只影響本 session）
+BULK_LOAD_OFF = (
+    "SET SESSION autocommit=0",
+    "SET SESSION foreign_key_checks=0",
+)
+BULK_LOAD_ON = (
+    "SET SESSION unique_checks=1",
+    "SET SESSION foreign_key_checks=1",
+)
+
+# unique_checks=0 時 InnoDB 不檢查次要唯一索引（identities.uq_line_id）的重複，UPSERT 會直接寫出
+# 重複的 line_id 而不走 ON DUPLICATE KEY UPDATE；所以只在這些表全空（第一次搬）時才關，重跑時照常檢查
+UNIQUE_CHECK_TABLES = ("identities", "members")
+
+def bulk_unique_checks_off(cur):
+    for t in UNIQUE_CHECK_TABLES:
+        cur.execute(f"SELECT 1 FROM {t} LIMIT 1")
+        if cur.fetchone():
+            return False
+    cur.execute("SET SESSION unique_checks=0")
+    return True
+
 def connect_mysql():
     return pymysql.connect(
         host=MYSQL_HOST, port=MYSQL_PORT,
         user=MYSQL_USER, password=MYSQL_PASS,
         database=MYSQL_DB, charset=MYSQL_CHARSET,
         autocommit=False,
+        local_infile=USE_LOAD_DATA,
         cursorclass=pymysql.cursors.DictCursor
     )
 
-def fetch_all_sqlite(conn, sql):
+def iter_sqlite(conn, sql, size=BATCH_SIZE):
+    # 逐批 fetchmany，不把整張表一次載入記憶體；邊讀邊寫 MySQL
     cur = conn.cursor()
     cur.execute(sql)
     cols = [d[0] for d in cur.description]
-    rows = [dict(zip(cols, r)) for r in cur.fetchall()]
-    return rows
+    while True:
+        rows = cur.fetchmany(size)
+        if not rows:
+            break
+        yield [dict(zip(cols, r)) for r in rows]
+
+def upsert_batches(cur, sql, batches, to_params):
+    n = 0
+    for batch in batches:
+        params = to_params(batch)
+        cur.executemany(sql, params)
+        n += len(params)
+    return n
+
+def _load_field(v):
+    # 搭配 ESCAPED BY ''：未加引號的 NULL 代表 SQL NULL，其餘一律以 "..." 包住
+    if v is None:
+        return "NULL"
+    return '"' + str(v).replace('"', '""') + '"'
+
+def load_via_stage(cur, table, cols, params, update_cols):
+    """把 params 寫成暫存檔 → LOAD DATA 進暫存表 → 一次 INSERT ... SELECT ... ON DUPLICATE KEY UPDATE"""
+    stage = table + "_stage"
+    col_sql = ", ".join(cols)
+    n = 0
+    fd, path = tempfile.mkstemp(suffix=".csv")
+    try:
+        with os.fdopen(fd, "w", encoding="utf-8", newline="") as f:
+            for row in params:
+                f.write(",".join(_load_field(v) for v in row))
+                f.write("\n")
+                n += 1
+        cur.execute(f"DROP TEMPORARY TABLE IF EXISTS {stage}")
+        cur.execute(f"CREATE TEMPORARY TABLE {stage} LIKE {table}")
+        cur.execute(
+            f"LOAD DATA LOCAL INFILE %s INTO TABLE {stage} CHARACTER SET utf8mb4 "
+            f"FIELDS TERMINATED BY ',' ENCLOSED BY '\"' ESCAPED BY '' "
+            f"LINES TERMINATED BY '\\n' ({col_sql})",
+            (path.replace("\\", "/"),),
+        )
+        updates = ", ".join(f"{c}=VALUES({c})" for c in update_cols)
+        cur.execute(
+            f"INSERT INTO {table} ({col_sql}) SELECT {col_sql} FROM {stage} "
+            f"ON DUPLICATE KEY UPDATE {updates}"
+        )
+        cur.execute(f"DROP TEMPORARY TABLE IF EXISTS {stage}")
+    finally:
+        os.remove(path)
+    return n
+
+def load_or_upsert(cur, sconn, select_sql, to_params, table, cols, update_cols, upsert_sql):
+    """能用 LOAD DATA 就走暫存表；伺服器拒絕 LOCAL INFILE 時改走 executemany UPSERT"""
+    global USE_LOAD_DATA
+    if USE_LOAD_DATA:
+        try:
+            return load_via_stage(cur, table, cols,
+                                  (p for rows in iter_sqlite(sconn, select_sql) for p in to_params(rows)),
+                                  update_cols)
+        except pymysql.MySQLError as e:
+            if not e.args or e.args[0] not in LOCAL_INFILE_DISABLED:
+                raise
+            print(f"LOAD DATA LOCAL disabled ({e.args[0]}): fallback to executemany")
+            USE_LOAD_DATA = False
+    # 失敗的 LOAD DATA 只回滾該句，交易仍可繼續；來源要重新讀一次
+    return upsert_batches(cur, upsert_sql, iter_sqlite(sconn, select_sql), to_params)
+
+def drop_secondary_indexes(cur, table):
+    """
+    搬移前拆掉非唯一的次要索引（PRIMARY / UNIQUE 保留，UPSERT 需要它們判斷重複），
+    回傳 {索引名: [欄位（含前綴長度 / DESC）...]} 供搬完後重建。
+    """
+    try:
+        cur.execute(f"SHOW INDEX FROM {table}")
+    except pymysql.MySQLError:
+        return {}
+    indexes = {}
+    for r in cur.fetchall():
+        if r["Key_name"] == "PRIMARY" or not r["Non_unique"]:
+            continue
+        col = f"`{r['Column_name']}`" + (f"({r['Sub_part']})" if r["Sub_part"] else "")
+        if r.get("Collation") == "D":
+            col += " DESC"  # 例如 idx_ident_lookup 的 last_seen DESC，重建時要照原本方向
+        indexes.setdefault(r["Key_name"], []).append((r["Seq_in_index"], col))
+    indexes = {name: [c for _, c in sorted(cols)] for name, cols in indexes.items()}
+    if indexes:
+        cur.execute(f"ALTER TABLE {table} " + ", ".join(f"DROP INDEX `{name}`" for name in indexes))
+    return indexes
+
+def recreate_indexes(cur, table, indexes):
+    # 單一 ALTER 一次排序建完所有索引
+    if indexes:
+        cur.execute(f"ALTER TABLE {table} " + ", ".join(
+            f"ADD INDEX `{name}` ({', '.join(cols)})" for name, cols in indexes.items()))
+
+def restore_indexes(mconn, dropped):
+    # 搬移中途斷線也要建回索引：先 ping（必要時重連）再 ALTER
+    try:
+        mconn.ping(reconnect=True)
+    except pymysql.MySQLError:
+        pass
+    with mconn.cursor() as cur:
+        for t, indexes in dropped.items():
+            recreate_indexes(cur, t, indexes)
 
 def as_dt(val):
     # SQLite 可能存 TEXT/NULL；MySQL DATETIME 需要 datetime 或字串
@@ -35,29 +177,78 @@ def as_dt(val):
         return None
     if isinstance(val, (datetime, )):
         return val
+    # SQLite 存 unix time（秒，webhook.py 的 INTEGER 欄位）：直接轉，不走字串解析
+    if isinstance(val, (int, float)):
+        return datetime.fromtimestamp(int(val))
     s = str(val).strip()
     if not s:
         return None
-    # 常見格式：2026-02-27 14:37:15
+    # 常見格式：2026-02-27 14:37:15（ISO 走 C 實作的 fromisoformat，不行再退回 strptime）
+    try:
+        return datetime.fromisoformat(s[:19].replace(" ", "T"))
+    except ValueError:
+        pass
     for fmt in ("%Y-%m-%d %H:%M:%S", "%Y-%m-%dT%H:%M:%S"):
         try:
             return datetime.strptime(s[:19], fmt)
         except:
             pass
-    # 如果 SQLite 存的是 unix time（秒），可在此加轉換
     return None
 
-def main():
-    sconn = sqlite3.connect(SQLITE_PATH)
-    sconn.row_factory = sqlite3.Row
+def as_dt_column(values):
+    """整欄轉 datetime：字串交給 pandas 向量化（cache=True 重複值只解析一次），其餘走 as_dt"""
+    if pd is None:
+        return [as_dt(v) for v in values]
+    out = [None if isinstance(v, str) else as_dt(v) for v in values]
+    idx = [i for i, v in enumerate(values) if isinstance(v, str) and v.strip()]
+    if idx:
+        parsed = pd.to_datetime([values[i].strip()[:19] for i in idx],
+                                format="ISO8601", errors="coerce", cache=True)
+        for i, ts in zip(idx, parsed):
+            out[i] = None if pd.isna(ts) else ts.to_pydatetime()
+    return out
 
-    mconn = connect_mysql()
-    mcur = mconn.cursor()
+def identity_params(rows, now_dt):
+    created = as_dt_column([r.get("created_at") for r in rows])
+    last_seen = as_dt_column([r.get("last_seen") for r in rows])
+    return [(
+        r.get("id_type"),
+        r.get("line_id"),
+        r.get("phone"),
+        r.get("note"),
+        r.get("member_token") if "member_token" in r else r.get("token"),
+        c or now_dt,
+        ls or now_dt,
+    ) for r, c, ls in zip(rows, created, last_seen)]
+
+def member_params(rows, now_dt):
+    created = as_dt_column([r.get("created_at") for r in rows])
+    updated = as_dt_column([r.get("updated_at") for r in rows])
+    return [(
+        r.get("phone"),
+        r.get("name"),
+        r.get("email"),
+        r.get("group_name"),
+        r.get("remark"),
+        r.get("line_id"),
+        c or now_dt,
+        u or now_dt,
+    ) for r, c, u in zip(rows, created, updated)]
+
+def login_state_params(rows, now_dt):
+    created = as_dt_column([r.get("created_at") for r in rows])
+    expires = as_dt_column([r.get("expires_at") for r in rows])
+    return [(
+        r.get("state"),
+        r.get("phone"),
+        c or now_dt,
+        e or now_dt,
+    ) for r, c, e in zip(rows, created, expires)]
 
+def load_tables(sconn, mcur, now_dt):
     # ===== identities =====
     # 依你 v2.3：id_type, line_id, phone, note, created_at, last_seen, member_token
-    identities = fetch_all_sqlite(sconn, "SELECT * FROM identities")
-    print("identities:", len(identities))
+    to_params = lambda rows: identity_params(rows, now_dt)
 
     sql_id_upsert = """
     INSERT INTO identities (id_type, line_id, phone, note, member_token, created_at, last_seen)
@@ -69,20 +260,14 @@ def main():
       last_seen=VALUES(last_seen)
     """
 
-    for r in identities:
-        mcur.execute(sql_id_upsert, (
-            r.get("id_type"),
-            r.get("line_id"),
-            r.get("phone"),
-            r.get("note"),
-            r.get("member_token") if "member_token" in r else r.get("token"),
-            as_dt(r.get("created_at")) or datetime.now(),
-            as_dt(r.get("last_seen")) or datetime.now(),
-        ))
+    n = load_or_upsert(mcur, sconn, "SELECT * FROM identities", to_params, "identities",
+                       ("id_type", "line_id", "phone", "note", "member_token", "created_at", "last_seen"),
+                       ("phone", "note", "member_token", "last_seen"),
+                       sql_id_upsert)
+    print("identities:", n)
 
     # ===== members =====
-    members = fetch_all_sqlite(sconn, "SELECT * FROM members")
-    print("members:", len(members))
+    to_params = lambda rows: member_params(rows, now_dt)
 
     sql_mem_upsert = """
     INSERT INTO members (phone, name, email, group_name, remark, line_id, created_at, updated_at)
@@ -96,22 +281,15 @@ def main():
       updated_at=VALUES(updated_at)
     """
 
-    for r in members:
-        mcur.execute(sql_mem_upsert, (
-            r.get("phone"),
-            r.get("name"),
-            r.get("email"),
-            r.get("group_name"),
-            r.get("remark"),
-            r.get("line_id"),
-            as_dt(r.get("created_at")) or datetime.now(),
-            as_dt(r.get("updated_at")) or datetime.now(),
-        ))
+    n = load_or_upsert(mcur, sconn, "SELECT * FROM members", to_params, "members",
+                       ("phone", "name", "email", "group_name", "remark", "line_id", "created_at", "updated_at"),
+                       ("name", "email", "group_name", "remark", "line_id", "updated_at"),
+                       sql_mem_upsert)
+    print("members:", n)
 
     # ===== login_states（如果有）=====
     try:
-        login_states = fetch_all_sqlite(sconn, "SELECT * FROM login_states")
-        print("login_states:", len(login_states))
+        batches = iter_sqlite(sconn, "SELECT * FROM login_states")
 
         sql_ls_upsert = """
         INSERT INTO login_states (state, phone, created_at, expires_at)
@@ -121,17 +299,49 @@ def main():
           created_at=VALUES(created_at),
           expires_at=VALUES(expires_at)
         """
-        for r in login_states:
-            mcur.execute(sql_ls_upsert, (
-                r.get("state"),
-                r.get("phone"),
-                as_dt(r.get("created_at")) or datetime.now(),
-                as_dt(r.get("expires_at")) or datetime.now(),
-            ))
+        n = upsert_batches(mcur, sql_ls_upsert, batches, lambda rows: login_state_params(rows, now_dt))
+        print("login_states:", n)
     except sqlite3.OperationalError:
         print("login_states table not found in SQLite — skipped.")
 
-    mconn.commit()
+def main():
+    # 缺時間欄位時的預設值：整批共用同一個時間點
+    now_dt = datetime.now()
+
+    sconn = sqlite3.connect(SQLITE_PATH)
+    sconn.row_factory = sqlite3.Row
+
+    mconn = connect_mysql()
+    mcur = mconn.cursor()
+
+    # 一次性搬移：整段包成單一交易，並暫停外鍵檢查（目標表全空時連唯一鍵檢查也暫停）
+    for stmt in BULK_LOAD_OFF:
+        mcur.execute(stmt)
+    if not bulk_unique_checks_off(mcur):
+        print("target tables not empty: unique_checks stays on (UPSERT)")
+
+    # 次要索引搬完再建（DDL 會隱含 commit，所以放在交易開始前）
+    dropped = {}
+    try:
+        for t in ("identities", "members", "login_states"):
+            dropped[t] = drop_secondary_indexes(mcur, t)
+
+        load_tables(sconn, mcur, now_dt)
+
+        for stmt in BULK_LOAD_ON:
+            mcur.execute(stmt)
+        mconn.commit()
+    except Exception:
+        # 先 rollback：下面重建索引的 DDL 會隱含 commit，不能把搬到一半的資料一起 commit 進去
+        try:
+            mconn.rollback()
+        except pymysql.MySQLError:
+            pass
+        raise
+    finally:
+        # 成功或失敗都要把拆掉的索引建回來（否則 idx_ident_lookup / idx_phone_norm 等就永久不見）
+        restore_indexes(mconn, dropped)
+
     mcur.close()
     mconn.close()
     sconn.close()
@@ -13,10 +13,78 @@ MYSQL_CONFIG = {
     "autocommit": False
 }
 
+# 每批 UPSERT 筆數（pymysql executemany 會改寫成單一多列 INSERT）
+BATCH_SIZE = 1000
+
+# 大量匯入期間暫停外鍵檢查（只影響本 session）
+BULK_LOAD_OFF = (
+    "SET SESSION autocommit=0",
+    "SET SESSION foreign_key_checks=0",
+)
+BULK_LOAD_ON = (
+    "SET SESSION unique_checks=1",
+    "SET SESSION foreign_key_checks=1",
+)
+
+# unique_checks=0 時 InnoDB 不檢查次要唯一索引（identities.uq_line_id）的重複，UPSERT 會直接寫出
+# 重複的 line_id 而不走 ON DUPLICATE KEY UPDATE；所以只在這些表全空（第一次搬）時才關，重跑時照常檢查
+UNIQUE_CHECK_TABLES = ("identities", "members")
+
+def bulk_unique_checks_off(cur):
+    for t in UNIQUE_CHECK_TABLES:
+        cur.execute(f"SELECT 1 FROM {t} LIMIT 1")
+        if cur.fetchone():
+            return False
+    cur.execute("SET SESSION unique_checks=0")
+    return True
+
+# UPSERT 語句：模組載入時建好，整個搬移共用同一個 cursor 執行
+SQL_IDENTITIES_UPSERT = """
+    INSERT INTO identities
+    (id_type, line_id, phone, note,
+     created_at, last_seen,
+     member_token, member_token_exp)
+    VALUES (%s,%s,%s,%s,%s,%s,%s,%s)
+    ON DUPLICATE KEY UPDATE
+        phone=VALUES(phone),
+        note=VALUES(note),
+        last_seen=VALUES(last_seen),
+        member_token=VALUES(member_token),
+        member_token_exp=VALUES(member_token_exp)
+"""
+
+SQL_MEMBERS_UPSERT = """
+    INSERT INTO members
+    (phone,name,email,remark,line_id,
+     created_at,updated_at,group_name)
+    VALUES (%s,%s,%s,%s,%s,%s,%s,%s)
+    ON DUPLICATE KEY UPDATE
+        name=VALUES(name),
+        email=VALUES(email),
+        remark=VALUES(remark),
+        line_id=VALUES(line_id),
+        updated_at=VALUES(updated_at),
+        group_name=VALUES(group_name)
+"""
+
+SQL_LOGIN_STATES_UPSERT = """
+    INSERT INTO login_states
+    (state,phone,created_at,expires_at)
+    VALUES (%s,%s,%s,%s)
+    ON DUPLICATE KEY UPDATE
+        phone=VALUES(phone),
+        created_at=VALUES(created_at),
+        expires_at=VALUES(expires_at)
+"""
+
 def ts_to_dt(ts):
     if ts is None:
         return None
-    return datetime.fromtimestamp(int(ts))
+    return datetime.fromtimestamp(ts if isinstance(ts, int) else int(ts))
+
+def executemany_chunked(cur, sql, params, size=BATCH_SIZE):
+    for i in range(0, len(params), size):
+        cur.executemany(sql, params[i:i + size])
 
 def main():
     sconn = sqlite3.connect(SQLITE_PATH)
@@ -24,22 +92,15 @@ def main():
     mconn = pymysql.connect(**MYSQL_CONFIG)
     mcur = mconn.cursor()
 
+    # 一次性搬移：整段包成單一交易，並暫停外鍵檢查（目標表全空時連唯一鍵檢查也暫停）
+    for stmt in BULK_LOAD_OFF:
+        mcur.execute(stmt)
+    if not bulk_unique_checks_off(mcur):
+        print("target tables not empty: unique_checks stays on (UPSERT)")
+
     # identities
     srows = sconn.execute("SELECT * FROM identities").fetchall()
-    for r in srows:
-        mcur.execute("""
-            INSERT INTO identities
-            (id_type, line_id, phone, note,
-             created_at, last_seen,
-             member_token, member_token_exp)
-            VALUES (%s,%s,%s,%s,%s,%s,%s,%s)
-            ON DUPLICATE KEY UPDATE
-                phone=VALUES(phone),
-                note=VALUES(note),
-                last_seen=VALUES(last_seen),
-                member_token=VALUES(member_token),
-                member_token_exp=VALUES(member_token_exp)
-        """, (
+    executemany_chunked(mcur, SQL_IDENTITIES_UPSERT, [(
             r["id_type"],
             r["line_id"],
             r["phone"],
@@ -48,24 +109,11 @@ def main():
             ts_to_dt(r["last_seen"]),
             r["member_token"],
             ts_to_dt(r["member_token_exp"])
-        ))
+        ) for r in srows])
 
     # members
     srows = sconn.execute("SELECT * FROM members").fetchall()
-    for r in srows:
-        mcur.execute("""
-            INSERT INTO members
-            (phone,name,email,remark,line_id,
-             created_at,updated_at,group_name)
-            VALUES (%s,%s,%s,%s,%s,%s,%s,%s)
-            ON DUPLICATE KEY UPDATE
-                name=VALUES(name),
-                email=VALUES(email),
-                remark=VALUES(remark),
-                line_id=VALUES(line_id),
-                updated_at=VALUES(updated_at),
-                group_name=VALUES(group_name)
-        """, (
+    executemany_chunked(mcur, SQL_MEMBERS_UPSERT, [(
             r["phone"],
             r["name"],
             r["email"],
@@ -74,26 +122,19 @@ def main():
             ts_to_dt(r["created_at"]),
             ts_to_dt(r["updated_at"]),
             r["group_name"]
-        ))
+        ) for r in srows])
 
     # login_states
     srows = sconn.execute("SELECT * FROM login_states").fetchall()
-    for r in srows:
-        mcur.execute("""
-            INSERT INTO login_states
-            (state,phone,created_at,expires_at)
-            VALUES (%s,%s,%s,%s)
-            ON DUPLICATE KEY UPDATE
-                phone=VALUES(phone),
-                created_at=VALUES(created_at),
-                expires_at=VALUES(expires_at)
-        """, (
+    executemany_chunked(mcur, SQL_LOGIN_STATES_UPSERT, [(
             r["state"],
             r["phone"],
             ts_to_dt(r["created_at"]),
             ts_to_dt(r["expires_at"])
-        ))
+        ) for r in srows])
 
+    for stmt in BULK_LOAD_ON:
+        mcur.execute(stmt)
     mconn.commit()
     mconn.close()
     sconn.close()
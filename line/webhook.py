@@ -20,11 +20,24 @@ import secrets
 import sqlite3
 import time
 import urllib.parse
+from collections import OrderedDict
 from functools import wraps
 from typing import Any, Dict, List, Optional, Tuple
 
 import requests
-from flask import Flask, Response, abort, redirect, request, url_for
+from requests.adapters import HTTPAdapter
+from flask import Flask, Response, abort, g, has_app_context, redirect, request, url_for
+
+try:
+    import orjson  # optional: faster, parses bytes directly
+except ImportError:
+    orjson = None
+
+
+def json_loads(raw: bytes) -> Any:
+    if orjson is not None:
+        return orjson.loads(raw)
+    return json.loads(raw.decode("utf-8"))
 
 # -----------------------------
 # Paths
@@ -43,6 +56,10 @@ LINE_LOGIN_AUTH_URL = "https://access.line.me/oauth2/v2.1/authorize"
 LINE_LOGIN_TOKEN_URL = "https://api.line.me/oauth2/v2.1/token"
 LINE_LOGIN_VERIFY_URL = "https://api.line.me/oauth2/v2.1/verify"
 
+# Keep-alive session shared by all LINE API calls (one TLS handshake per pooled connection)
+_LINE_SESSION = requests.Session()
+_LINE_SESSION.mount("https://", HTTPAdapter(pool_connections=10, pool_maxsize=50))
+
 app = Flask(__name__)
 
 # ==========================================
@@ -66,6 +83,10 @@ CFG = load_config()
 CHANNEL_SECRET = (CFG.get("channel_secret") or "").strip()
 ACCESS_TOKEN = (CFG.get("channel_access_token") or "").strip()
 
+# Keyed once at import; verify_line_signature() copies it per request
+_SECRET_BYTES = CHANNEL_SECRET.encode("utf-8")
+_HMAC_TMPL = hmac.new(_SECRET_BYTES, b"", hashlib.sha256)
+
 # LINE Login
 LINE_LOGIN_CHANNEL_ID = (CFG.get("line_login_channel_id") or "").strip()
 LINE_LOGIN_CHANNEL_SECRET = (CFG.get("line_login_channel_secret") or "").strip()
@@ -91,22 +112,29 @@ AUTO_REPLY_TEXT = (CFG.get("auto_reply_text") or "收到 ✅").strip()
 # -----------------------------
 # In-memory login/session tokens
 # -----------------------------
-_LOGIN_STATE: Dict[str, Dict[str, Any]] = {}     # state -> {phone, nonce, ts}
-_MEMBER_TOKENS: Dict[str, Dict[str, Any]] = {}   # token -> {phone, line_id, ts}
+# insertion order == ts order (fixed TTL), so expired entries are always at the front
+_LOGIN_STATE: "OrderedDict[str, Dict[str, Any]]" = OrderedDict()     # state -> {phone, nonce, ts}
+_MEMBER_TOKENS: "OrderedDict[str, Dict[str, Any]]" = OrderedDict()   # token -> {phone, line_id, ts}
 LOGIN_STATE_TTL_SEC = 10 * 60
 MEMBER_TOKEN_TTL_SEC = 30 * 60
 
 
-def _cleanup_by_ttl(store: Dict[str, Dict[str, Any]], ttl: int) -> None:
+def _cleanup_by_ttl(store: "OrderedDict[str, Dict[str, Any]]", ttl: int) -> None:
     now = int(time.time())
-    expired = [k for k, v in store.items() if now - int(v.get("ts", 0)) > ttl]
-    for k in expired:
-        store.pop(k, None)
+    while store:
+        _, v = next(iter(store.items()))
+        if now - int(v.get("ts", 0)) <= ttl:
+            break
+        store.popitem(last=False)
 
 
 # -----------------------------
 # Utilities
 # -----------------------------
+_NON_DIGITS = re.compile(r"\D+")
+_EMAIL_RE = re.compile(r"^[^@\s]+@[^@\s]+\.[^@\s]+$")
+
+
 def normalize_tw_phone(phone: str) -> str:
     """
     Accept: 09xxxxxxxx, 9xxxxxxxx, +8869xxxxxxxx, 8869xxxxxxxx, with spaces/hyphens
@@ -116,9 +144,12 @@ def normalize_tw_phone(phone: str) -> str:
     p = p.replace(" ", "").replace("-", "")
     if not p:
         return ""
+    # common case: already a clean 09xxxxxxxx
+    if len(p) == 10 and p.isdigit() and p.startswith("09"):
+        return p
     if p.startswith("+"):
         p = p[1:]
-    p = re.sub(r"\D+", "", p)
+    p = _NON_DIGITS.sub("", p)
 
     if p.startswith("886"):
         p = "0" + p[3:]
@@ -135,7 +166,7 @@ def is_valid_email(email: str) -> bool:
     e = (email or "").strip()
     if not e:
         return False
-    return re.match(r"^[^@\s]+@[^@\s]+\.[^@\s]+$", e) is not None
+    return _EMAIL_RE.match(e) is not None
 
 
 def parse_csv_list(raw: str) -> List[str]:
@@ -143,13 +174,7 @@ def parse_csv_list(raw: str) -> List[str]:
 
 
 def uniq_preserve(seq: List[str]) -> List[str]:
-    seen = set()
-    out = []
-    for x in seq:
-        if x and x not in seen:
-            seen.add(x)
-            out.append(x)
-    return out
+    return list(dict.fromkeys(x for x in seq if x))
 
 
 def fmt_ts(ts: Any) -> str:
@@ -162,12 +187,40 @@ def fmt_ts(ts: Any) -> str:
 # -----------------------------
 # DB + migrations
 # -----------------------------
-def db() -> sqlite3.Connection:
+_PRAGMAS = (
+    "PRAGMA journal_mode=WAL",        # readers don't block the writer
+    "PRAGMA synchronous=NORMAL",      # fsync at checkpoint, not every commit (safe with WAL)
+    "PRAGMA mmap_size=268435456",     # 256 MB memory-mapped reads
+    "PRAGMA cache_size=-65536",       # 64 MB page cache
+    "PRAGMA temp_store=MEMORY",
+)
+
+
+def _connect() -> sqlite3.Connection:
     conn = sqlite3.connect(DB_PATH)
     conn.row_factory = sqlite3.Row
+    for pragma in _PRAGMAS:
+        conn.execute(pragma)
+    return conn
+
+
+def db() -> sqlite3.Connection:
+    """One connection per request (flask.g), closed in teardown; fresh connection outside app context."""
+    if not has_app_context():
+        return _connect()
+    conn = g.get("_db")
+    if conn is None:
+        conn = g._db = _connect()
     return conn
 
 
+@app.teardown_appcontext
+def close_db(exc: Optional[BaseException]) -> None:
+    conn = g.pop("_db", None)
+    if conn is not None:
+        conn.close()
+
+
 def _table_columns(conn: sqlite3.Connection, table: str) -> List[str]:
     cur = conn.cursor()
     cur.execute(f"PRAGMA table_info({table})")
@@ -175,7 +228,7 @@ def _table_columns(conn: sqlite3.Connection, table: str) -> List[str]:
 
 
 def init_db() -> None:
-    conn = db()
+    conn = _connect()
     cur = conn.cursor()
 
     # identities
@@ -246,7 +299,6 @@ def upsert_identity(id_type: str, line_id: str) -> None:
         (id_type, line_id, now, now),
     )
     conn.commit()
-    conn.close()
 
 
 def bind_phone(line_id: str, phone: str, note: str = "") -> None:
@@ -258,7 +310,6 @@ def bind_phone(line_id: str, phone: str, note: str = "") -> None:
         (phone, note, now, line_id),
     )
     conn.commit()
-    conn.close()
 
 
 def list_identities(q: str = "", limit: int = 500) -> List[sqlite3.Row]:
@@ -285,7 +336,6 @@ def list_identities(q: str = "", limit: int = 500) -> List[sqlite3.Row]:
             (limit,),
         )
     rows = cur.fetchall()
-    conn.close()
     return rows
 
 
@@ -294,7 +344,6 @@ def get_identity_by_line_id(line_id: str) -> Optional[sqlite3.Row]:
     cur = conn.cursor()
     cur.execute("SELECT * FROM identities WHERE line_id=? LIMIT 1", (line_id,))
     row = cur.fetchone()
-    conn.close()
     return row
 
 
@@ -306,7 +355,6 @@ def get_identity_by_phone(phone: str) -> Optional[sqlite3.Row]:
         (phone,),
     )
     row = cur.fetchone()
-    conn.close()
     return row
 
 
@@ -315,34 +363,27 @@ def delete_identity(line_id: str) -> None:
     cur = conn.cursor()
     cur.execute("DELETE FROM identities WHERE line_id=?", (line_id,))
     conn.commit()
-    conn.close()
+
+
+_UPSERT_MEMBER_SQL = """
+    INSERT INTO members (phone, name, email, group_name, remark, line_id, created_at, updated_at)
+    VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+    ON CONFLICT(phone) DO UPDATE SET
+        name=excluded.name,
+        email=excluded.email,
+        group_name=excluded.group_name,
+        remark=excluded.remark,
+        line_id=excluded.line_id,
+        updated_at=excluded.updated_at
+"""
 
 
 def upsert_member(phone: str, name: str, email: str, group_name: str, remark: str, line_id: str) -> None:
     now = int(time.time())
     conn = db()
     cur = conn.cursor()
-    cur.execute("SELECT phone FROM members WHERE phone=? LIMIT 1", (phone,))
-    exists = cur.fetchone() is not None
-    if not exists:
-        cur.execute(
-            """
-            INSERT INTO members (phone, name, email, group_name, remark, line_id, created_at, updated_at)
-            VALUES (?, ?, ?, ?, ?, ?, ?, ?)
-            """,
-            (phone, name, email, group_name, remark, line_id, now, now),
-        )
-    else:
-        cur.execute(
-            """
-            UPDATE members
-            SET name=?, email=?, group_name=?, remark=?, line_id=?, updated_at=?
-            WHERE phone=?
-            """,
-            (name, email, group_name, remark, line_id, now, phone),
-        )
+    cur.execute(_UPSERT_MEMBER_SQL, (phone, name, email, group_name, remark, line_id, now, now))
     conn.commit()
-    conn.close()
 
 
 def get_member(phone: str) -> Optional[sqlite3.Row]:
@@ -350,21 +391,33 @@ def get_member(phone: str) -> Optional[sqlite3.Row]:
     cur = conn.cursor()
     cur.execute("SELECT * FROM members WHERE phone=? LIMIT 1", (phone,))
     row = cur.fetchone()
-    conn.close()
     return row
 
 
+# stay under SQLite's default 999 host-parameter limit
+IN_CHUNK = 500
+
+
+def _members_in_sql(n: int) -> str:
+    return f"SELECT * FROM members WHERE phone IN ({','.join('?' * n)})"
+
+
+# every chunk but the last is full: one fixed SQL text, reused from sqlite3's statement cache
+SQL_MEMBERS_IN_CHUNK = _members_in_sql(IN_CHUNK)
+
+
 def get_members_map(phones: List[str]) -> Dict[str, sqlite3.Row]:
     phones = [p for p in phones if p]
     if not phones:
         return {}
     conn = db()
     cur = conn.cursor()
-    qmarks = ",".join(["?"] * len(phones))
-    cur.execute(f"SELECT * FROM members WHERE phone IN ({qmarks})", phones)
-    rows = cur.fetchall()
-    conn.close()
-    return {r["phone"]: r for r in rows}
+    out: Dict[str, sqlite3.Row] = {}
+    for i in range(0, len(phones), IN_CHUNK):
+        sub = phones[i : i + IN_CHUNK]
+        cur.execute(SQL_MEMBERS_IN_CHUNK if len(sub) == IN_CHUNK else _members_in_sql(len(sub)), sub)
+        out.update({r["phone"]: r for r in cur.fetchall()})
+    return out
 
 
 def find_phones_by_group_fuzzy(group_terms: List[str]) -> List[str]:
@@ -373,19 +426,16 @@ def find_phones_by_group_fuzzy(group_terms: List[str]) -> List[str]:
         return []
     conn = db()
     cur = conn.cursor()
-    phones: List[str] = []
-    for g in group_terms:
-        cur.execute(
-            """
-            SELECT phone FROM members
-            WHERE group_name LIKE ?
-              AND phone IS NOT NULL AND phone <> ''
-            """,
-            (f"%{g}%",),
-        )
-        phones.extend([r["phone"] for r in cur.fetchall()])
-    conn.close()
-    return phones
+    clauses = " OR ".join(["group_name LIKE ?"] * len(group_terms))
+    cur.execute(
+        f"""
+        SELECT DISTINCT phone FROM members
+        WHERE ({clauses})
+          AND phone IS NOT NULL AND phone <> ''
+        """,
+        [f"%{g}%" for g in group_terms],
+    )
+    return [r["phone"] for r in cur.fetchall()]
 
 
 def find_phones_by_name_fuzzy(name_terms: List[str]) -> List[str]:
@@ -394,19 +444,16 @@ def find_phones_by_name_fuzzy(name_terms: List[str]) -> List[str]:
         return []
     conn = db()
     cur = conn.cursor()
-    phones: List[str] = []
-    for n in name_terms:
-        cur.execute(
-            """
-            SELECT phone FROM members
-            WHERE name LIKE ?
-              AND phone IS NOT NULL AND phone <> ''
-            """,
-            (f"%{n}%",),
-        )
-        phones.extend([r["phone"] for r in cur.fetchall()])
-    conn.close()
-    return phones
+    clauses = " OR ".join(["name LIKE ?"] * len(name_terms))
+    cur.execute(
+        f"""
+        SELECT DISTINCT phone FROM members
+        WHERE ({clauses})
+          AND phone IS NOT NULL AND phone <> ''
+        """,
+        [f"%{n}%" for n in name_terms],
+    )
+    return [r["phone"] for r in cur.fetchall()]
 
 
 # -----------------------------
@@ -453,8 +500,9 @@ def require_api_key_get() -> Optional[Response]:
 def verify_line_signature(body_bytes: bytes, signature_b64: str) -> bool:
     if not CHANNEL_SECRET or not signature_b64:
         return False
-    mac = hmac.new(CHANNEL_SECRET.encode("utf-8"), body_bytes, hashlib.sha256).digest()
-    expected = base64.b64encode(mac).decode("utf-8")
+    m = _HMAC_TMPL.copy()
+    m.update(body_bytes)
+    expected = base64.b64encode(m.digest()).decode("utf-8")
     return hmac.compare_digest(expected, signature_b64)
 
 
@@ -469,7 +517,7 @@ def push_text(to_id: str, text: str) -> Tuple[bool, str]:
     if not ACCESS_TOKEN:
         return False, "Missing channel_access_token"
     payload = {"to": to_id, "messages": [{"type": "text", "text": text}]}
-    r = requests.post(LINE_PUSH_URL, headers=line_headers(), json=payload, timeout=15)
+    r = _LINE_SESSION.post(LINE_PUSH_URL, headers=line_headers(), json=payload, timeout=15)
     if r.status_code != 200:
         return False, f"{r.status_code} {r.text}"
     return True, "ok"
@@ -479,7 +527,7 @@ def reply_text(reply_token: str, text: str) -> Tuple[bool, str]:
     if not ACCESS_TOKEN:
         return False, "Missing channel_access_token"
     payload = {"replyToken": reply_token, "messages": [{"type": "text", "text": text}]}
-    r = requests.post(LINE_REPLY_URL, headers=line_headers(), json=payload, timeout=15)
+    r = _LINE_SESSION.post(LINE_REPLY_URL, headers=line_headers(), json=payload, timeout=15)
     if r.status_code != 200:
         return False, f"{r.status_code} {r.text}"
     return True, "ok"
@@ -503,7 +551,7 @@ def line_callback():
     if not verify_line_signature(body, sig):
         abort(403)
 
-    data = json.loads(body.decode("utf-8"))
+    data = json_loads(body)
     events = data.get("events", [])
 
     for ev in events:
@@ -642,7 +690,7 @@ def line_login_callback():
         "client_id": LINE_LOGIN_CHANNEL_ID,
         "client_secret": LINE_LOGIN_CHANNEL_SECRET,
     }
-    r = requests.post(LINE_LOGIN_TOKEN_URL, data=data, timeout=15)
+    r = _LINE_SESSION.post(LINE_LOGIN_TOKEN_URL, data=data, timeout=15)
     if r.status_code != 200:
         return Response(
             f"<html><meta charset='utf-8'><body><h3>綁定失敗</h3>"
@@ -652,13 +700,13 @@ def line_login_callback():
             status=400,
         )
 
-    tok = r.json()
+    tok = json_loads(r.content)
     id_token = tok.get("id_token")
     if not id_token:
         return Response("Missing id_token", status=400)
 
     # Verify id_token to get sub(userId)
-    vr = requests.post(
+    vr = _LINE_SESSION.post(
         LINE_LOGIN_VERIFY_URL,
         data={"id_token": id_token, "client_id": LINE_LOGIN_CHANNEL_ID},
         timeout=15,
@@ -672,7 +720,7 @@ def line_login_callback():
             status=400,
         )
 
-    v = vr.json()
+    v = json_loads(vr.content)
     user_id = v.get("sub")
     if not user_id:
         return Response("Missing sub(userId)", status=400)
@@ -924,7 +972,6 @@ def member_save():
         (note, phone),
     )
     conn.commit()
-    conn.close()
 
     return redirect(f"{MEMBER_BASE_URL}/member?t={urllib.parse.quote(t)}&msg={urllib.parse.quote('✅ 已儲存會員資料')}")
 
@@ -1206,25 +1253,7 @@ def admin_update():
 
     # Upsert members if phone present
     if phone:
-        cur.execute("SELECT phone FROM members WHERE phone=? LIMIT 1", (phone,))
-        exists = cur.fetchone() is not None
-        if not exists:
-            cur.execute(
-                """
-                INSERT INTO members (phone, name, email, group_name, remark, line_id, created_at, updated_at)
-                VALUES (?, ?, ?, ?, ?, ?, ?, ?)
-                """,
-                (phone, name, email, group_name, remark, line_id, now, now),
-            )
-        else:
-            cur.execute(
-                """
-                UPDATE members
-                SET name=?, email=?, group_name=?, remark=?, line_id=?, updated_at=?
-                WHERE phone=?
-                """,
-                (name, email, group_name, remark, line_id, now, phone),
-            )
+        cur.execute(_UPSERT_MEMBER_SQL, (phone, name, email, group_name, remark, line_id, now, now))
 
         # Update identities.note for list readability
         note = f"{name}<{email}>"
@@ -1235,7 +1264,6 @@ def admin_update():
         cur.execute("UPDATE identities SET note=? WHERE line_id=?", (note, line_id))
 
     conn.commit()
-    conn.close()
 
     return redirect(url_for("admin_home", msg=f"✅ 已更新：{line_id}"))
 
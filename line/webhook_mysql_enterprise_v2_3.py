@@ -6,26 +6,52 @@
 # - Member center (admin view/search): /member?phone=... or /member?line_id=...
 # - Admin console: /admin (push / edit / view / delete) + /admin/export.csv
 # - API push (GET): /api/push?id=... | phone=... | group=... | name=... (fuzzy + multi)
+#   multi-target pushes are queued (202 + job_id) -> /api/push/status/<job_id>; add &wait=1 to block
 # ==========================================
 
+import asyncio
 import base64
 import csv
 import hashlib
+import heapq
 import hmac
 import io
 import json
 import os
+import queue
 import re
 import secrets
+import threading
 import pymysql
 import time
 import datetime
 import urllib.parse
-from functools import wraps
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from contextlib import contextmanager
+from functools import lru_cache, wraps
 from typing import Any, Dict, List, Optional, Tuple
 
 import requests
-from flask import Flask, Response, abort, redirect, request, url_for
+from requests.adapters import HTTPAdapter
+from flask import Flask, Response, abort, redirect, request, stream_with_context, url_for
+from jinja2 import Environment, FileSystemBytecodeCache, FileSystemLoader
+from markupsafe import Markup, escape
+
+try:
+    import aiohttp  # optional: single event loop for /api/push fan-out
+except ImportError:
+    aiohttp = None
+
+try:
+    from dbutils.pooled_db import PooledDB  # optional: pip install DBUtils
+except ImportError:
+    PooledDB = None
+
+try:
+    from flask_compress import Compress  # optional: br/gzip for large HTML / CSV responses
+except ImportError:
+    Compress = None
 
 # -----------------------------
 # Paths
@@ -43,8 +69,32 @@ LINE_LOGIN_AUTH_URL = "https://access.line.me/oauth2/v2.1/authorize"
 LINE_LOGIN_TOKEN_URL = "https://api.line.me/oauth2/v2.1/token"
 LINE_LOGIN_VERIFY_URL = "https://api.line.me/oauth2/v2.1/verify"
 
+# Keep-alive session shared by all LINE API calls (thread-safe across the push pool)
+PUSH_WORKERS = 16
+_LINE_SESSION = requests.Session()
+_LINE_SESSION.mount("https://", HTTPAdapter(pool_connections=PUSH_WORKERS, pool_maxsize=PUSH_WORKERS))
+
 app = Flask(__name__)
 
+if Compress is not None:
+    app.config["COMPRESS_ALGORITHM"] = ["br", "gzip"]
+    app.config["COMPRESS_MIMETYPES"] = ["text/html", "text/csv", "application/json"]
+    app.config["COMPRESS_MIN_SIZE"] = 512
+    app.config["COMPRESS_STREAMS"] = True  # /admin/export.csv is streamed
+    Compress(app)
+
+# Page templates live in templates/; compiled once at import and rendered per request.
+# auto_reload off: no stat() per render (restart to pick up template edits).
+# Bytecode cache (system temp dir) skips recompiling on the next process start.
+_TPL_ENV = Environment(
+    loader=FileSystemLoader(os.path.join(APP_DIR, "templates")),
+    autoescape=True,
+    auto_reload=False,
+    cache_size=400,
+    bytecode_cache=FileSystemBytecodeCache(),
+    trim_blocks=True,
+)
+
 # -----------------------------
 # Config
 # -----------------------------
@@ -94,25 +144,71 @@ API_KEY = (CFG.get("api_key") or "").strip()
 ENABLE_AUTO_REPLY = bool(CFG.get("enable_auto_reply", False))
 AUTO_REPLY_TEXT = (CFG.get("auto_reply_text") or "收到 ✅").strip()
 
+# Outbound push rate limit (requests/sec) shared by all /api/push fan-out workers
+PUSH_RATE_PER_SEC = float(CFG.get("push_rate_per_sec", 100))
+
 # -----------------------------
 # In-memory login/session tokens
 # -----------------------------
 _LOGIN_STATE: Dict[str, Dict[str, Any]] = {}     # state -> {phone, nonce, ts}
 _MEMBER_TOKENS: Dict[str, Dict[str, Any]] = {}   # token -> {phone, line_id, ts}
+_PUSH_JOBS: Dict[str, Dict[str, Any]] = {}      # job_id -> {status, targets, sent, failed, ts}
 LOGIN_STATE_TTL_SEC = 10 * 60
 MEMBER_TOKEN_TTL_SEC = 30 * 60
-
-
-def _cleanup_by_ttl(store: Dict[str, Dict[str, Any]], ttl: int) -> None:
-    now = int(time.time())
-    expired = [k for k, v in store.items() if now - int(v.get("ts", 0)) > ttl]
-    for k in expired:
-        store.pop(k, None)
+PUSH_JOB_TTL_SEC = 60 * 60
+
+# Expiry min-heaps of (expires_at, key); the sweep only pops expired heads
+_LOGIN_STATE_HEAP: List[Tuple[int, str]] = []
+_MEMBER_TOKEN_HEAP: List[Tuple[int, str]] = []
+_PUSH_JOB_HEAP: List[Tuple[int, str]] = []
+SWEEP_INTERVAL_SEC = 5
+_LAST_SWEEP = 0.0
+_SWEEP_LOCK = threading.Lock()
+
+
+def _ttl_put(store: Dict[str, Dict[str, Any]], heap: List[Tuple[int, str]], key: str, value: Dict[str, Any], ttl: int) -> None:
+    with _SWEEP_LOCK:
+        store[key] = value
+        heapq.heappush(heap, (int(value["ts"]) + ttl, key))
+
+
+def _ttl_get(store: Dict[str, Dict[str, Any]], key: str, ttl: int, pop: bool = False) -> Optional[Dict[str, Any]]:
+    """Return the entry only if it has not expired (checked on access, independent of the sweep)."""
+    v = store.pop(key, None) if pop else store.get(key)
+    if v is None:
+        return None
+    if int(time.time()) - int(v.get("ts", 0)) > ttl:
+        store.pop(key, None)
+        return None
+    return v
+
+
+def _sweep_expired_tokens() -> None:
+    """Drop expired login states / member tokens / push jobs, at most once per SWEEP_INTERVAL_SEC."""
+    global _LAST_SWEEP
+    mono = time.monotonic()
+    if mono - _LAST_SWEEP < SWEEP_INTERVAL_SEC:
+        return
+    with _SWEEP_LOCK:
+        _LAST_SWEEP = mono
+        now = int(time.time())
+        for store, heap in (
+            (_LOGIN_STATE, _LOGIN_STATE_HEAP),
+            (_MEMBER_TOKENS, _MEMBER_TOKEN_HEAP),
+            (_PUSH_JOBS, _PUSH_JOB_HEAP),
+        ):
+            while heap and heap[0][0] < now:
+                _, k = heapq.heappop(heap)
+                store.pop(k, None)
 
 
 # -----------------------------
 # Utilities
 # -----------------------------
+_NON_DIGITS = re.compile(r"\D+")
+_EMAIL_RE = re.compile(r"^[^@\s]+@[^@\s]+\.[^@\s]+$")
+
+
 def normalize_tw_phone(phone: str) -> str:
     """
     Accept: 09xxxxxxxx, 9xxxxxxxx, +8869xxxxxxxx, 8869xxxxxxxx, with spaces/hyphens
@@ -122,9 +218,12 @@ def normalize_tw_phone(phone: str) -> str:
     p = p.replace(" ", "").replace("-", "")
     if not p:
         return ""
+    # common case: already a clean 09xxxxxxxx
+    if len(p) == 10 and p.isdigit() and p.startswith("09"):
+        return p
     if p.startswith("+"):
         p = p[1:]
-    p = re.sub(r"\D+", "", p)
+    p = _NON_DIGITS.sub("", p)
 
     if p.startswith("886"):
         p = "0" + p[3:]
@@ -141,7 +240,17 @@ def is_valid_email(email: str) -> bool:
     e = (email or "").strip()
     if not e:
         return False
-    return re.match(r"^[^@\s]+@[^@\s]+\.[^@\s]+$", e) is not None
+    return _EMAIL_RE.match(e) is not None
+
+
+# LINE user/group/room IDs: U/C/R + 32 lowercase hex — already URL-safe
+_LINEID_RE = re.compile(r"^[UCR][0-9a-f]{32}$")
+
+
+def quote_line_id(line_id: str) -> str:
+    if _LINEID_RE.match(line_id):
+        return line_id
+    return urllib.parse.quote(line_id, safe="")
 
 
 def parse_csv_list(raw: str) -> List[str]:
@@ -158,10 +267,12 @@ def uniq_preserve(seq: List[str]) -> List[str]:
     return out
 
 
+@lru_cache(maxsize=8192)
 def fmt_ts(ts: Any) -> str:
     """Format timestamp/datetime for UI.
     - SQLite v2.3 stored unix int seconds
     - MySQL enterprise stores DATETIME
+    Memoized: admin/export rows repeat the same second-resolution values a lot.
     """
     try:
         if ts is None:
@@ -182,23 +293,142 @@ def fmt_ts(ts: Any) -> str:
 # -----------------------------
 # DB + migrations
 # -----------------------------
+MYSQL_KW: Dict[str, Any] = dict(
+    host=MYSQL_HOST,
+    port=MYSQL_PORT,
+    user=MYSQL_USER,
+    password=MYSQL_PASS,
+    database=MYSQL_DB,
+    charset=MYSQL_CHARSET,
+    cursorclass=pymysql.cursors.DictCursor,
+    autocommit=True,
+)
+
+# Connection pool shared by every app that imports db() (webhook_mysql.py too).
+# Created on first use so importing the module never touches MySQL.
+# conn.close() hands the connection back to the pool; ping=1 re-checks it on checkout,
+# so connections dropped after MySQL's wait_timeout reconnect transparently.
+_POOL = None
+_POOL_LOCK = threading.Lock()
+
+
+def _get_pool():
+    global _POOL
+    if _POOL is None:
+        with _POOL_LOCK:
+            if _POOL is None:
+                _POOL = PooledDB(
+                    creator=pymysql,
+                    mincached=2,
+                    maxcached=8,
+                    maxshared=0,
+                    maxconnections=16,
+                    blocking=True,
+                    ping=1,
+                    **MYSQL_KW,
+                )
+    return _POOL
+
+
 def db() -> pymysql.connections.Connection:
-    return pymysql.connect(
-        host=MYSQL_HOST,
-        port=MYSQL_PORT,
-        user=MYSQL_USER,
-        password=MYSQL_PASS,
-        database=MYSQL_DB,
-        charset=MYSQL_CHARSET,
-        cursorclass=pymysql.cursors.DictCursor,
-        autocommit=True,
-    )
+    if PooledDB is not None:
+        return _get_pool().connection()
+    # DBUtils not installed: plain connection per call
+    return pymysql.connect(**MYSQL_KW)
+
+
+@contextmanager
+def db_tx():
+    """One connection, one explicit transaction: yields a cursor, commits on success, rolls back on error."""
+    conn = db()
+    try:
+        conn.begin()
+        yield conn.cursor()
+        conn.commit()
+    except Exception:
+        conn.rollback()
+        raise
+    finally:
+        conn.close()
+
+
+# -----------------------------
+# Read cache for admin listings (list_identities / get_members_map)
+# Short TTL + cleared on every write below, so the admin page never shows
+# stale data written through this app.
+# -----------------------------
+READ_CACHE_TTL_SEC = 30
+READ_CACHE_MAX = 64
+_READ_CACHE: "OrderedDict[tuple, Tuple[float, Any]]" = OrderedDict()
+_READ_CACHE_LOCK = threading.Lock()
+
+
+def _cache_get(key: tuple) -> Any:
+    with _READ_CACHE_LOCK:
+        hit = _READ_CACHE.get(key)
+        if hit is None:
+            return None
+        if time.monotonic() - hit[0] > READ_CACHE_TTL_SEC:
+            _READ_CACHE.pop(key, None)
+            return None
+        return hit[1]
+
+
+def _cache_put(key: tuple, value: Any) -> None:
+    with _READ_CACHE_LOCK:
+        _READ_CACHE[key] = (time.monotonic(), value)
+        _READ_CACHE.move_to_end(key)
+        while len(_READ_CACHE) > READ_CACHE_MAX:
+            _READ_CACHE.popitem(last=False)
+
+
+def invalidate_read_cache() -> None:
+    with _READ_CACHE_LOCK:
+        _READ_CACHE.clear()
 
 
 def _now_dt() -> datetime.datetime:
     return datetime.datetime.now()
 
 
+# Same rules as normalize_tw_phone() for already-stored values (+886 / 886 / 9xxxxxxxx);
+# plain string functions only, so it also works on MySQL 5.7 / MariaDB
+_PHONE_STRIPPED = "REPLACE(REPLACE(REPLACE(phone, ' ', ''), '-', ''), '+', '')"
+PHONE_NORM_SQL = (
+    f"CASE WHEN {_PHONE_STRIPPED} LIKE '8869%' AND CHAR_LENGTH({_PHONE_STRIPPED}) = 12 "
+    f"THEN CONCAT('0', SUBSTRING({_PHONE_STRIPPED}, 4)) "
+    f"WHEN {_PHONE_STRIPPED} LIKE '9%' AND CHAR_LENGTH({_PHONE_STRIPPED}) = 9 "
+    f"THEN CONCAT('0', {_PHONE_STRIPPED}) "
+    f"ELSE NULLIF({_PHONE_STRIPPED}, '') END"
+)
+
+
+def _has_column(cur, table: str, column: str) -> bool:
+    cur.execute(
+        "SELECT 1 FROM information_schema.COLUMNS WHERE TABLE_SCHEMA=DATABASE() AND TABLE_NAME=%s AND COLUMN_NAME=%s",
+        (table, column),
+    )
+    return cur.fetchone() is not None
+
+
+# ER_DUP_FIELDNAME / ER_DUP_KEYNAME: another worker running init_db() got there first
+_SCHEMA_RACE_ERRORS = (1060, 1061)
+
+
+def _alter_if_missing(cur, sql: str) -> None:
+    try:
+        cur.execute(sql)
+    except pymysql.MySQLError as e:
+        if not e.args or e.args[0] not in _SCHEMA_RACE_ERRORS:
+            raise
+
+
+def _ensure_index(cur, table: str, name: str, cols: str) -> None:
+    cur.execute(f"SHOW INDEX FROM {table} WHERE Key_name=%s", (name,))
+    if not cur.fetchall():
+        _alter_if_missing(cur, f"ALTER TABLE {table} ADD INDEX {name} ({cols})")
+
+
 def init_db() -> None:
     conn = db()
     cur = conn.cursor()
@@ -256,6 +486,16 @@ def init_db() -> None:
         """
     )
 
+    # Normalized phone (09xxxxxxxx) maintained by MySQL, so /api/push can match
+    # phones with one indexed IN / JOIN instead of per-phone lookups
+    if not _has_column(cur, "identities", "phone_norm"):
+        _alter_if_missing(cur, f"ALTER TABLE identities ADD COLUMN phone_norm VARCHAR(32) GENERATED ALWAYS AS ({PHONE_NORM_SQL}) STORED")
+    _ensure_index(cur, "identities", "idx_phone_norm", "phone_norm, id_type")
+    # get_identity_by_phone: WHERE id_type=.. AND phone=.. ORDER BY last_seen DESC LIMIT 1
+    # reads the newest entry straight off this index (no filesort); line_id makes it covering
+    # for line_id-only lookups. (line_id itself is already covered by uq_line_id.)
+    _ensure_index(cur, "identities", "idx_ident_lookup", "id_type, phone, last_seen DESC, line_id")
+
     conn.close()
 
 
@@ -274,6 +514,7 @@ def upsert_identity(id_type: str, line_id: str) -> None:
         (id_type, line_id, now, now),
     )
     conn.close()
+    invalidate_read_cache()
 
 
 def bind_phone(line_id: str, phone: str, note: str = "") -> None:
@@ -285,9 +526,14 @@ def bind_phone(line_id: str, phone: str, note: str = "") -> None:
         (phone, note, now, line_id),
     )
     conn.close()
+    invalidate_read_cache()
 
 
 def list_identities(q: str = "", limit: int = 500) -> List[dict]:
+    key = ("identities", q, int(limit))
+    rows = _cache_get(key)
+    if rows is not None:
+        return rows
     conn = db()
     cur = conn.cursor()
     if q:
@@ -312,9 +558,25 @@ def list_identities(q: str = "", limit: int = 500) -> List[dict]:
         )
     rows = cur.fetchall()
     conn.close()
+    _cache_put(key, rows)
     return rows
 
 
+def iter_identities(limit: int = 500, size: int = 200):
+    """Yield identities (newest first) in fetchmany batches; used by the streaming CSV export."""
+    conn = db()
+    try:
+        cur = conn.cursor()
+        cur.execute("SELECT * FROM identities ORDER BY last_seen DESC LIMIT %s", (int(limit),))
+        while True:
+            rows = cur.fetchmany(size)
+            if not rows:
+                break
+            yield rows
+    finally:
+        conn.close()
+
+
 def get_identity_by_line_id(line_id: str) -> Optional[dict]:
     conn = db()
     cur = conn.cursor()
@@ -336,17 +598,44 @@ def get_identity_by_phone(phone: str) -> Optional[dict]:
     return row
 
 
+def get_identities_by_phones(phones: List[str]) -> Dict[str, str]:
+    """normalized phone -> line_id of the most recently seen user bound to it, in one query."""
+    phones = [p for p in phones if p]
+    if not phones:
+        return {}
+    conn = db()
+    cur = conn.cursor()
+    placeholders = ",".join(["%s"] * len(phones))
+    cur.execute(
+        f"SELECT phone_norm, line_id FROM identities WHERE id_type='user' AND phone_norm IN ({placeholders}) "
+        "ORDER BY last_seen DESC",
+        phones,
+    )
+    rows = cur.fetchall()
+    conn.close()
+    out: Dict[str, str] = {}
+    for r in rows:
+        out.setdefault(r["phone_norm"], r["line_id"])
+    return out
+
+
 def delete_identity(line_id: str) -> None:
     conn = db()
     cur = conn.cursor()
     cur.execute("DELETE FROM identities WHERE line_id=%s", (line_id,))
     conn.close()
+    invalidate_read_cache()
 
 
-def upsert_member(phone: str, name: str, email: str, group_name: str, remark: str, line_id: str) -> None:
+def upsert_member(
+    phone: str, name: str, email: str, group_name: str, remark: str, line_id: str, cur=None
+) -> None:
+    """Pass `cur` (e.g. from db_tx()) to run inside the caller's transaction."""
     now = _now_dt()
-    conn = db()
-    cur = conn.cursor()
+    own = cur is None
+    if own:
+        conn = db()
+        cur = conn.cursor()
     cur.execute(
         """
         INSERT INTO members (phone, name, email, group_name, remark, line_id, created_at, updated_at)
@@ -361,7 +650,19 @@ def upsert_member(phone: str, name: str, email: str, group_name: str, remark: st
         """,
         (phone, name, email, group_name, remark, line_id, now, now),
     )
-    conn.close()
+    if own:
+        conn.close()
+        invalidate_read_cache()
+
+
+def member_note(name: str, email: str, group_name: str, remark: str) -> str:
+    # identities.note 讓 Admin 清單更好讀
+    note = f"{name}<{email}>"
+    if group_name:
+        note += f"｜群組:{group_name}"
+    if remark:
+        note += f"｜{remark}"
+    return note
 
 
 def get_member(phone: str) -> Optional[dict]:
@@ -373,59 +674,97 @@ def get_member(phone: str) -> Optional[dict]:
     return row
 
 
+_MEMBER_MAP_COLS = ("phone", "name", "email", "group_name", "remark")
+
+
 def get_members_map(phones: List[str]) -> Dict[str, dict]:
     phones = [p for p in phones if p]
     if not phones:
         return {}
+    key = ("members", tuple(sorted(set(phones))))
+    out = _cache_get(key)
+    if out is not None:
+        return out
     conn = db()
-    cur = conn.cursor()
+    # plain tuple cursor + only the columns the admin list / CSV export read
+    cur = conn.cursor(pymysql.cursors.Cursor)
     placeholders = ",".join(["%s"] * len(phones))
-    cur.execute(f"SELECT * FROM members WHERE phone IN ({placeholders})", phones)
+    cur.execute(f"SELECT {', '.join(_MEMBER_MAP_COLS)} FROM members WHERE phone IN ({placeholders})", phones)
     rows = cur.fetchall()
     conn.close()
-    return {r["phone"]: r for r in rows}
+    out = {r[0]: dict(zip(_MEMBER_MAP_COLS, r)) for r in rows}
+    _cache_put(key, out)
+    return out
 
 
-def find_phones_by_group_fuzzy(group_terms: List[str]) -> List[str]:
-    group_terms = [g.strip() for g in group_terms if g.strip()]
-    if not group_terms:
+def _find_line_ids_by_member_like(column: str, terms: List[str]) -> List[str]:
+    """
+    Members whose `column` contains any of the terms -> their bound LINE users.
+    members.phone is stored as entered (0912-345-678, +886..., spaces), so it goes
+    through normalize_tw_phone here before the indexed phone_norm lookup.
+    """
+    terms = [t.strip() for t in terms if t.strip()]
+    if not terms:
         return []
     conn = db()
     cur = conn.cursor()
-    phones: List[str] = []
-    for g in group_terms:
-        cur.execute(
-            """
-            SELECT phone FROM members
-            WHERE group_name LIKE %s
-              AND phone IS NOT NULL AND phone <> ''
-            """,
-            (f"%{g}%",),
-        )
-        phones.extend([r["phone"] for r in cur.fetchall()])
+    where = " OR ".join([f"{column} LIKE %s"] * len(terms))
+    cur.execute(
+        f"SELECT phone FROM members WHERE ({where}) AND phone IS NOT NULL AND phone <> ''",
+        [f"%{t}%" for t in terms],
+    )
+    rows = cur.fetchall()
     conn.close()
-    return phones
+    phones = uniq_preserve([p for p in (normalize_tw_phone(r["phone"]) for r in rows) if p])
+    bound = get_identities_by_phones(phones)
+    return [bound[p] for p in phones if p in bound]
 
 
-def find_phones_by_name_fuzzy(name_terms: List[str]) -> List[str]:
-    name_terms = [n.strip() for n in name_terms if n.strip()]
-    if not name_terms:
-        return []
-    conn = db()
-    cur = conn.cursor()
-    phones: List[str] = []
-    for n in name_terms:
-        cur.execute(
-            """
-            SELECT phone FROM members
-            WHERE name LIKE %s
-              AND phone IS NOT NULL AND phone <> ''
-            """,
-            (f"%{n}%",),
-        )
-        phones.extend([r["phone"] for r in cur.fetchall()])
-    conn.close()
-    return phones
+def find_line_ids_by_group_fuzzy(group_terms: List[str]) -> List[str]:
+    return _find_line_ids_by_member_like("group_name", group_terms)
+
+
+def find_line_ids_by_name_fuzzy(name_terms: List[str]) -> List[str]:
+    return _find_line_ids_by_member_like("name", name_terms)
+
+
+# -----------------------------
+# Conditional GET for rendered pages
+# -----------------------------
+# Browsers keep the page but must revalidate on every load (so a save is never hidden);
+# an unchanged page then costs a 304 instead of a render + full body.
+PAGE_CACHE_CONTROL = "private, no-cache"
+
+# Changes whenever this file or any page template changes
+def _etag_salt() -> str:
+    h = hashlib.sha1()
+    tpl_dir = os.path.join(APP_DIR, "templates")
+    for path in [__file__] + sorted(os.path.join(tpl_dir, n) for n in os.listdir(tpl_dir)):
+        with open(path, "rb") as f:
+            h.update(f.read())
+    return h.hexdigest()[:12]
+
+
+_ETAG_SALT = _etag_salt()
+
+
+def page_etag(*parts: Any) -> str:
+    """Strong ETag from everything that goes into a page."""
+    return hashlib.sha1(repr((_ETAG_SALT,) + parts).encode("utf-8")).hexdigest()
+
+
+def not_modified(etag: str) -> Response:
+    resp = Response(status=304)
+    resp.set_etag(etag)
+    resp.headers["Cache-Control"] = PAGE_CACHE_CONTROL
+    return resp
+
+
+def cacheable_html(html: str, etag: str) -> Response:
+    resp = Response(html, mimetype="text/html")
+    resp.set_etag(etag)
+    resp.headers["Cache-Control"] = PAGE_CACHE_CONTROL
+    return resp
 
 
 # -----------------------------
@@ -488,17 +827,156 @@ def push_text(to_id: str, text: str) -> Tuple[bool, str]:
     if not ACCESS_TOKEN:
         return False, "Missing channel_access_token"
     payload = {"to": to_id, "messages": [{"type": "text", "text": text}]}
-    r = requests.post(LINE_PUSH_URL, headers=line_headers(), json=payload, timeout=15)
+    r = _LINE_SESSION.post(LINE_PUSH_URL, headers=line_headers(), json=payload, timeout=15)
     if r.status_code != 200:
         return False, f"{r.status_code} {r.text}"
     return True, "ok"
 
 
+class _TokenBucket:
+    """Simple thread-safe token bucket: acquire() blocks until a token is available."""
+
+    def __init__(self, rate: float, burst: int) -> None:
+        self.rate = rate
+        self.burst = burst
+        self.tokens = float(burst)
+        self.ts = time.monotonic()
+        self.lock = threading.Lock()
+
+    def _take(self) -> float:
+        """Take a token if one is available; otherwise return seconds to wait."""
+        with self.lock:
+            now = time.monotonic()
+            self.tokens = min(self.burst, self.tokens + (now - self.ts) * self.rate)
+            self.ts = now
+            if self.tokens >= 1:
+                self.tokens -= 1
+                return 0.0
+            return (1 - self.tokens) / self.rate
+
+    def acquire(self) -> None:
+        wait = self._take()
+        while wait:
+            time.sleep(wait)
+            wait = self._take()
+
+    async def acquire_async(self) -> None:
+        wait = self._take()
+        while wait:
+            await asyncio.sleep(wait)
+            wait = self._take()
+
+
+_PUSH_BUCKET = _TokenBucket(PUSH_RATE_PER_SEC, PUSH_WORKERS)
+
+
+def _push_limited(to_id: str, text: str) -> Tuple[bool, str]:
+    _PUSH_BUCKET.acquire()
+    try:
+        return push_text(to_id, text)
+    except requests.RequestException as e:
+        return False, str(e)
+
+
+async def _push_text_async(session: "aiohttp.ClientSession", to_id: str, text: str) -> Tuple[bool, str]:
+    await _PUSH_BUCKET.acquire_async()
+    payload = {"to": to_id, "messages": [{"type": "text", "text": text}]}
+    try:
+        async with session.post(LINE_PUSH_URL, headers=line_headers(), json=payload) as r:
+            if r.status != 200:
+                return False, f"{r.status} {await r.text()}"
+            return True, "ok"
+    except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+        return False, str(e) or type(e).__name__
+
+
+async def _push_many_async(targets: List[str], text: str) -> List[Tuple[bool, str]]:
+    connector = aiohttp.TCPConnector(limit=32, ttl_dns_cache=300)
+    timeout = aiohttp.ClientTimeout(total=15)
+    async with aiohttp.ClientSession(connector=connector, timeout=timeout) as session:
+        return await asyncio.gather(*[_push_text_async(session, t, text) for t in targets])
+
+
+def push_many(targets: List[str], text: str) -> Tuple[int, List[Dict[str, str]]]:
+    """Push the same text to many targets concurrently; returns (sent, failed)."""
+    if not ACCESS_TOKEN:
+        return 0, [{"to": t, "err": "Missing channel_access_token"} for t in targets]
+    if aiohttp is not None:
+        results = asyncio.run(_push_many_async(targets, text))
+        failed = [{"to": t, "err": m} for t, (ok, m) in zip(targets, results) if not ok]
+        return len(targets) - len(failed), failed
+
+    sent = 0
+    failed: List[Dict[str, str]] = []
+    with ThreadPoolExecutor(max_workers=min(PUSH_WORKERS, len(targets)) or 1) as ex:
+        futs = {ex.submit(_push_limited, t, text): t for t in targets}
+        for f in as_completed(futs):
+            ok, m = f.result()
+            if ok:
+                sent += 1
+            else:
+                failed.append({"to": futs[f], "err": m})
+    return sent, failed
+
+
+# -----------------------------
+# Background push queue: /api/push enqueues and answers 202 right away
+# -----------------------------
+PUSH_QUEUE_WORKERS = 2
+_PUSH_Q: "queue.Queue[Tuple[str, List[str], str]]" = queue.Queue(maxsize=10000)
+_PUSH_WORKERS_STARTED = False
+_PUSH_WORKERS_LOCK = threading.Lock()
+
+
+def _push_worker() -> None:
+    while True:
+        job_id, targets, text = _PUSH_Q.get()
+        job = _PUSH_JOBS.get(job_id)
+        try:
+            if job is not None:
+                job["status"] = "running"
+            sent, failed = push_many(targets, text)
+            if job is not None:
+                job.update(status="done", sent=sent, failed=failed)
+        except Exception as e:  # keep the worker alive
+            if job is not None:
+                job.update(status="error", error=str(e))
+        finally:
+            _PUSH_Q.task_done()
+
+
+def _ensure_push_workers() -> None:
+    # Started on first use, not at import (so gevent's monkey patch in wsgi.py applies first)
+    global _PUSH_WORKERS_STARTED
+    if _PUSH_WORKERS_STARTED:
+        return
+    with _PUSH_WORKERS_LOCK:
+        if not _PUSH_WORKERS_STARTED:
+            for _ in range(PUSH_QUEUE_WORKERS):
+                threading.Thread(target=_push_worker, daemon=True).start()
+            _PUSH_WORKERS_STARTED = True
+
+
+def enqueue_push(targets: List[str], text: str) -> Optional[str]:
+    """Queue a push job; returns its job_id, or None when the queue is full."""
+    _ensure_push_workers()
+    _sweep_expired_tokens()
+    job_id = secrets.token_urlsafe(12)
+    job = {"status": "queued", "targets": len(targets), "sent": 0, "failed": [], "ts": int(time.time())}
+    _ttl_put(_PUSH_JOBS, _PUSH_JOB_HEAP, job_id, job, PUSH_JOB_TTL_SEC)
+    try:
+        _PUSH_Q.put_nowait((job_id, targets, text))
+    except queue.Full:
+        _PUSH_JOBS.pop(job_id, None)
+        return None
+    return job_id
+
+
 def reply_text(reply_token: str, text: str) -> Tuple[bool, str]:
     if not ACCESS_TOKEN:
         return False, "Missing channel_access_token"
     payload = {"replyToken": reply_token, "messages": [{"type": "text", "text": text}]}
-    r = requests.post(LINE_REPLY_URL, headers=line_headers(), json=payload, timeout=15)
+    r = _LINE_SESSION.post(LINE_REPLY_URL, headers=line_headers(), json=payload, timeout=15)
     if r.status_code != 200:
         return False, f"{r.status_code} {r.text}"
     return True, "ok"
@@ -605,7 +1083,7 @@ def line_login_start():
     if not LINE_LOGIN_CHANNEL_ID or not LINE_LOGIN_CHANNEL_SECRET:
         return "Missing LINE Login channel config", 500
 
-    _cleanup_by_ttl(_LOGIN_STATE, LOGIN_STATE_TTL_SEC)
+    _sweep_expired_tokens()
 
     phone_raw = (request.form.get("phone") or "").strip()
     phone = normalize_tw_phone(phone_raw)
@@ -622,7 +1100,7 @@ def line_login_start():
 
     state = secrets.token_urlsafe(16)
     nonce = secrets.token_urlsafe(16)
-    _LOGIN_STATE[state] = {"phone": phone, "nonce": nonce, "ts": int(time.time())}
+    _ttl_put(_LOGIN_STATE, _LOGIN_STATE_HEAP, state, {"phone": phone, "nonce": nonce, "ts": int(time.time())}, LOGIN_STATE_TTL_SEC)
 
     redirect_uri = f"{SITE_BASE_URL}/line/login/callback"
     params = {
@@ -642,7 +1120,7 @@ def line_login_callback():
     code = (request.args.get("code") or "").strip()
     state = (request.args.get("state") or "").strip()
 
-    st = _LOGIN_STATE.pop(state, None)
+    st = _ttl_get(_LOGIN_STATE, state, LOGIN_STATE_TTL_SEC, pop=True)
     if not st:
         return Response(
             "<html><meta charset='utf-8'><body><h3>綁定失敗</h3>"
@@ -663,7 +1141,7 @@ def line_login_callback():
         "client_id": LINE_LOGIN_CHANNEL_ID,
         "client_secret": LINE_LOGIN_CHANNEL_SECRET,
     }
-    r = requests.post(LINE_LOGIN_TOKEN_URL, data=data, timeout=15)
+    r = _LINE_SESSION.post(LINE_LOGIN_TOKEN_URL, data=data, timeout=15)
     if r.status_code != 200:
         return Response(
             f"<html><meta charset='utf-8'><body><h3>綁定失敗</h3>"
@@ -679,7 +1157,7 @@ def line_login_callback():
         return Response("Missing id_token", status=400)
 
     # Verify id_token to get sub(userId)
-    vr = requests.post(
+    vr = _LINE_SESSION.post(
         LINE_LOGIN_VERIFY_URL,
         data={"id_token": id_token, "client_id": LINE_LOGIN_CHANNEL_ID},
         timeout=15,
@@ -703,9 +1181,9 @@ def line_login_callback():
     bind_phone(user_id, phone, note="bound via LINE Login")
 
     # Create member token and redirect to /member (HTTPS recommended)
-    _cleanup_by_ttl(_MEMBER_TOKENS, MEMBER_TOKEN_TTL_SEC)
+    _sweep_expired_tokens()
     t = secrets.token_urlsafe(18)
-    _MEMBER_TOKENS[t] = {"phone": phone, "line_id": user_id, "ts": int(time.time())}
+    _ttl_put(_MEMBER_TOKENS, _MEMBER_TOKEN_HEAP, t, {"phone": phone, "line_id": user_id, "ts": int(time.time())}, MEMBER_TOKEN_TTL_SEC)
 
     return redirect(f"{MEMBER_BASE_URL}/member?t={urllib.parse.quote(t)}")
 
@@ -713,6 +1191,24 @@ def line_login_callback():
 # =========================================================
 # Member Center (user token) + Admin view/search
 # =========================================================
+GROUP_OPTIONS = ("114下創客產品實作", "114下物聯網概論", "114下大數據實作", "其他")
+_GROUP_SET = frozenset(GROUP_OPTIONS)
+
+
+def _build_group_options_html(selected: str) -> Markup:
+    return Markup("").join(
+        Markup('<option value="{0}"{1}>{0}</option>').format(g, Markup(" selected") if g == selected else "")
+        for g in GROUP_OPTIONS
+    )
+
+
+# <option> list for each possible selection, built once at import ("" = none of the known groups)
+_GROUP_OPTIONS_HTML = {g: _build_group_options_html(g) for g in ("",) + GROUP_OPTIONS}
+
+_MEMBER_TPL = _TPL_ENV.get_template("member.html")
+_MEMBER_LOOKUP_TPL = _TPL_ENV.get_template("member_lookup.html")
+
+
 @app.get("/member")
 def member_center():
     # 1) token-based member center (for normal users)
@@ -720,8 +1216,8 @@ def member_center():
     msg = (request.args.get("msg") or "").strip()
 
     if t:
-        _cleanup_by_ttl(_MEMBER_TOKENS, MEMBER_TOKEN_TTL_SEC)
-        st = _MEMBER_TOKENS.get(t)
+        _sweep_expired_tokens()
+        st = _ttl_get(_MEMBER_TOKENS, t, MEMBER_TOKEN_TTL_SEC)
         if not st:
             return Response(
                 "<html><meta charset='utf-8'><body style='font-family:Arial,Microsoft JhengHei;margin:24px'>"
@@ -742,70 +1238,23 @@ def member_center():
         group_val = (m["group_name"] if m and m["group_name"] else "")
         remark_val = (m["remark"] if m and m["remark"] else "")
 
-        html = f"""
-        <html>
-        <head>
-          <meta charset="utf-8">
-          <title>會員中心</title>
-          <style>
-            body{{font-family:Arial,'Microsoft JhengHei';margin:24px;max-width:760px}}
-            .card{{border:1px solid #ddd;border-radius:14px;padding:16px}}
-            label{{display:block;margin-top:12px;margin-bottom:6px}}
-            input,select{{padding:10px;font-size:16px;width:100%;box-sizing:border-box}}
-            textarea{{padding:10px;font-size:16px;width:100%;box-sizing:border-box;min-height:90px}}
-            button{{padding:10px 14px;font-size:16px;cursor:pointer;margin-top:14px}}
-            .hint{{color:#666;font-size:13px;line-height:1.6;margin-top:6px}}
-            .ok{{padding:10px;border:1px solid #cfe8cf;background:#f3fbf3;border-radius:10px;margin-bottom:10px}}
-            code{{background:#f6f6f6;padding:2px 6px;border-radius:6px}}
-          </style>
-        </head>
-        <body>
-          <h2>會員中心</h2>
-          {("<div class='ok'>"+msg+"</div>") if msg else ""}
-
-          <div class="card">
-            <div class="hint">
-              已完成 LINE 綁定 ✅<br>
-              手機：<b>{phone}</b><br>
-              （debug）LINE userId：<code>{line_id}</code>
-            </div>
-
-            <form method="post" action="/member/save">
-              <input type="hidden" name="t" value="{t}">
-
-              <label>姓名</label>
-              <input name="name" value="{name_val}" placeholder="請輸入姓名" required>
-
-              <label>Email</label>
-              <input name="email" value="{email_val}" placeholder="name@example.com" required>
-
-              <label>群組</label>
-              <div class="hint">請選擇你目前的課程/群組（供後續 API 依群組推播使用）</div>
-              <select name="group_name">
-                <option value="" {('selected' if not group_val else '')}>請選擇</option>
-                {f'<option value="{group_val}" selected>（已存）{group_val}</option>' if (group_val and group_val not in ["114下創客產品實作","114下物聯網概論","114下大數據實作","其他"]) else ''}
-                <option value="114下創客產品實作" {('selected' if group_val=="114下創客產品實作" else '')}>114下創客產品實作</option>
-                <option value="114下物聯網概論" {('selected' if group_val=="114下物聯網概論" else '')}>114下物聯網概論</option>
-                <option value="114下大數據實作" {('selected' if group_val=="114下大數據實作" else '')}>114下大數據實作</option>
-                <option value="其他" {('selected' if group_val=="其他" else '')}>其他</option>
-              </select>
-
-              <label>註記</label>
-              <div class="hint">請填寫「上課班級、群組、使用目的等」</div>
-              <textarea name="remark" placeholder="上課班級、群組、使用目的等">{remark_val}</textarea>
-
-              <button type="submit">儲存資料</button>
-            </form>
-
-            <div class="hint" style="margin-top:12px">
-              儲存後可用 API 推播：
-              <code>/api/push?group=醫管三&msg=...&key=...</code>
-            </div>
-          </div>
-        </body>
-        </html>
-        """
-        return Response(html, mimetype="text/html")
+        etag = page_etag("member", t, msg, phone, line_id, name_val, email_val, group_val, remark_val)
+        if etag in request.if_none_match:
+            return not_modified(etag)
+
+        html = _MEMBER_TPL.render(
+            msg=msg,
+            t=t,
+            phone=phone,
+            line_id=line_id,
+            name_val=name_val,
+            email_val=email_val,
+            group_val=group_val,
+            remark_val=remark_val,
+            group_known=group_val in _GROUP_SET,
+            group_options_html=_GROUP_OPTIONS_HTML.get(group_val, _GROUP_OPTIONS_HTML[""]),
+        )
+        return cacheable_html(html, etag)
 
     # 2) admin view/search mode (no token)
     auth = request.headers.get("Authorization", "")
@@ -860,34 +1309,13 @@ def member_center():
     m = get_member(phone_q) if phone_q else None
     ident = get_identity_by_line_id(line_q) if line_q else (get_identity_by_phone(phone_q) if phone_q else None)
 
-    html = f"""
-    <html><head><meta charset="utf-8"><title>會員查詢結果</title>
-    <style>
-      body{{font-family:Arial,'Microsoft JhengHei';margin:24px;max-width:860px}}
-      .btn{{display:inline-block;padding:6px 10px;border:1px solid #ddd;border-radius:8px;text-decoration:none;color:#333;background:#fff;margin-right:8px}}
-      pre{{background:#f6f6f6;padding:12px;border-radius:10px;white-space:pre-wrap}}
-    </style></head>
-    <body>
-      <a class="btn" href="/admin">← 返回 Admin</a>
-      <a class="btn" href="/member">重新查詢</a>
-      <h2>會員中心（管理者查詢）</h2>
-      <pre>
-Identity:
-  line_id: {(ident["line_id"] if ident else "")}
-  phone: {(ident["phone"] if ident else "")}
-  note: {(ident["note"] if ident else "")}
-  created_at: {fmt_ts(ident["created_at"]) if ident else ""}
-  last_seen: {fmt_ts(ident["last_seen"]) if ident else ""}
-
-Member:
-  phone: {phone_q}
-  name: {(m["name"] if m else "")}
-  email: {(m["email"] if m else "")}
-  group_name: {(m["group_name"] if m else "")}
-  remark: {(m["remark"] if m else "")}
-      </pre>
-    </body></html>
-    """
+    html = _MEMBER_LOOKUP_TPL.render(
+        ident=ident,
+        m=m,
+        phone=phone_q,
+        created=fmt_ts(ident["created_at"]) if ident else "",
+        last_seen=fmt_ts(ident["last_seen"]) if ident else "",
+    )
     return Response(html, mimetype="text/html")
 
 
@@ -899,8 +1327,8 @@ def member_save():
     group_name = (request.form.get("group_name") or "").strip()
     remark = (request.form.get("remark") or "").strip()
 
-    _cleanup_by_ttl(_MEMBER_TOKENS, MEMBER_TOKEN_TTL_SEC)
-    st = _MEMBER_TOKENS.get(t)
+    _sweep_expired_tokens()
+    st = _ttl_get(_MEMBER_TOKENS, t, MEMBER_TOKEN_TTL_SEC)
     if not st:
         return Response("Token expired. Please re-bind via /line/login.", status=400)
 
@@ -912,22 +1340,14 @@ def member_save():
     if not is_valid_email(email):
         return redirect(f"{MEMBER_BASE_URL}/member?t={urllib.parse.quote(t)}&msg={urllib.parse.quote('❌ Email 格式不正確')}")
 
-    upsert_member(phone, name, email, group_name, remark, line_id)
-
-    # Update identities.note for admin readability
-    note = f"{name}<{email}>"
-    if group_name:
-        note += f"｜群組:{group_name}"
-    if remark:
-        note += f"｜{remark}"
-
-    conn = db()
-    cur = conn.cursor()
-    cur.execute(
-        "UPDATE identities SET note=%s WHERE phone=%s AND id_type='user'",
-        (note, phone),
-    )
-    conn.close()
+    # Member row + identities.note (for admin readability) in one transaction
+    with db_tx() as cur:
+        upsert_member(phone, name, email, group_name, remark, line_id, cur=cur)
+        cur.execute(
+            "UPDATE identities SET note=%s WHERE phone=%s AND id_type='user'",
+            (member_note(name, email, group_name, remark), phone),
+        )
+    invalidate_read_cache()
 
     return redirect(f"{MEMBER_BASE_URL}/member?t={urllib.parse.quote(t)}&msg={urllib.parse.quote('✅ 已儲存會員資料')}")
 
@@ -935,6 +1355,33 @@ def member_save():
 # =========================================================
 # Admin Console
 # =========================================================
+_ADMIN_TPL = _TPL_ENV.get_template("admin.html")
+
+
+def _admin_row(r: dict, m: Optional[dict]) -> Dict[str, Any]:
+    """
+    All per-row values for _ADMIN_TPL, computed once so the loop body only substitutes.
+    User-controlled text is escaped here (Markup passes through autoescape untouched),
+    so line_id is escaped once although the row prints it four times.
+    """
+    line_id = r["line_id"]
+    return {
+        "id_type": r["id_type"],
+        "line_id": escape(line_id),
+        "qid": quote_line_id(line_id),
+        "phone": escape(r["phone"] or ""),
+        "group_name": escape(m["group_name"] or "") if m else "",
+        "member": (
+            {"name": escape(m["name"] or ""), "email": escape(m["email"] or ""), "remark": escape(m["remark"] or "")}
+            if m
+            else None
+        ),
+        "note": escape(r["note"] or ""),
+        "created": fmt_ts(r["created_at"]),
+        "last_seen": fmt_ts(r["last_seen"]),
+    }
+
+
 @app.get("/admin")
 @require_admin
 def admin_home():
@@ -945,109 +1392,14 @@ def admin_home():
     phones = [r["phone"] for r in rows if r["phone"]]
     members_map = get_members_map(phones)
 
-    html = []
-    html.append("<html><head><meta charset='utf-8'><title>LINE 通知中心 v2.3</title>")
-    html.append(
-        """
-        <style>
-          body{font-family:Arial,'Microsoft JhengHei';margin:24px}
-          table{border-collapse:collapse;width:100%}
-          th,td{border:1px solid #ddd;padding:8px;vertical-align:top}
-          th{background:#f4f4f4}
-          input[type=text]{padding:6px}
-          button{padding:6px 10px;cursor:pointer}
-          .mono{font-family:Consolas,monospace}
-          .topbar{display:flex;gap:10px;flex-wrap:wrap;align-items:center;margin:10px 0}
-          .btn{display:inline-block;padding:6px 10px;border:1px solid #ddd;border-radius:8px;text-decoration:none;color:#333;background:#fff}
-          .danger{border:1px solid #c33;color:#c33;background:#fff}
-          .hint{color:#666;font-size:13px;line-height:1.6}
-        </style>
-        """
-    )
-    html.append("</head><body>")
-    html.append("<h2>LINE 通知中心 v2.3 - Admin</h2>")
-
-    if msg:
-        html.append(f"<p style='padding:10px;border:1px solid #ddd;background:#f8f8f8'>{msg}</p>")
-
-    html.append("<div class='topbar'>")
-    html.append("<a class='btn' href='/line/login' target='_blank'>/line/login 綁定入口</a>")
-    html.append("<a class='btn' href='/member' target='_blank'>/member 管理者查詢</a>")
-    html.append("<a class='btn' href='/admin/export.csv'>下載 CSV</a>")
-    html.append("</div>")
-
-    html.append("<form method='get' action='/admin'>")
-    html.append(
-        f"搜尋：<input type='text' name='q' value='{q}' placeholder='line_id / phone / note' style='min-width:280px'> "
-        "<button type='submit'>查詢</button>"
-    )
-    html.append("</form>")
-
-    html.append("<div class='hint' style='margin:10px 0'>")
-    html.append("API：<span class='mono'>/api/push?group=醫管三&msg=通知&key=APIKEY</span> ｜ ")
-    html.append("<span class='mono'>/api/push?name=王&msg=通知&key=APIKEY</span>")
-    html.append("</div>")
-
-    html.append(
-        "<table><tr>"
-        "<th>id_type</th><th>line_id</th><th>phone</th><th>群組</th><th>會員資料</th><th>note</th>"
-        "<th>created</th><th>last_seen</th><th>推播</th><th>操作</th>"
-        "</tr>"
-    )
-
-    for r in rows:
-        line_id = r["line_id"]
-        phone = r["phone"] or ""
-        m = members_map.get(phone)
-        group_name = (m["group_name"] if m and m["group_name"] else "") if phone else ""
-        member_txt = ""
-        if m:
-            member_txt = f"{(m['name'] or '')}<br>{(m['email'] or '')}<br>{(m['remark'] or '')}"
-
-        html.append("<tr>")
-        html.append(f"<td>{r['id_type']}</td>")
-        html.append(f"<td class='mono'>{line_id}</td>")
-        html.append(f"<td>{phone}</td>")
-        html.append(f"<td>{group_name}</td>")
-        html.append(f"<td>{member_txt}</td>")
-        html.append(f"<td>{r['note'] or ''}</td>")
-        html.append(f"<td>{fmt_ts(r['created_at'])}</td>")
-        html.append(f"<td>{fmt_ts(r['last_seen'])}</td>")
-
-        # push
-        html.append("<td>")
-        html.append(
-            f"""
-            <form method="post" action="/admin/push" style="display:flex;gap:6px;align-items:center;margin:0">
-              <input type="hidden" name="to" value="{line_id}">
-              <input type="hidden" name="q" value="{q}">
-              <input name="text" placeholder="輸入要推播的訊息" style="flex:1;min-width:220px;padding:6px">
-              <button type="submit">推播</button>
-            </form>
-            """
-        )
-        html.append("</td>")
-
-        # actions
-        html.append("<td>")
-        html.append(
-            f"""
-            <a class="btn" href="/admin/edit/{urllib.parse.quote(line_id)}">編輯</a>
-            <a class="btn" href="/admin/view/{urllib.parse.quote(line_id)}">記錄</a>
-            <form method="post" action="/admin/delete" style="display:inline;margin-left:6px"
-                  onsubmit="return confirm('確定刪除？\\n{line_id}')">
-              <input type="hidden" name="line_id" value="{line_id}">
-              <input type="hidden" name="q" value="{q}">
-              <button class="danger" type="submit">刪除</button>
-            </form>
-            """
-        )
-        html.append("</td>")
+    view_rows = [_admin_row(r, members_map.get(r["phone"] or "")) for r in rows]
+    etag = page_etag("admin", q, msg, view_rows)
+    if etag in request.if_none_match:
+        return not_modified(etag)
 
-        html.append("</tr>")
-
-    html.append("</table></body></html>")
-    return Response("\n".join(html), mimetype="text/html")
+    # q is printed twice per row: escape it once for the whole page
+    html = _ADMIN_TPL.render(q=escape(q), msg=msg, rows=view_rows)
+    return cacheable_html(html, etag)
 
 
 @app.post("/admin/push")
@@ -1077,6 +1429,9 @@ def admin_delete():
     return redirect(url_for("admin_home", q=q, msg=f"✅ 已刪除：{line_id}"))
 
 
+_ADMIN_VIEW_TPL = _TPL_ENV.get_template("admin_view.html")
+
+
 @app.get("/admin/view/<path:line_id>")
 @require_admin
 def admin_view(line_id):
@@ -1087,40 +1442,19 @@ def admin_view(line_id):
     phone = ident["phone"] or ""
     m = get_member(phone) if phone else None
 
-    html = f"""
-    <html><head><meta charset="utf-8"><title>記錄</title>
-    <style>
-      body{{font-family:Arial,'Microsoft JhengHei';margin:24px}}
-      pre{{background:#f6f6f6;padding:12px;border-radius:10px;white-space:pre-wrap}}
-      .mono{{font-family:Consolas,monospace}}
-      .btn{{display:inline-block;padding:6px 10px;border:1px solid #ddd;border-radius:8px;text-decoration:none;color:#333;background:#fff;margin-right:6px}}
-    </style></head>
-    <body>
-      <a class="btn" href="/admin">← 返回清單</a>
-      <a class="btn" href="/admin/edit/{urllib.parse.quote(line_id)}">編輯</a>
-      <a class="btn" href="/member?line_id={urllib.parse.quote(line_id)}" target="_blank">會員中心(管理者檢視)</a>
-
-      <h2>個別記錄</h2>
-
-      <pre>
-id_type: {ident["id_type"]}
-line_id: {ident["line_id"]}
-phone: {ident["phone"] or ""}
-note: {ident["note"] or ""}
-created_at: {fmt_ts(ident["created_at"])}
-last_seen: {fmt_ts(ident["last_seen"])}
-
-會員資料:
-  姓名: {(m["name"] if m else "") or ""}
-  Email: {(m["email"] if m else "") or ""}
-  群組: {(m["group_name"] if m else "") or ""}
-  註記: {(m["remark"] if m else "") or ""}
-      </pre>
-    </body></html>
-    """
+    html = _ADMIN_VIEW_TPL.render(
+        ident=ident,
+        m=m,
+        qid=quote_line_id(line_id),
+        created=fmt_ts(ident["created_at"]),
+        last_seen=fmt_ts(ident["last_seen"]),
+    )
     return Response(html, mimetype="text/html")
 
 
+_ADMIN_EDIT_TPL = _TPL_ENV.get_template("admin_edit.html")
+
+
 @app.get("/admin/edit/<path:line_id>")
 @require_admin
 def admin_edit(line_id):
@@ -1136,52 +1470,15 @@ def admin_edit(line_id):
     group_name = (m["group_name"] if m else "") or ""
     remark = (m["remark"] if m else "") or ""
 
-    html = f"""
-    <html><head><meta charset="utf-8"><title>編輯</title>
-    <style>
-      body{{font-family:Arial,'Microsoft JhengHei';margin:24px;max-width:760px}}
-      input,textarea{{width:100%;padding:10px;font-size:16px;box-sizing:border-box}}
-      textarea{{min-height:120px}}
-      label{{display:block;margin-top:12px;margin-bottom:6px}}
-      button{{padding:10px 14px;font-size:16px;cursor:pointer;margin-top:14px}}
-      .hint{{color:#666;font-size:13px;line-height:1.6;margin-top:6px}}
-      .mono{{font-family:Consolas,monospace}}
-      .top{{display:flex;gap:10px;align-items:center;flex-wrap:wrap}}
-      .btn{{display:inline-block;padding:6px 10px;border:1px solid #ddd;border-radius:8px;text-decoration:none;color:#333;background:#fff}}
-    </style></head>
-    <body>
-      <div class="top">
-        <a class="btn" href="/admin">← 返回清單</a>
-        <a class="btn" href="/admin/view/{urllib.parse.quote(line_id)}">查看記錄</a>
-        <a class="btn" href="/member?line_id={urllib.parse.quote(line_id)}" target="_blank">會員中心(管理者檢視)</a>
-      </div>
-
-      <h2>編輯使用者</h2>
-      <div class="hint">line_id：<span class="mono">{line_id}</span></div>
-
-      <form method="post" action="/admin/update">
-        <input type="hidden" name="line_id" value="{line_id}">
-
-        <label>手機（09xxxxxxxx）</label>
-        <input name="phone" value="{phone}" placeholder="0912345678">
-
-        <label>姓名</label>
-        <input name="name" value="{name}" placeholder="王小明">
-
-        <label>Email</label>
-        <input name="email" value="{email}" placeholder="name@example.com">
-
-        <label>群組</label>
-        <input name="group_name" value="{group_name}" placeholder="醫管三甲">
-
-        <label>註記</label>
-        <div class="hint">請填寫「上課班級、群組、使用目的等」</div>
-        <textarea name="remark" placeholder="上課班級、群組、使用目的等">{remark}</textarea>
-
-        <button type="submit">儲存</button>
-      </form>
-    </body></html>
-    """
+    html = _ADMIN_EDIT_TPL.render(
+        line_id=line_id,
+        qid=quote_line_id(line_id),
+        phone=phone,
+        name=name,
+        email=email,
+        group_name=group_name,
+        remark=remark,
+    )
     return Response(html, mimetype="text/html")
 
 
@@ -1203,22 +1500,13 @@ def admin_update():
 
     # 若有填手機，就同步更新 members（供 group/name 模糊查詢與其它系統共用）
     if phone:
-        upsert_member(phone, name, email, group_name, remark, line_id)
-
-        # identities.note 讓清單更好讀
-        note = f"{name}<{email}>"
-        if group_name:
-            note += f"｜群組:{group_name}"
-        if remark:
-            note += f"｜{remark}"
-
-        conn = db()
-        cur = conn.cursor()
-        cur.execute(
-            "UPDATE identities SET phone=%s, note=%s, last_seen=%s WHERE line_id=%s",
-            (phone, note, now, line_id),
-        )
-        conn.close()
+        with db_tx() as cur:
+            upsert_member(phone, name, email, group_name, remark, line_id, cur=cur)
+            cur.execute(
+                "UPDATE identities SET phone=%s, note=%s, last_seen=%s WHERE line_id=%s",
+                (phone, member_note(name, email, group_name, remark), now, line_id),
+            )
+        invalidate_read_cache()
     else:
         # 沒填手機就只更新 identities 的 last_seen（避免把 phone 清空造成誤判）
         conn = db()
@@ -1228,6 +1516,7 @@ def admin_update():
             (now, line_id),
         )
         conn.close()
+        invalidate_read_cache()
 
     return redirect(url_for("admin_home", msg="✅ 已更新"))
 
@@ -1235,51 +1524,58 @@ def admin_update():
 @app.get("/admin/export.csv")
 @require_admin
 def admin_export_csv():
-    rows = list_identities("")
-    phones = [r["phone"] for r in rows if r["phone"]]
-    members_map = get_members_map(phones)
+    def gen():
+        buf = io.StringIO()
+        writer = csv.writer(buf)
 
-    output = io.StringIO()
-    writer = csv.writer(output)
-
-    writer.writerow(
-        [
-            "id_type",
-            "line_id",
-            "phone",
-            "member_name",
-            "member_email",
-            "member_group",
-            "member_remark",
-            "note",
-            "created_at",
-            "last_seen",
-        ]
-    )
+        def flush() -> bytes:
+            data = buf.getvalue().encode("utf-8")
+            buf.seek(0)
+            buf.truncate()
+            return data
 
-    for r in rows:
-        phone = r["phone"] or ""
-        m = members_map.get(phone)
+        yield "\ufeff".encode("utf-8")  # Excel-friendly BOM
         writer.writerow(
             [
-                r["id_type"],
-                r["line_id"],
-                phone,
-                (m["name"] if m else ""),
-                (m["email"] if m else ""),
-                (m["group_name"] if m else ""),
-                (m["remark"] if m else ""),
-                (r["note"] or ""),
-                r["created_at"],
-                r["last_seen"],
+                "id_type",
+                "line_id",
+                "phone",
+                "member_name",
+                "member_email",
+                "member_group",
+                "member_remark",
+                "note",
+                "created_at",
+                "last_seen",
             ]
         )
+        yield flush()
+
+        for rows in iter_identities():
+            members_map = get_members_map([r["phone"] for r in rows if r["phone"]])
+            for r in rows:
+                phone = r["phone"] or ""
+                m = members_map.get(phone)
+                writer.writerow(
+                    [
+                        r["id_type"],
+                        r["line_id"],
+                        phone,
+                        (m["name"] if m else ""),
+                        (m["email"] if m else ""),
+                        (m["group_name"] if m else ""),
+                        (m["remark"] if m else ""),
+                        (r["note"] or ""),
+                        r["created_at"],
+                        r["last_seen"],
+                    ]
+                )
+            yield flush()
 
-    data = output.getvalue().encode("utf-8-sig")  # Excel-friendly BOM
     filename = f"line_center_export_{time.strftime('%Y%m%d_%H%M%S')}.csv"
 
     return Response(
-        data,
+        stream_with_context(gen()),
         mimetype="text/csv; charset=utf-8",
         headers={"Content-Disposition": f"attachment; filename={filename}"},
     )
@@ -1312,7 +1608,6 @@ def api_push():
         ok, m = push_text(user_id, msg)
         return {"ok": ok, "mode": "id", "to": user_id, "msg": m}
 
-    targets: List[str] = []
     mode = ""
 
     # 2) phones csv
@@ -1320,35 +1615,20 @@ def api_push():
         mode = "phone"
         phones = [normalize_tw_phone(p) for p in parse_csv_list(phone_csv)]
         phones = uniq_preserve([p for p in phones if p])
-
-        for p in phones:
-            row = get_identity_by_phone(p)
-            if row:
-                targets.append(row["line_id"])
+        bound = get_identities_by_phones(phones)
+        targets = [bound[p] for p in phones if p in bound]
 
     # 3) group fuzzy csv
     elif group_csv:
         mode = "group"
         group_terms = parse_csv_list(group_csv)
-        phones = find_phones_by_group_fuzzy(group_terms)
-        phones = uniq_preserve([normalize_tw_phone(p) for p in phones if p])
-
-        for p in phones:
-            row = get_identity_by_phone(p)
-            if row:
-                targets.append(row["line_id"])
+        targets = find_line_ids_by_group_fuzzy(group_terms)
 
     # 4) name fuzzy csv
     elif name_csv:
         mode = "name"
         name_terms = parse_csv_list(name_csv)
-        phones = find_phones_by_name_fuzzy(name_terms)
-        phones = uniq_preserve([normalize_tw_phone(p) for p in phones if p])
-
-        for p in phones:
-            row = get_identity_by_phone(p)
-            if row:
-                targets.append(row["line_id"])
+        targets = find_line_ids_by_name_fuzzy(name_terms)
 
     else:
         return Response(
@@ -1365,23 +1645,41 @@ def api_push():
             mimetype="application/json",
         )
 
-    sent = 0
-    failed = []
-    for t in targets:
-        ok, m = push_text(t, msg)
-        if ok:
-            sent += 1
-        else:
-            failed.append({"to": t, "err": m})
-        time.sleep(0.1)
+    # wait=1 keeps the old synchronous behavior (response carries sent/failed)
+    if (request.args.get("wait") or "") == "1":
+        sent, failed = push_many(targets, msg)
+        return {
+            "ok": sent > 0 and len(failed) == 0,
+            "mode": mode,
+            "sent": sent,
+            "failed": failed,
+            "targets": len(targets),
+        }
+
+    job_id = enqueue_push(targets, msg)
+    if not job_id:
+        return Response(
+            json.dumps({"ok": False, "mode": mode, "error": "push queue full, retry later"}, ensure_ascii=False),
+            status=503,
+            mimetype="application/json",
+        )
+    return {"ok": True, "mode": mode, "queued": len(targets), "job_id": job_id}, 202
 
-    return {
-        "ok": sent > 0 and len(failed) == 0,
-        "mode": mode,
-        "sent": sent,
-        "failed": failed,
-        "targets": len(targets),
-    }
+
+@app.get("/api/push/status/<job_id>")
+def api_push_status(job_id):
+    deny = require_api_key_get()
+    if deny:
+        return deny
+
+    job = _ttl_get(_PUSH_JOBS, job_id, PUSH_JOB_TTL_SEC)
+    if not job:
+        return Response(
+            json.dumps({"ok": False, "error": "unknown or expired job_id"}, ensure_ascii=False),
+            status=404,
+            mimetype="application/json",
+        )
+    return {"ok": job["status"] == "done" and not job["failed"], "job_id": job_id, **job}
 
 
 # =========================================================
@@ -0,0 +1,32 @@
+# ==========================================
+# WSGI entry for LINE Notification Center v2.3 (MySQL Enterprise)
+#
+# Linux (gunicorn + gevent workers; every pymysql / requests socket wait yields):
+#   gunicorn -k gevent -w 2 --worker-connections 1000 -b 127.0.0.1:5000 wsgi:app
+#
+# Windows / WAMP (gunicorn does not run on Windows):
+#   python wsgi.py
+#   -> gevent WSGIServer on 127.0.0.1:5000, Apache reverse proxy in front as before
+# ==========================================
+
+try:
+    # Must run before anything imports socket/ssl/threading (pymysql, requests, flask)
+    from gevent import monkey
+
+    monkey.patch_all()
+    from gevent.pywsgi import WSGIServer
+except ImportError:
+    WSGIServer = None
+
+from webhook_mysql_enterprise_v2_3 import app, init_db
+
+# Every gunicorn worker imports this module; init_db() is idempotent and
+# ignores the duplicate column/index errors when workers race on the ALTERs
+init_db()
+
+if __name__ == "__main__":
+    if WSGIServer is not None:
+        WSGIServer(("127.0.0.1", 5000), app).serve_forever()
+    else:
+        # No gevent installed: fall back to the threaded dev server
+        app.run(host="127.0.0.1", port=5000, debug=False, threaded=True)
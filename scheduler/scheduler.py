@@ -3,12 +3,14 @@
 Scheduler v3 (clean, stable) - Python 3.8 compatible
 """
 import json, os, sys, time, traceback, logging
+import heapq
 import threading
 import queue
 from http.server import BaseHTTPRequestHandler, HTTPServer
 from urllib.parse import urlparse, parse_qs
 from logging.handlers import RotatingFileHandler
 from datetime import datetime, timedelta, time as dtime
+from functools import lru_cache
 from typing import Any, Dict, List, Optional, Tuple
 
 import mysql.connector
@@ -24,6 +26,11 @@ try:
 except Exception:
     mqtt = None
 
+try:
+    import orjson  # optional: faster control-API JSON
+except Exception:
+    orjson = None
+
 try:
     from zoneinfo import ZoneInfo  # py>=3.9 or backport on 3.8
 except Exception:
@@ -37,7 +44,7 @@ except Exception:
 
 DEFAULT_CONFIG = {
   "db": {"host":"127.0.0.1","port":3306,"user":"jj","password":"jamesjian","database":"smartcare","pool_size":5,"connect_timeout":10,"charset":"utf8mb4"},
-  "scheduler": {"poll_interval_sec":2,"batch":20,"mysql_session_time_zone":"+08:00","default_timezone":"Asia/Taipei","log_file":"",
+  "scheduler": {"poll_interval_sec":2,"resync_sec":30,"batch":20,"mysql_session_time_zone":"+08:00","default_timezone":"Asia/Taipei","log_file":"",
     "control_enabled": True,
     "control_host": "127.0.0.1",
     "control_port": 5055,
@@ -90,11 +97,15 @@ def log_err(m:str)->None: LOGGER.info(C.RED+m+C.RESET)
 # Immediate-control (HTTP) queue
 # -----------------------------
 IMMEDIATE_QUEUE = queue.Queue()
-INFLIGHT_LOCK = threading.Lock()
-INFLIGHT = set()
+# job_id -> claim token; dict.setdefault is atomic under the GIL, so no lock
+INFLIGHT: Dict[int, object] = {}
+# run_loop waits on this between ticks; enqueue_immediate wakes it early
+WAKE = threading.Condition()
 
 def enqueue_immediate(job_id: int) -> None:
     IMMEDIATE_QUEUE.put(job_id)
+    with WAKE:
+        WAKE.notify()
 
 def drain_immediate(max_n: int = 50):
     ids = []
@@ -105,11 +116,23 @@ def drain_immediate(max_n: int = 50):
             break
     return ids
 
+def _json_bytes(payload: dict) -> bytes:
+    if orjson is not None:
+        return orjson.dumps(payload)
+    return json.dumps(payload, ensure_ascii=False).encode("utf-8")
+
+# fixed control-API responses, serialized once
+_HEALTH_BODY = _json_bytes({"ok": True})
+_NOT_FOUND_BODY = _json_bytes({"ok": False, "error": "not_found"})
+_FORBIDDEN_BODY = _json_bytes({"ok": False, "error": "forbidden"})
+_MISSING_JOB_ID_BODY = _json_bytes({"ok": False, "error": "missing_job_id"})
+_BAD_JOB_ID_BODY = _json_bytes({"ok": False, "error": "bad_job_id"})
+
 class _ControlHandler(BaseHTTPRequestHandler):
     # These will be set at server creation time
     control_token = ""
-    def _send(self, code: int, payload: dict):
-        body = json.dumps(payload, ensure_ascii=False).encode("utf-8")
+    def _send(self, code: int, payload):
+        body = payload if isinstance(payload, bytes) else _json_bytes(payload)
         self.send_response(code)
         self.send_header("Content-Type", "application/json; charset=utf-8")
         self.send_header("Content-Length", str(len(body)))
@@ -123,25 +146,25 @@ class _ControlHandler(BaseHTTPRequestHandler):
     def do_GET(self):
         try:
             u = urlparse(self.path)
-            if u.path not in ("/run_immediate", "/health"):
-                return self._send(404, {"ok": False, "error": "not_found"})
             if u.path == "/health":
-                return self._send(200, {"ok": True})
+                return self._send(200, _HEALTH_BODY)
+            if u.path != "/run_immediate":
+                return self._send(404, _NOT_FOUND_BODY)
 
             qs = parse_qs(u.query or "")
             job_id = qs.get("job_id", [None])[0]
             token = qs.get("token", [None])[0] or self.headers.get("X-Token")
 
             if self.control_token and token != self.control_token:
-                return self._send(403, {"ok": False, "error": "forbidden"})
+                return self._send(403, _FORBIDDEN_BODY)
 
             if job_id is None:
-                return self._send(400, {"ok": False, "error": "missing_job_id"})
+                return self._send(400, _MISSING_JOB_ID_BODY)
 
             try:
                 jid = int(job_id)
             except Exception:
-                return self._send(400, {"ok": False, "error": "bad_job_id"})
+                return self._send(400, _BAD_JOB_ID_BODY)
 
             enqueue_immediate(jid)
             return self._send(200, {"ok": True, "queued": jid})
@@ -161,33 +184,90 @@ def make_pool(db_cfg: Dict[str, Any]) -> pooling.MySQLConnectionPool:
     ps=int(cfg.pop("pool_size",5))
     return pooling.MySQLConnectionPool(pool_name="sched_pool", pool_size=ps, **cfg)
 
+def _discard_conn(conn) -> None:
+    if conn is None: return
+    try: conn.close()
+    except Exception: pass
+
 def set_mysql_session_tz(conn, tz: str) -> None:
     try:
         cur=conn.cursor(); cur.execute("SET time_zone=%s",(tz,)); cur.close()
     except Exception:
         log_warn("MySQL session time_zone set failed (ignored).")
 
-def fetch_due_jobs(conn, batch: int) -> List[Dict[str, Any]]:
-    cur=conn.cursor(dictionary=True)
-    cur.execute("""
-        SELECT * FROM schedule_jobs
-        WHERE enabled=1 AND next_run_at IS NOT NULL AND next_run_at<=NOW()
+# (enabled, next_run_at) lets the per-tick due query range-scan + skip the filesort
+SCHEDULE_INDEXES = (
+    ("idx_sched_due", "CREATE INDEX idx_sched_due ON schedule_jobs (enabled, next_run_at)"),
+)
+
+def ensure_indexes(conn) -> None:
+    cur=conn.cursor()
+    try:
+        for name, ddl in SCHEDULE_INDEXES:
+            try:
+                cur.execute(ddl)
+                log_info(f"Created index {name} on schedule_jobs")
+            except mysql.connector.Error as e:
+                # MySQL has no CREATE INDEX IF NOT EXISTS: 1061 = already there
+                if getattr(e, "errno", None) != 1061:
+                    log_warn(f"Create index {name} failed (ignored): {e}")
+    finally:
+        cur.close()
+
+# Only the columns the scheduler reads (same set job_save.php writes)
+JOB_FIELDS = ("id","name","channel","enabled","schedule_type","timezone","days_of_week","time_of_day","times_of_day",
+              "run_at","next_run_at","http_url","http_method","content_type","http_headers_json","mqtt_topic",
+              "qos","retained","payload","timeout_sec","max_retries","retry_backoff_sec")
+JOB_COLS = ",".join(JOB_FIELDS)
+
+class Job:
+    """
+    One schedule_jobs row, built from a plain tuple cursor in JOB_FIELDS order
+    (no per-row dict), plus the fields normalize_job() derives from it.
+    """
+    __slots__ = JOB_FIELDS + ("_stype","_channel","_dows","_times","_tz")
+
+    def __init__(self, row: tuple):
+        for k, v in zip(JOB_FIELDS, row): setattr(self, k, v)
+        self._stype=self._channel=self._dows=self._times=self._tz=None
+
+def fetch_due_jobs(conn, batch: int) -> List[Job]:
+    cur=conn.cursor()
+    # NULL next_run_at never satisfies <= NOW(), so no separate IS NOT NULL test
+    cur.execute(f"""
+        SELECT {JOB_COLS} FROM schedule_jobs
+        WHERE enabled=1 AND next_run_at<=NOW()
         ORDER BY next_run_at ASC
         LIMIT %s
     """,(batch,))
     rows=cur.fetchall() or []
     cur.close()
-    return rows
+    return [Job(r) for r in rows]
 
-def fetch_job_by_id(conn, job_id: int) -> Optional[Dict[str, Any]]:
-    cur=conn.cursor(dictionary=True)
-    cur.execute("SELECT * FROM schedule_jobs WHERE id=%s",(job_id,))
-    row=cur.fetchone()
+def load_schedule_heap(conn) -> List[Tuple[datetime, int]]:
+    """(next_run_at, id) min-heap of every enabled job; covered by idx_sched_due"""
+    cur=conn.cursor()
+    cur.execute("SELECT next_run_at, id FROM schedule_jobs WHERE enabled=1 AND next_run_at IS NOT NULL")
+    heap=[(r[0], int(r[1])) for r in (cur.fetchall() or []) if isinstance(r[0], datetime)]
+    cur.close()
+    heapq.heapify(heap)
+    return heap
+
+def fetch_jobs_by_ids(conn, job_ids: List[int]) -> Dict[int, Job]:
+    """One round-trip for any number of ids; returns {id: Job}"""
+    ids=sorted(set(job_ids))
+    if not ids: return {}
+    cur=conn.cursor()
+    cur.execute(f"SELECT {JOB_COLS} FROM schedule_jobs WHERE id IN (%s)" % ",".join(["%s"]*len(ids)), tuple(ids))
+    rows=cur.fetchall() or []
     cur.close()
-    return row
+    return {int(r[0]): Job(r) for r in rows}
 
-DOW_MAP={"Mon":0,"Tue":1,"Wed":2,"Thu":3,"Fri":4,"Sat":5,"Sun":6}
+# upper-cased token -> weekday; "MON"/"MONDAY" ... "SUN"/"SUNDAY"
+_DOW_LOOKUP={k:i for i,pair in enumerate([("MON","MONDAY"),("TUE","TUESDAY"),("WED","WEDNESDAY"),("THU","THURSDAY"),
+                                          ("FRI","FRIDAY"),("SAT","SATURDAY"),("SUN","SUNDAY")]) for k in pair}
 
+@lru_cache(maxsize=64)
 def _get_zoneinfo(name: str):
     if ZoneInfo is None: return None
     try: return ZoneInfo(name)
@@ -201,15 +281,13 @@ def _parse_time_of_day(x: Any) -> dtime:
     hh,mm,ss=s.split(":")
     return dtime(int(hh),int(mm),int(ss))
 
-def _parse_times(job: Dict[str,Any]) -> List[dtime]:
+def _parse_times(csv: Any, tod: Any) -> List[dtime]:
     out=[]
-    csv=job.get("times_of_day")
     if csv is not None and str(csv).strip():
         for part in str(csv).split(","):
             part=part.strip()
             if part: out.append(_parse_time_of_day(part))
     if not out:
-        tod=job.get("time_of_day")
         if tod is not None and str(tod).strip():
             out.append(_parse_time_of_day(tod))
     uniq={(t.hour,t.minute,t.second):t for t in out}
@@ -230,34 +308,62 @@ def _parse_days(raw: Any) -> List[int]:
 
     # mysql-connector may return MySQL SET as Python set
     if isinstance(raw, (set, list, tuple)):
-        tokens = [str(t).strip() for t in raw if str(t).strip()]
+        tokens = [str(t).strip().upper() for t in raw]
     else:
-        tokens = [t.strip() for t in str(raw).split(",") if t.strip()]
-
-    norm = {
-        "MON": "Mon", "MONDAY": "Mon",
-        "TUE": "Tue", "TUESDAY": "Tue",
-        "WED": "Wed", "WEDNESDAY": "Wed",
-        "THU": "Thu", "THURSDAY": "Thu",
-        "FRI": "Fri", "FRIDAY": "Fri",
-        "SAT": "Sat", "SATURDAY": "Sat",
-        "SUN": "Sun", "SUNDAY": "Sun",
-    }
-    tokens = [norm.get(t.upper(), t) for t in tokens]
-    return sorted({DOW_MAP[t] for t in tokens if t in DOW_MAP})
-
-
-def compute_next_run_at(job: Dict[str,Any], default_tz: str) -> Optional[datetime]:
-    stype=str(job.get("schedule_type") or "").strip().upper()
-    job_tz_name=(str(job.get("timezone") or default_tz)).strip() or default_tz
-    job_tz=_get_zoneinfo(job_tz_name)
-    sess_tz=_get_zoneinfo(default_tz)
+        tokens = [t.strip().upper() for t in str(raw).split(",")]
+
+    return sorted({_DOW_LOOKUP[t] for t in tokens if t in _DOW_LOOKUP})
+
+def normalize_job(job: Job, default_tz: str) -> Job:
+    """
+    Parse the schedule/channel fields once per fetched row; later code reads:
+      _stype, _channel (upper-cased), _dows, _times, _tz (ZoneInfo or None)
+    """
+    job._stype=str(job.schedule_type or "").strip().upper()
+    job._channel=str(job.channel or "").strip().upper()
+    job._dows=_parse_days(job.days_of_week)
+    job._times=_parse_times(job.times_of_day, job.time_of_day)
+    job._tz=_get_zoneinfo((str(job.timezone or default_tz)).strip() or default_tz)
+    return job
+
+def _log_pause(prefix: str, job: Job) -> None:
+    log_warn(f"{prefix}   ⚠ next_run_at=None -> PAUSE job (check schedule fields): schedule_type=%s days_of_week=%r time_of_day=%r times_of_day=%r timezone=%r" % (
+        str(job.schedule_type), job.days_of_week, job.time_of_day, job.times_of_day, job.timezone
+    ))
+
+def _next_slot(now: datetime, job_tz, times: List[dtime], dows: Optional[List[int]] = None) -> datetime:
+    """
+    Earliest (weekday, time) slot strictly after `now`, by day arithmetic:
+      - days ahead = (dow - today) % 7; a slot already passed today rolls to next week
+      - dows=None means DAILY: today's passed slots roll to tomorrow
+    Candidates are compared as (days, h, m, s) tuples (same-tzinfo datetimes compare
+    by wall time anyway), so only the winner is turned into a datetime.
+    """
+    today=now.date(); today_dow=today.weekday()
+    now_tod=(now.hour,now.minute,now.second)
+    best=None
+    for dow in (dows if dows is not None else (today_dow,)):
+        ahead=(dow-today_dow)%7
+        for tt in times:
+            tod=(tt.hour,tt.minute,tt.second)
+            days=ahead
+            if days==0 and tod<=now_tod:
+                days=7 if dows is not None else 1
+            key=(days,)+tod
+            if best is None or key<best[0]: best=(key, tt)
+    return datetime.combine(today+timedelta(days=best[0][0]), best[1], tzinfo=job_tz)
+
+def compute_next_run_at(job: Job, default_tz: str, sess_tz=None) -> Optional[datetime]:
+    if job._stype is None: normalize_job(job, default_tz)
+    stype=job._stype
+    job_tz=job._tz
+    if sess_tz is None: sess_tz=_get_zoneinfo(default_tz)
 
     now = datetime.now(job_tz) if job_tz else datetime.now()
-    times=_parse_times(job)
+    times=job._times
 
     if stype=="ONCE":
-        ra=job.get("run_at")
+        ra=job.run_at
         if not ra: return None
         try:
             run = ra if isinstance(ra,datetime) else datetime.fromisoformat(str(ra).replace(" ","T"))
@@ -272,35 +378,42 @@ def compute_next_run_at(job: Dict[str,Any], default_tz: str) -> Optional[datetim
     if not times: return None
 
     if stype=="DAILY":
-        for day_offset in range(0,14):
-            d=now.date()+timedelta(days=day_offset)
-            for tt in times:
-                cand = datetime(d.year,d.month,d.day,tt.hour,tt.minute,tt.second,tzinfo=job_tz) if job_tz else datetime(d.year,d.month,d.day,tt.hour,tt.minute,tt.second)
-                if cand>now:
-                    if job_tz and sess_tz: return cand.astimezone(sess_tz).replace(tzinfo=None)
-                    return cand.replace(tzinfo=None) if job_tz else cand
-        return None
-
-    if stype=="WEEKLY":
-        dows=_parse_days(job.get("days_of_week"))
+        best=_next_slot(now, job_tz, times)
+    elif stype=="WEEKLY":
+        dows=job._dows
         if not dows: return None
-        best=None
-        for i in range(0,366):
-            d=now.date()+timedelta(days=i)
-            w=datetime(d.year,d.month,d.day).weekday()
-            if w not in dows: continue
-            for tt in times:
-                cand = datetime(d.year,d.month,d.day,tt.hour,tt.minute,tt.second,tzinfo=job_tz) if job_tz else datetime(d.year,d.month,d.day,tt.hour,tt.minute,tt.second)
-                if cand<=now: continue
-                best=cand if best is None or cand<best else best
-            if best is not None: break
-        if best is None: return None
-        if job_tz and sess_tz: return best.astimezone(sess_tz).replace(tzinfo=None)
-        return best.replace(tzinfo=None) if job_tz else best
-
-    return None
+        best=_next_slot(now, job_tz, times, dows)
+    else:
+        return None
+    if job_tz and sess_tz: return best.astimezone(sess_tz).replace(tzinfo=None)
+    return best.replace(tzinfo=None) if job_tz else best
+
+# Per-tick write-back: updates are queued during the tick, then applied with
+# one executemany per statement and a single commit (flush_job_updates)
+SQL_JOB_PAUSE = "UPDATE schedule_jobs SET enabled=0, last_run_at=NOW() WHERE id=%s"
+SQL_JOB_NEXT = "UPDATE schedule_jobs SET last_run_at=NOW(), next_run_at=%s, enabled=1 WHERE id=%s"
+SQL_JOB_RETRY = "UPDATE schedule_jobs SET next_run_at=%s, last_run_at=NOW() WHERE id=%s"
+
+def new_job_updates() -> Dict[str, List[tuple]]:
+    return {SQL_JOB_PAUSE: [], SQL_JOB_NEXT: [], SQL_JOB_RETRY: []}
+
+def flush_job_updates(conn, updates: Dict[str, List[tuple]]) -> None:
+    # always commits, even with nothing queued: that also ends the read snapshot.
+    # Rows are only dropped once committed; after a rollback they stay queued and
+    # run_loop flushes them at the start of the next tick, before fetching due jobs.
+    cur = conn.cursor()
+    try:
+        for sql, rows in updates.items():
+            if rows: cur.executemany(sql, rows)
+        conn.commit()
+        for rows in updates.values(): rows.clear()
+    except Exception:
+        conn.rollback()
+        raise
+    finally:
+        cur.close()
 
-def update_job_after_success(conn, job_id: int, next_run_at: Optional[datetime], disable: bool) -> None:
+def update_job_after_success(updates, job_id: int, next_run_at: Optional[datetime], disable: bool) -> None:
     """
     After SUCCESS:
       - ONCE: disable (enabled=0)
@@ -308,42 +421,47 @@ def update_job_after_success(conn, job_id: int, next_run_at: Optional[datetime],
       - IMPORTANT: If next_run_at cannot be computed for a recurring job, we PAUSE the job (enabled=0)
         to prevent "0000-00-00 00:00:00" (or NULL) causing immediate repeated executions.
     """
-    cur = conn.cursor()
     if disable:
-        cur.execute("UPDATE schedule_jobs SET enabled=0, last_run_at=NOW() WHERE id=%s", (job_id,))
-        cur.close()
-        conn.commit()
+        updates[SQL_JOB_PAUSE].append((job_id,))
         return
 
     if next_run_at is None:
         # Pause job to avoid spamming
-        cur.execute("UPDATE schedule_jobs SET enabled=0, last_run_at=NOW() WHERE id=%s", (job_id,))
-        cur.close()
-        conn.commit()
+        updates[SQL_JOB_PAUSE].append((job_id,))
         return
 
-    cur.execute("UPDATE schedule_jobs SET last_run_at=NOW(), next_run_at=%s, enabled=1 WHERE id=%s", (next_run_at, job_id))
-    cur.close()
-    conn.commit()
+    updates[SQL_JOB_NEXT].append((next_run_at, job_id))
 
-def update_job_after_failure(conn, job_id: int, max_retries: int, backoff_sec: int) -> Optional[datetime]:
+def _sess_now(sess_tz) -> datetime:
+    # same clock next_run_at is stored in (naive, session time zone)
+    return datetime.now(sess_tz).replace(tzinfo=None) if sess_tz else datetime.now()
+
+def update_job_after_failure(updates, job_id: int, max_retries: int, backoff_sec: int, sess_tz=None) -> Optional[datetime]:
     # best-effort retry without requiring retry_count column
     if max_retries and max_retries>0:
-        retry_at=datetime.now()+timedelta(seconds=int(backoff_sec or 60))
-        cur=conn.cursor()
-        cur.execute("UPDATE schedule_jobs SET next_run_at=%s, last_run_at=NOW() WHERE id=%s",(retry_at,job_id))
-        cur.close(); conn.commit()
+        retry_at=_sess_now(sess_tz)+timedelta(seconds=int(backoff_sec or 60))
+        updates[SQL_JOB_RETRY].append((retry_at,job_id))
         return retry_at
     return None
 
+_HTTP_DRAIN_MAX = 64 * 1024
+
 class Sender:
     def __init__(self, cfg: Dict[str,Any]):
         self.cfg=cfg
         self.http = requests.Session() if requests else None
         if self.http:
             self.http.headers.update({"User-Agent": cfg["http"]["user_agent"]})
+            # default adapter keeps only 10 connections per host; recurring jobs to the
+            # same endpoint should reuse their TLS sessions instead of re-handshaking
+            adapter=requests.adapters.HTTPAdapter(pool_connections=32, pool_maxsize=64, max_retries=0)
+            self.http.mount("http://", adapter)
+            self.http.mount("https://", adapter)
+        # job_id -> (raw string, parsed); recurring jobs re-send the same JSON for years
+        self._hdr_cache: Dict[int, Tuple[Any, Any]] = {}
+        self._body_cache: Dict[int, Tuple[Any, Any]] = {}
         self.mqtt = None
-        self.mqtt_ready=False
+        self.mqtt_up=threading.Event()  # set by on_connect, cleared by on_disconnect
         if mqtt:
             self.mqtt = mqtt.Client(client_id=self._client_id())
             u=(cfg["mqtt"].get("username") or "").strip()
@@ -352,11 +470,14 @@ class Sender:
             if bool(cfg["mqtt"].get("tls")): self.mqtt.tls_set()
             self.mqtt.on_connect=self._on_connect
             self.mqtt.on_disconnect=self._on_disconnect
+            # connect_async + loop_start: paho's network thread does the first connect
+            # and every reconnect, so a broker outage never blocks the scheduler loop
+            self.mqtt.reconnect_delay_set(min_delay=1, max_delay=30)
             try:
-                self.mqtt.connect(cfg["mqtt"]["host"], int(cfg["mqtt"]["port"]), int(cfg["mqtt"]["keepalive"]))
+                self.mqtt.connect_async(cfg["mqtt"]["host"], int(cfg["mqtt"]["port"]), int(cfg["mqtt"]["keepalive"]))
                 self.mqtt.loop_start()
             except Exception as e:
-                log_warn("MQTT connect failed (will retry): %s" % e)
+                log_warn("MQTT connect failed: %s" % e)
 
     def _client_id(self):
         import random
@@ -364,83 +485,109 @@ class Sender:
         return "%s%06d"%(pre, random.randint(0,999999))
 
     def _on_connect(self, client, userdata, flags, rc):
-        self.mqtt_ready = (rc==0)
-        log_ok("MQTT connected.") if self.mqtt_ready else log_warn("MQTT connect rc=%s"%rc)
+        if rc==0: self.mqtt_up.set()
+        else: self.mqtt_up.clear()
+        log_ok("MQTT connected.") if rc==0 else log_warn("MQTT connect rc=%s"%rc)
 
     def _on_disconnect(self, client, userdata, rc):
-        self.mqtt_ready=False
-        log_warn("MQTT disconnected rc=%s"%rc)
-
-    def send(self, job: Dict[str,Any]) -> Tuple[bool, Optional[int], str]:
-        ch=str(job.get("channel") or "").strip().upper()
+        self.mqtt_up.clear()
+        log_warn("MQTT disconnected rc=%s (reconnecting in background)"%rc)
+
+    @staticmethod
+    def _cached_json(cache: Dict[int, Tuple[Any, Any]], job_id: Any, raw: Any, fallback: Any) -> Any:
+        hit=cache.get(job_id)
+        if hit is not None and hit[0]==raw: return hit[1]
+        try: parsed=json.loads(raw)
+        except Exception: parsed=fallback
+        if len(cache)>=1024: cache.popitem()
+        cache[job_id]=(raw, parsed)
+        return parsed
+
+    def send(self, job: Job) -> Tuple[bool, Optional[int], str]:
+        ch=job._channel if job._channel is not None else str(job.channel or "").strip().upper()
         return self._send_http(job) if ch=="HTTP" else self._send_mqtt(job) if ch=="MQTT" else (False,None,"Unsupported channel")
 
-    def _send_http(self, job: Dict[str,Any]) -> Tuple[bool, Optional[int], str]:
+    def _send_http(self, job: Job) -> Tuple[bool, Optional[int], str]:
         if not self.http or not requests: return (False,None,"requests not available")
-        url=str(job.get("http_url") or "").strip()
+        url=str(job.http_url or "").strip()
         if not url: return (False,None,"http_url empty")
-        method=str(job.get("http_method") or "POST").strip().upper()
-        payload=job.get("payload") or ""
-        ctype=str(job.get("content_type") or "text/plain").strip()
+        method=str(job.http_method or "POST").strip().upper()
+        payload=job.payload or ""
+        ctype=str(job.content_type or "text/plain").strip()
         headers=None
-        hj=job.get("http_headers_json")
+        hj=job.http_headers_json
         if hj:
-            try: headers=json.loads(hj) if isinstance(hj,str) else hj
-            except Exception: headers=None
-        timeout=int(job.get("timeout_sec") or 10)
+            headers=self._cached_json(self._hdr_cache, job.id, hj, None) if isinstance(hj,str) else hj
+        timeout=int(job.timeout_sec or 10)
         verify_tls=bool(self.cfg["http"].get("verify_tls", True))
         log_info(f"Sending HTTP request to {url} with headers {headers}")
+        r=None
         try:
+            # stream=True: only the first 512 bytes of the body are ever read (see below)
             if method=="GET":
-                r=self.http.get(url, headers=headers, timeout=timeout, verify=verify_tls)
+                r=self.http.get(url, headers=headers, timeout=timeout, verify=verify_tls, stream=True)
             else:
                 if ctype.lower().startswith("application/json"):
                     obj=payload
                     if isinstance(payload,str) and payload.strip():
-                        try: obj=json.loads(payload)
-                        except Exception: obj=payload
-                    r=self.http.post(url, json=obj, headers=headers, timeout=timeout, verify=verify_tls)
+                        obj=self._cached_json(self._body_cache, job.id, payload, payload)
+                    r=self.http.post(url, json=obj, headers=headers, timeout=timeout, verify=verify_tls, stream=True)
                 else:
-                    r=self.http.post(url, data=str(payload), headers=headers, timeout=timeout, verify=verify_tls)
+                    r=self.http.post(url, data=str(payload), headers=headers, timeout=timeout, verify=verify_tls, stream=True)
             ok=200<=r.status_code<300
-            return (ok, r.status_code, (r.text or "")[:500])
+            raw=r.raw.read(512, decode_content=True) or b""
+            try: snippet=raw.decode(r.encoding or "utf-8", "replace")[:500]
+            except Exception: snippet=repr(raw[:500])
+            # drain small leftovers so the keep-alive connection returns to the pool;
+            # bigger bodies are cut off by close() instead of being downloaded
+            r.raw.read(_HTTP_DRAIN_MAX)
+            return (ok, r.status_code, snippet)
         except Exception as e:
             return (False,None,"HTTP request error: %s"%e)
+        finally:
+            if r is not None: r.close()
 
-    def _send_mqtt(self, job: Dict[str,Any]) -> Tuple[bool, Optional[int], str]:
+    def _send_mqtt(self, job: Job) -> Tuple[bool, Optional[int], str]:
         if not self.mqtt or not mqtt: return (False,None,"paho-mqtt not available")
-        topic=str(job.get("mqtt_topic") or "").strip()
+        topic=str(job.mqtt_topic or "").strip()
         if not topic: return (False,None,"mqtt_topic empty")
-        qos=int(job.get("qos") or 0)
-        retained=bool(job.get("retained") or False)
-        payload=str(job.get("payload") or "")
-        if not self.mqtt_ready:
-            try:
-                self.mqtt.connect(self.cfg["mqtt"]["host"], int(self.cfg["mqtt"]["port"]), int(self.cfg["mqtt"]["keepalive"]))
-                self.mqtt.loop_start()
-            except Exception as e:
-                return (False,None,"MQTT reconnect failed: %s"%e)
+        qos=int(job.qos or 0)
+        retained=bool(job.retained or False)
+        payload=str(job.payload or "")
+        timeout=int(job.timeout_sec or 5)
+        # short grace period (e.g. right after startup); otherwise fail and let retry policy handle it
+        if not self.mqtt_up.wait(timeout=min(2, timeout)):
+            return (False,None,"MQTT not connected (reconnecting in background)")
         try:
             info=self.mqtt.publish(topic, payload=payload, qos=qos, retain=retained)
-            ok=(info.rc==0)
-            return (ok, 0 if ok else info.rc, "published")
+            if info.rc!=0:
+                return (False, info.rc, "publish rc=%s"%info.rc)
+            if qos==0:
+                # fire-and-forget: handed to the network thread, nothing to wait for
+                return (True, 0, "published")
+            # QoS 1/2: only report success once the broker acked (PUBACK/PUBCOMP)
+            info.wait_for_publish(timeout=timeout)
+            if not info.is_published():
+                return (False, None, "MQTT ack timeout after %ss (qos=%s)"%(timeout, qos))
+            return (True, 0, "published (acked)")
         except Exception as e:
             return (False,None,"MQTT publish error: %s"%e)
 
 
-def _execute_one(conn, sender, job: Dict[str,Any], default_tz: str, immediate: bool = False) -> None:
+def _execute_one(updates, sender, job: Job, default_tz: str, immediate: bool = False, sess_tz=None) -> None:
     """
     Execute exactly one job (scheduled or immediate).
-    - On success: recompute next_run_at from fresh DB row and update.
+    - On success: recompute next_run_at from the job row and update
+      (the scheduler is the only writer during a tick, so no re-fetch).
     - On failure: schedule retry or recompute next_run_at (and may pause if invalid schedule).
     """
-    job_id = int(job["id"])
-    name = job.get("name") or ""
-    channel = job.get("channel") or ""
+    job_id = int(job.id)
+    name = job.name or ""
+    channel = job.channel or ""
 
     planned_dt = datetime.now()
     if not immediate:
-        planned = job.get("next_run_at")
+        planned = job.next_run_at
         if isinstance(planned, datetime):
             planned_dt = planned
         elif planned:
@@ -451,9 +598,9 @@ def _execute_one(conn, sender, job: Dict[str,Any], default_tz: str, immediate: b
 
     prefix = "[IMMEDIATE] " if immediate else ""
 
-    target = ("url=%s" % (job.get("http_url") or "")) if str(channel).upper() == "HTTP" else ("topic=%s" % (job.get("mqtt_topic") or ""))
+    target = ("url=%s" % (job.http_url or "")) if job._channel == "HTTP" else ("topic=%s" % (job.mqtt_topic or ""))
 
-    pv = str(job.get("payload") or "")
+    pv = str(job.payload or "")
     if len(pv) > 120:
         pv = pv[:120] + "..."
 
@@ -464,16 +611,13 @@ def _execute_one(conn, sender, job: Dict[str,Any], default_tz: str, immediate: b
 
     if ok:
         log_ok(f"{prefix}   ✅ SUCCESS" + ("" if code is None else f" HTTP={code}"))
-        fresh = fetch_job_by_id(conn, job_id) or job
-        disable = (str(fresh.get("schedule_type") or "").strip().upper() == "ONCE")
-        next_run = compute_next_run_at(fresh, default_tz)
+        disable = (job._stype == "ONCE")
+        next_run = compute_next_run_at(job, default_tz, sess_tz)
 
         if (not disable) and (next_run is None):
-            log_warn(f"{prefix}   ⚠ next_run_at=None -> PAUSE job (check schedule fields): schedule_type=%s days_of_week=%r time_of_day=%r times_of_day=%r timezone=%r" % (
-                str(fresh.get('schedule_type')), fresh.get('days_of_week'), fresh.get('time_of_day'), fresh.get('times_of_day'), fresh.get('timezone')
-            ))
+            _log_pause(prefix, job)
 
-        update_job_after_success(conn, job_id, next_run, disable)
+        update_job_after_success(updates, job_id, next_run, disable)
         log_info(f"{prefix}   Next: " + ("PAUSED" if ((not disable) and (next_run is None)) else (str(next_run) if next_run else "NULL")))
         return
 
@@ -481,21 +625,18 @@ def _execute_one(conn, sender, job: Dict[str,Any], default_tz: str, immediate: b
     log_err(f"{prefix}   ❌ FAILED" + ("" if code is None else f" HTTP={code}"))
     log_err(f"{prefix}   Error: " + (detail or "send failed"))
 
-    max_retries = int(job.get("max_retries") or 0)
-    backoff = int(job.get("retry_backoff_sec") or 60)
-    retry_at = update_job_after_failure(conn, job_id, max_retries, backoff)
+    max_retries = int(job.max_retries or 0)
+    backoff = int(job.retry_backoff_sec or 60)
+    retry_at = update_job_after_failure(updates, job_id, max_retries, backoff, sess_tz)
 
     if retry_at:
         log_warn(f"{prefix}   Retry scheduled at: {retry_at}")
         return
 
-    fresh = fetch_job_by_id(conn, job_id) or job
-    next_run = compute_next_run_at(fresh, default_tz)
+    next_run = compute_next_run_at(job, default_tz, sess_tz)
     if next_run is None:
-        log_warn(f"{prefix}   ⚠ next_run_at=None -> PAUSE job (check schedule fields): schedule_type=%s days_of_week=%r time_of_day=%r times_of_day=%r timezone=%r" % (
-            str(fresh.get('schedule_type')), fresh.get('days_of_week'), fresh.get('time_of_day'), fresh.get('times_of_day'), fresh.get('timezone')
-        ))
-    update_job_after_success(conn, job_id, next_run, False)
+        _log_pause(prefix, job)
+    update_job_after_success(updates, job_id, next_run, False)
     log_info(f"{prefix}   Next (no retry): " + ("PAUSED" if (next_run is None) else (str(next_run) if next_run else "NULL")))
 
 
@@ -504,11 +645,13 @@ def run_loop(cfg: Dict[str,Any]) -> None:
     global LOGGER
     LOGGER=setup_logger(cfg["scheduler"].get("log_file") or "")
     poll=int(cfg["scheduler"]["poll_interval_sec"])
+    resync=max(poll, int(cfg["scheduler"].get("resync_sec") or 30))
     batch=int(cfg["scheduler"]["batch"])
     mysql_tz=str(cfg["scheduler"]["mysql_session_time_zone"] or "+08:00")
     default_tz=str(cfg["scheduler"].get("default_timezone") or "Asia/Taipei")
+    sess_tz=_get_zoneinfo(default_tz)  # resolved once; every job shares it
 
-    log_info(f"Scheduler started. Poll interval={poll}s batch={batch}")
+    log_info(f"Scheduler started. Resync every {resync}s (error backoff {poll}s) batch={batch}")
     log_info(f"Log file: {cfg['scheduler'].get('log_file') or os.path.join(os.getcwd(),'scheduler.log')}")
     log_info(f"MySQL session time_zone will be set to {mysql_tz}")
 
@@ -527,83 +670,101 @@ def run_loop(cfg: Dict[str,Any]) -> None:
         except Exception as e:
             log_warn(f"Control server start failed: {e}")
 
+    # One connection for the whole loop; only re-acquired after it breaks
+    conn=None
+    updates=new_job_updates()
+    # (next_run_at, job_id) of every enabled job: the loop sleeps until heap[0]
+    # instead of polling. Rebuilt from the DB every `resync` seconds to pick up
+    # jobs added/edited by the PHP admin; /run_immediate wakes it via WAKE.
+    heap: List[Tuple[datetime, int]] = []
+    next_sync=0.0
     while True:
+        tick_ok=False
         try:
-            conn=pool.get_connection()
-            set_mysql_session_tz(conn, mysql_tz)
-
-            jobs=fetch_due_jobs(conn, batch)
+            if conn is None:
+                conn=pool.get_connection()
+                set_mysql_session_tz(conn, mysql_tz)
+                ensure_indexes(conn)
+                next_sync=0.0
+
+            # write-backs left over from a failed commit go first: until they land the DB
+            # still has the old next_run_at, and fetch_due_jobs would send those jobs again.
+            # If this raises, the tick ends here without fetching anything.
+            if any(updates.values()): flush_job_updates(conn, updates)
+
+            used_db=False
+            if time.monotonic()>=next_sync:
+                heap=load_schedule_heap(conn)
+                next_sync=time.monotonic()+resync
+                used_db=True
+
+            # the DB stays authoritative: the heap only says *when* to look
+            jobs=[]
+            now=_sess_now(sess_tz)
+            if heap and heap[0][0]<=now:
+                while heap and heap[0][0]<=now: heapq.heappop(heap)
+                jobs=[normalize_job(j, default_tz) for j in fetch_due_jobs(conn, batch)]
+                used_db=True
+                # a full batch may have left more due rows behind: look again right away
+                if len(jobs)>=batch: heapq.heappush(heap, (now, 0))
 
             # Immediate runs (triggered by Admin)
             immediate_ids = drain_immediate(50)
+            if immediate_ids: used_db=True
+            # rows already in the due batch are reused; the rest come in one query
+            by_id = {int(j.id): j for j in jobs}
+            for jid, row in fetch_jobs_by_ids(conn, [i for i in immediate_ids if i not in by_id]).items():
+                by_id[jid]=normalize_job(row, default_tz)
             for jid in immediate_ids:
                 try:
-                    jobx = fetch_job_by_id(conn, int(jid))
+                    jobx = by_id.get(jid)
                     if not jobx:
                         log_warn(f"[IMMEDIATE] Job#{jid} not found")
                         continue
                     # Avoid duplicate concurrent runs
-                    with INFLIGHT_LOCK:
-                        if int(jid) in INFLIGHT:
-                            log_warn(f"[IMMEDIATE] Job#{jid} already inflight")
-                            continue
-                        INFLIGHT.add(int(jid))
+                    claim = object()
+                    if INFLIGHT.setdefault(jid, claim) is not claim:
+                        log_warn(f"[IMMEDIATE] Job#{jid} already inflight")
+                        continue
                     try:
-                        _execute_one(conn, sender, jobx, default_tz, immediate=True)
+                        _execute_one(updates, sender, jobx, default_tz, immediate=True, sess_tz=sess_tz)
                     finally:
-                        with INFLIGHT_LOCK:
-                            INFLIGHT.discard(int(jid))
+                        INFLIGHT.pop(jid, None)
                 except Exception as e:
                     log_err(f"[IMMEDIATE] error: {e}")
                     log_err(traceback.format_exc())
 
             for job in jobs:
-                job_id=int(job["id"])
-                name=job.get("name") or ""
-                channel=job.get("channel") or ""
-                planned=job.get("next_run_at")
-                planned_dt=planned if isinstance(planned,datetime) else datetime.now()
-                target=("url=%s"%(job.get("http_url") or "")) if str(channel).upper()=="HTTP" else ("topic=%s"%(job.get("mqtt_topic") or ""))
-                pv=str(job.get("payload") or "")
-                if len(pv)>120: pv=pv[:120]+"..."
-                log_info(f"▶ Job#{job_id} '{name}' [{channel}] planned={planned_dt} {target} payload={pv!r}")
-                log_info("   Attempt #1")
-
-                ok, code, detail = sender.send(job)
-                if ok:
-                    log_ok("   ✅ SUCCESS"+("" if code is None else f" HTTP={code}"))
-                    fresh=fetch_job_by_id(conn, job_id) or job
-                    disable=(str(fresh.get("schedule_type") or "").strip().upper()=="ONCE")
-                    next_run=compute_next_run_at(fresh, default_tz)
-                    if (not disable) and (next_run is None):
-                        log_warn("   ⚠ next_run_at=None -> PAUSE job (check schedule fields): schedule_type=%s days_of_week=%r time_of_day=%r times_of_day=%r timezone=%r" % (
-                            str(fresh.get('schedule_type')), fresh.get('days_of_week'), fresh.get('time_of_day'), fresh.get('times_of_day'), fresh.get('timezone')
-                        ))
-                    update_job_after_success(conn, job_id, next_run, disable)
-                    log_info(f"   Next: {'PAUSED' if ((not disable) and (next_run is None)) else (next_run if next_run else 'NULL')}" )
-                else:
-                    log_err("   ❌ FAILED"+("" if code is None else f" HTTP={code}"))
-                    log_err("   Error: "+(detail or "send failed"))
-                    max_retries=int(job.get("max_retries") or 0)
-                    backoff=int(job.get("retry_backoff_sec") or 60)
-                    retry_at=update_job_after_failure(conn, job_id, max_retries, backoff)
-                    if retry_at:
-                        log_warn(f"   Retry scheduled at: {retry_at}")
-                    else:
-                        fresh=fetch_job_by_id(conn, job_id) or job
-                        next_run=compute_next_run_at(fresh, default_tz)
-                        if next_run is None:
-                            log_warn("   ⚠ next_run_at=None -> PAUSE job (check schedule fields): schedule_type=%s days_of_week=%r time_of_day=%r times_of_day=%r timezone=%r" % (
-                                str(fresh.get('schedule_type')), fresh.get('days_of_week'), fresh.get('time_of_day'), fresh.get('times_of_day'), fresh.get('timezone')
-                            ))
-                        update_job_after_success(conn, job_id, next_run, False)
-                        log_info(f"   Next (no retry): {next_run if next_run else 'NULL'}")
-
-            conn.close()
+                _execute_one(updates, sender, job, default_tz, sess_tz=sess_tz)
+
+            # re-arm the heap with every new next_run_at / retry time
+            for when, jid in updates[SQL_JOB_NEXT] + updates[SQL_JOB_RETRY]:
+                heapq.heappush(heap, (when, int(jid)))
+
+            # one transaction for every job touched this tick; the commit also
+            # ends the read snapshot so the next tick sees rows changed by Admin
+            if used_db: flush_job_updates(conn, updates)
+            tick_ok=True
+        except (mysql.connector.InterfaceError, mysql.connector.OperationalError) as e:
+            log_warn("MySQL connection lost, reconnecting: %s"%e)
+            _discard_conn(conn)
+            conn=None
         except Exception as e:
             log_err("Scheduler error: %s"%e)
             log_err(traceback.format_exc())
-        time.sleep(poll)
+            # still record the jobs that were already sent this tick
+            try: flush_job_updates(conn, updates)
+            except Exception: pass
+            next_sync=0.0  # heap may have lost popped entries: rebuild next tick
+        with WAKE:
+            # ids queued after this tick's drain skip the wait (no lost wakeup);
+            # after an error always back off so a broken DB isn't hammered
+            if not tick_ok:
+                WAKE.wait(timeout=poll)
+            elif IMMEDIATE_QUEUE.empty():
+                wait=next_sync-time.monotonic()
+                if heap: wait=min(wait, (heap[0][0]-_sess_now(sess_tz)).total_seconds())
+                if wait>0: WAKE.wait(timeout=wait)
 
 def main():
     cfg=load_config(os.path.join(os.getcwd(),"config.json"))
@@ -0,0 +1,247 @@
+# _common.py
+# ------------------------------------------------------------
+# Shared by nlu_parser.py / text2cmd.py
+#
+# One copy of what both voice bridges need: the intent model loader,
+# CN_NUM, the brightness pattern, voice JSON in/out and the paho client
+# scaffolding. Importing both scripts into one process compiles the
+# patterns and loads the intent model only once.
+# ------------------------------------------------------------
+
+import json
+import logging
+import os
+import re
+from functools import lru_cache
+from typing import Any, Dict, Optional, Union
+
+import joblib
+import paho.mqtt.client as mqtt
+
+from async_log import get_logger
+
+try:
+    import numpy as np  # optional: evaluate train.py's numpy export instead of unpickling sklearn
+except Exception:
+    np = None
+
+try:
+    import orjson  # optional: C JSON parse/serialize for every voice message and reply
+except Exception:
+    orjson = None
+
+log = get_logger("mqtt")
+
+MODEL_PATH = "intent_clf.joblib"
+
+# Chinese / ASCII index digits (text2cmd's patterns only ever capture 1..4)
+CN_NUM = {
+    "一": 1, "二": 2, "三": 3, "四": 4, "五": 5, "六": 6,
+    "1": 1, "2": 2, "3": 3, "4": 4, "5": 5, "6": 6
+}
+
+# one scan for all three forms, in priority order:
+#   v1    "亮度 80" (clamped to 0..100)
+#   v2    "調亮 20" (clamped to 0..100)
+#   loose "調到 80" (only counts when already within 0..100)
+BRIGHTNESS_RE = re.compile(
+    r"(?:亮度|明亮|brightness)\s*(?:到|調到|調整到|設為|為)?\s*(?P<v1>\d{1,3})\s*%?"
+    r"|(?:調亮|調暗|變亮|變暗)\s*(?P<v2>\d{1,3})\s*%?"
+    r"|(?:到|調到|設到|設為)\s*(?P<loose>\d{1,3})\s*%?"
+)
+
+
+def _alternation(words) -> Optional["re.Pattern"]:
+    # one compiled search instead of an any(k in text ...) loop; None when there are no words
+    words = sorted({w for w in words if isinstance(w, str) and w}, key=len, reverse=True)
+    return re.compile("|".join(map(re.escape, words))) if words else None
+
+
+_WHITE_SPACES = re.compile(r"\s\s+")  # TfidfVectorizer's whitespace normalization
+
+
+class LinearIntentModel:
+    """
+    train.py's TF-IDF (char n-gram) + linear classifier, evaluated with numpy only.
+    Loads without importing sklearn, the weights are mmapped from .npy files, and it
+    exposes the Pipeline's predict / predict_proba / classes_.
+    """
+
+    def __init__(self, meta: Dict[str, Any], idf, coef, intercept):
+        self.classes_ = list(meta["classes"])
+        self.vocabulary: Dict[str, int] = meta["vocabulary"]
+        self.min_n, self.max_n = meta["ngram_range"]
+        self.lowercase = meta.get("lowercase", True)
+        self.idf = idf
+        self.coef = coef
+        self.intercept = intercept
+        # (n_features, n_classes): one text's known n-grams pick whole rows
+        self.coef_t = np.ascontiguousarray(np.asarray(coef, dtype=np.float64).T)
+
+    @classmethod
+    def load(cls, path: str) -> Optional["LinearIntentModel"]:
+        # intent_clf.joblib -> intent_clf.linear.json + intent_clf.{idf,coef,intercept}.npy
+        base = os.path.splitext(path)[0]
+        try:
+            with open(base + ".linear.json", "r", encoding="utf-8") as f:
+                meta = json.load(f)
+            arrays = [np.load(f"{base}.{name}.npy", mmap_mode="r") for name in ("idf", "coef", "intercept")]
+        except (OSError, ValueError, KeyError):
+            return None
+        return cls(meta, *arrays)
+
+    def _counts(self, text: str) -> Dict[int, int]:
+        # vocabulary column -> count of the text's char n-grams; unknown n-grams are dropped
+        if self.lowercase:
+            text = text.lower()
+        text = _WHITE_SPACES.sub(" ", text)
+        get = self.vocabulary.get
+        counts: Dict[int, int] = {}
+        n_chars = len(text)
+        for n in range(self.min_n, min(self.max_n + 1, n_chars + 1)):
+            for i in range(n_chars - n + 1):
+                j = get(text[i:i + n])
+                if j is not None:
+                    counts[j] = counts.get(j, 0) + 1
+        return counts
+
+    def decision_function(self, texts):
+        intercept = np.asarray(self.intercept, dtype=np.float64)
+        scores = np.empty((len(texts), len(intercept)))
+        for row, text in enumerate(texts):
+            counts = self._counts(text)
+            if not counts:
+                scores[row] = intercept  # no known n-gram: all-zero row, intercept only
+                continue
+            cols = list(counts)
+            x = np.array(list(counts.values()), dtype=np.float64) * self.idf[cols]
+            x /= np.sqrt(x @ x)  # l2 norm, as TfidfVectorizer(norm="l2")
+            scores[row] = intercept + x @ self.coef_t[cols]
+        return scores
+
+    def predict_proba(self, texts):
+        scores = self.decision_function(texts)
+        if scores.shape[1] == 1:  # binary: one logit for classes_[1]
+            p = 1.0 / (1.0 + np.exp(-scores[:, 0]))
+            return np.column_stack([1.0 - p, p])
+        scores -= scores.max(axis=1, keepdims=True)  # multinomial softmax
+        np.exp(scores, out=scores)
+        scores /= scores.sum(axis=1, keepdims=True)
+        return scores
+
+    def predict(self, texts):
+        scores = self.decision_function(texts)
+        idx = (scores[:, 0] > 0).astype(int) if scores.shape[1] == 1 else scores.argmax(axis=1)
+        return [self.classes_[i] for i in idx]
+
+
+@lru_cache(maxsize=None)
+def load_model(path: str = MODEL_PATH):
+    # cached: every importer shares one model (load_model.cache_clear() to reload).
+    # The numpy export skips the ~0.7s sklearn import that unpickling the pipeline costs.
+    if np is not None:
+        model = LinearIntentModel.load(path)
+        if model is not None:
+            return model
+    try:
+        return joblib.load(path)
+    except Exception:
+        return None
+
+
+def extract_brightness(text: str) -> Optional[int]:
+    v2 = loose = None
+    for m in BRIGHTNESS_RE.finditer(text):
+        kind = m.lastgroup
+        if kind == "v1":
+            return max(0, min(100, int(m.group("v1"))))  # highest priority: done
+        if kind == "v2":
+            if v2 is None:
+                v2 = int(m.group("v2"))
+        elif loose is None:
+            loose = int(m.group("loose"))
+    if v2 is not None:
+        return max(0, min(100, v2))
+    if loose is not None and 0 <= loose <= 100:
+        return loose
+    return None
+
+
+# first non-blank byte is printable ASCII other than "{": cannot be a JSON object, reject
+# without running a parser (anything else, e.g. a UTF-8 lead byte, takes the normal path)
+_NOT_OBJECT_RE = re.compile(rb"\s*[\x21-\x7a\x7c-\x7e]")
+
+
+def parse_incoming_json(payload_bytes: bytes) -> Dict[str, Any]:
+    obj = None
+    if orjson is not None:
+        try:
+            obj = orjson.loads(payload_bytes)  # straight from bytes, no decode/strip copy
+        except Exception:
+            obj = None  # e.g. invalid UTF-8: retry below with the lenient decode
+    if obj is None:
+        if _NOT_OBJECT_RE.match(payload_bytes):
+            raise ValueError("VOICE JSON must be an object")
+        s = payload_bytes.decode("utf-8", errors="replace").strip()
+        try:
+            obj = json.loads(s)
+        except Exception:
+            raise ValueError("VOICE payload must be JSON")
+    if not isinstance(obj, dict):
+        raise ValueError("VOICE JSON must be an object")
+    return obj
+
+
+def json_bytes(obj: Any) -> Union[bytes, str]:
+    # orjson returns UTF-8 bytes (non-ASCII kept as-is, like ensure_ascii=False); paho publishes either
+    if orjson is not None:
+        try:
+            return orjson.dumps(obj)
+        except TypeError:
+            pass
+    return json.dumps(obj, ensure_ascii=False)
+
+
+class BaseMqttBridge:
+    """paho client setup, publish/reply and the blocking run loop; subclasses add on_connect / on_message."""
+
+    reply_qos = 1  # subclasses whose replies are informational only can drop to 0 (no PUBACK round-trip)
+    reconnect_max_delay = 5  # seconds; paho's backoff otherwise doubles up to 120 s while commands are missed
+
+    def __init__(self, host: str, port: int, keepalive: int,
+                 username: Optional[str] = None, password: Optional[str] = None):
+        self.host = host
+        self.port = port
+        self.keepalive = keepalive
+
+        # Compatibility: paho-mqtt 2.x has CallbackAPIVersion, older doesn't
+        try:
+            self.client = mqtt.Client(mqtt.CallbackAPIVersion.VERSION2)
+        except Exception:
+            self.client = mqtt.Client()
+
+        if username:
+            self.client.username_pw_set(username, password)
+        self.client.reconnect_delay_set(min_delay=1, max_delay=self.reconnect_max_delay)
+
+        self.client.on_connect = self.on_connect
+        self.client.on_message = self.on_message
+
+    def on_connect(self, client, userdata, flags, reason_code, properties=None):
+        raise NotImplementedError
+
+    def on_message(self, client, userdata, msg):
+        raise NotImplementedError
+
+    def publish(self, topic: str, payload: Union[str, bytes], qos: int = 1, retain: bool = False):
+        if log.isEnabledFor(logging.DEBUG):  # no decode / record per publish unless asked for
+            shown = payload.decode("utf-8", errors="replace") if isinstance(payload, bytes) else payload
+            log.debug("[PUB] topic=%s qos=%s payload=%s", topic, qos, shown)
+        self.client.publish(topic, payload, qos=qos, retain=retain)
+
+    def reply(self, topic: str, obj: Dict[str, Any]):
+        self.publish(topic, json_bytes(obj), qos=self.reply_qos, retain=False)
+
+    def run(self):
+        self.client.connect(self.host, self.port, self.keepalive)
+        self.client.loop_forever()
@@ -0,0 +1,44 @@
+# async_log.py
+# ------------------------------------------------------------
+# Shared by iot_mapper.py / mqtt_topic_mysql_bridge.py / publish_batcher.py / _common.py / text2cmd.py
+#
+# Log calls on the MQTT threads only put the record on a queue; one
+# listener thread does the %-formatting and the console write, so the
+# network / worker threads never block on stdout.
+# ------------------------------------------------------------
+
+import atexit
+import logging
+import queue
+import sys
+from logging.handlers import QueueHandler, QueueListener
+from typing import Optional
+
+ROOT_NAME = "voice"
+LOG_FORMAT = "%(message)s"  # same console output as the old print() lines
+
+_listener: Optional[QueueListener] = None
+
+
+class _DeferredQueueHandler(QueueHandler):
+    # stock QueueHandler.prepare() formats the message on the calling thread;
+    # our log args are plain str/int/list values, so hand the record over as-is
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        return record
+
+
+def get_logger(name: str) -> logging.Logger:
+    global _listener
+    root = logging.getLogger(ROOT_NAME)
+    if _listener is None:
+        q: "queue.SimpleQueue[logging.LogRecord]" = queue.SimpleQueue()
+        out = logging.StreamHandler(sys.stdout)
+        out.setFormatter(logging.Formatter(LOG_FORMAT))
+        _listener = QueueListener(q, out)
+        _listener.start()
+        atexit.register(_listener.stop)  # drain queued records on exit
+
+        root.addHandler(_DeferredQueueHandler(q))
+        root.setLevel(logging.INFO)
+        root.propagate = False
+    return root.getChild(name)
@@ -24,10 +24,19 @@
 import json
 import os
 import re
-from typing import Any, Dict, Optional, List, Tuple
+import sys
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache
+from typing import Any, Callable, Dict, Optional, List, Tuple
 
 import paho.mqtt.client as mqtt
 
+from async_log import get_logger
+from publish_batcher import PublishBatcher
+
+log = get_logger("iot_mapper")
+
 # =========================
 # MQTT Broker
 # =========================
@@ -41,6 +50,11 @@ IN_TOPIC = "JJ/voice/out"
 DEFAULT_QOS = 1
 DEFAULT_RETAIN = False
 
+# handle_in runs on a worker pool so paho's network thread only enqueues.
+# Commands arriving at the same instant may finish out of order; set 1 for strict ordering.
+HANDLE_WORKERS = 4
+HANDLE_BACKLOG = 256  # max queued + running messages; on_message blocks beyond this
+
 # =========================
 # Load mapping.json
 # =========================
@@ -55,9 +69,20 @@ def load_mapping() -> Dict[str, Any]:
 
 MAPPING = load_mapping()
 ALIASES = MAPPING.get("aliases", {}) or {}
-AREA_ALIAS = (ALIASES.get("areas") or {})
-DT_ALIAS = (ALIASES.get("device_types") or {})
-ACTION_ALIAS = (ALIASES.get("actions") or {})
+
+
+def _interned(d: Dict[str, Any]) -> Dict[str, Any]:
+    # norm_* results are used as dict keys downstream (ROUTES lookups);
+    # interned strings make those probes identity compares
+    return {
+        sys.intern(k): (sys.intern(v) if isinstance(v, str) else v)
+        for k, v in d.items() if isinstance(k, str)
+    }
+
+
+AREA_ALIAS = _interned(ALIASES.get("areas") or {})
+DT_ALIAS = _interned(ALIASES.get("device_types") or {})
+ACTION_ALIAS = _interned(ALIASES.get("actions") or {})
 
 PUBLISH_CFG = (MAPPING.get("publish") or {})
 OUT_TOPIC = PUBLISH_CFG.get("iot_cmd_topic", "JJ/iot/cmd")
@@ -80,33 +105,50 @@ SCENE_NAME_TO_INDEX: Dict[str, int] = {
 }
 
 
-def infer_scene_name_from_text(text: str, area: Optional[str]) -> Optional[str]:
-    if not text:
-        return None
-    if area and area in ROUTES and "scene" in ROUTES[area]:
-        for k in ROUTES[area]["scene"].keys():
-            if isinstance(k, str) and k and k in text:
-                return k
-    for name in SCENE_NAME_TO_INDEX.keys():
-        if name in text:
-            return name
-    return None
+def _alternation(words) -> Optional["re.Pattern"]:
+    # longest first so e.g. "上課模式" wins over a shorter key it contains
+    words = sorted({w for w in words if isinstance(w, str) and w}, key=len, reverse=True)
+    return re.compile("|".join(map(re.escape, words))) if words else None
+
+
+# one regex pass per text instead of a `name in text` scan per scene name
+SCENE_NAME_ALT = _alternation(SCENE_NAME_TO_INDEX)
+AREA_SCENE_ALT: Dict[str, "re.Pattern"] = {
+    area: rx for area, r in ROUTES.items()
+    if isinstance(r, dict) and isinstance(r.get("scene"), dict)
+    for rx in [_alternation(r["scene"].keys())] if rx
+}
 
 
-def infer_scene_index_from_text(text: str) -> Optional[int]:
+def infer_scene(text: str, area: Optional[str]) -> Tuple[Optional[str], Optional[int]]:
+    """
+    Returns (scene_name, scene_index) in one pass over the text:
+      - name : area's own scene keys first, then the global SCENE_NAME_TO_INDEX names
+      - index: SCENE_NAME_TO_INDEX name, else "場景N / 模式N" numerals
+    """
     if not text:
-        return None
-    for name, idx in SCENE_NAME_TO_INDEX.items():
-        if name in text:
-            return idx
+        return None, None
+    m = SCENE_NAME_ALT.search(text) if SCENE_NAME_ALT else None
+    known = m.group(0) if m else None
+
+    name = None
+    rx = AREA_SCENE_ALT.get(area) if area else None
+    if rx:
+        am = rx.search(text)
+        name = am.group(0) if am else None
+    if name is None:
+        name = known
+
+    if known:
+        return name, SCENE_NAME_TO_INDEX[known]
     m = SCENE_NUM_RE.search(text)
     if m:
         token = m.group(1)
         if token.isdigit():
-            return int(token)
+            return name, int(token)
         if token in CN_NUM:
-            return CN_NUM[token]
-    return None
+            return name, CN_NUM[token]
+    return name, None
 
 
 # =========================
@@ -137,34 +179,56 @@ def norm_index(idx: Any) -> Optional[int]:
         return idx
     if isinstance(idx, str):
         s = idx.strip()
-        if s.isdigit():
+        # CN numeral is a single dict probe; only fall back to the digit scan on a miss
+        v = CN_NUM.get(s)
+        if v is not None:
+            return v
+        # isdecimal (not isdigit): "²" is a digit but int() rejects it
+        if s.isdecimal():
             return int(s)
-        if s in CN_NUM:
-            return CN_NUM[s]
     return None
 
 
 # =========================
 # Lookup
 # =========================
+def _flatten_routes(routes: Dict[str, Any]) -> Dict[Tuple[str, str, str], List[Dict[str, Any]]]:
+    # ROUTES[area][device_type][key] -> one (area, device_type, key) dict, built once at load;
+    # entries that are neither list nor dict are left out (same as the old KeyError)
+    flat: Dict[Tuple[str, str, str], List[Dict[str, Any]]] = {}
+    for a, by_dt in routes.items():
+        if not isinstance(by_dt, dict):
+            continue
+        for dt, by_key in by_dt.items():
+            if not isinstance(by_key, dict):
+                continue
+            for k, v in by_key.items():
+                if isinstance(v, list):
+                    flat[(sys.intern(a), sys.intern(dt), k)] = v
+                elif isinstance(v, dict):
+                    flat[(sys.intern(a), sys.intern(dt), k)] = [v]
+    return flat
+
+
+_FLAT_ROUTES = _flatten_routes(ROUTES)
+
+
 def lookup_entries(area: str, device_type: str, key: str) -> List[Dict[str, Any]]:
-    entry = ROUTES[area][device_type][key]
-    if isinstance(entry, list):
-        return entry
-    if isinstance(entry, dict):
-        return [entry]
-    raise KeyError("invalid mapping entry type")
+    return _FLAT_ROUTES[(area, device_type, key)]
 
 
 # =========================
 # Build publish messages
 # =========================
-def format_payload_template(payload: Any, ctx: Dict[str, Any]) -> str:
+def format_payload_template(payload: Any, ctx_factory: Callable[[], Dict[str, Any]]) -> str:
     if isinstance(payload, (dict, list)):
         return json.dumps(payload, ensure_ascii=False)
     s = str(payload)
+    # plain payloads (the common case) never need the ctx dict
+    if "{" not in s:
+        return s
     try:
-        return s.format(**ctx)
+        return s.format(**ctx_factory())
     except Exception:
         return s
 
@@ -179,22 +243,32 @@ def build_iot_cmd(device: str, sw: str, cmd: str, value: Optional[Any]) -> Dict[
     return out
 
 
-def build_publish_messages(entry: Dict[str, Any], fallback_cmd: str, ctx: Dict[str, Any], slots_brightness: Optional[Any]) -> Tuple[str, str]:
+@lru_cache(maxsize=2048)
+def _serialize_iot_cmd(device: str, sw: str, cmd: str, value: Optional[Any]) -> str:
+    # the same voice command always yields the same JSON; serialize it once
+    return json.dumps(build_iot_cmd(device, sw, cmd, value), ensure_ascii=False)
+
+
+def build_publish_messages(entry: Dict[str, Any], fallback_cmd: str, ctx_factory: Callable[[], Dict[str, Any]], slots_brightness: Optional[Any]) -> Tuple[str, str]:
     # direct mqtt publish entry (boards, etc.)
     if "topic" in entry:
         topic = entry["topic"]
         payload = entry.get("payload", "")
-        return topic, format_payload_template(payload, ctx)
+        return topic, format_payload_template(payload, ctx_factory)
 
     # IoT cmd entry
     device = entry["device"]
     sw = entry["switch"]
     cmd = entry.get("cmd", fallback_cmd)
 
-    # value priority: entry.value > slots_brightness (for brightness)
-    value = entry.get("value", slots_brightness)
-    out_obj = build_iot_cmd(device, sw, cmd, value)
-    return OUT_TOPIC, json.dumps(out_obj, ensure_ascii=False)
+    # value priority: entry.value > slots_brightness (for brightness);
+    # other cmds ignore it, so leave it out of the cache key
+    value = entry.get("value", slots_brightness) if cmd == "brightness" else None
+    try:
+        return OUT_TOPIC, _serialize_iot_cmd(device, sw, cmd, value)
+    except TypeError:
+        # unhashable field (list/dict in mapping.json): serialize uncached
+        return OUT_TOPIC, json.dumps(build_iot_cmd(device, sw, cmd, value), ensure_ascii=False)
 
 
 def board_topic_allowed(action: str, topic: str) -> bool:
@@ -225,41 +299,62 @@ class MapperBridge:
         self.client.on_connect = self.on_connect
         self.client.on_message = self.on_message
 
+        # on_message only enqueues; the batcher thread does the actual client.publish
+        self.publisher = PublishBatcher(self.client)
+        self.publisher.start()
+
+        self._pool = ThreadPoolExecutor(max_workers=HANDLE_WORKERS, thread_name_prefix="voice-in")
+        self._slots = threading.BoundedSemaphore(HANDLE_BACKLOG)
+
     def on_connect(self, client, userdata, flags, reason_code, properties=None):
         ok = (reason_code == 0)
-        print(f"[MQTT] connected={ok} reason_code={reason_code}")
+        log.info("[MQTT] connected=%s reason_code=%s", ok, reason_code)
         client.subscribe(IN_TOPIC, qos=QOS)
-        print(f"[SUB] {IN_TOPIC}")
-        print(f"[OUT] IoT cmd -> {OUT_TOPIC} (qos={QOS} retain={RETAIN})")
+        log.info("[SUB] %s", IN_TOPIC)
+        log.info("[OUT] IoT cmd -> %s (qos=%s retain=%s)", OUT_TOPIC, QOS, RETAIN)
 
     def publish(self, topic: str, payload: str):
-        print(f"[PUB] topic={topic} qos={QOS} payload={payload}")
-        self.client.publish(topic, payload, qos=QOS, retain=RETAIN)
+        log.info("[PUB] topic=%s qos=%s payload=%s", topic, QOS, payload)
+        self.publisher.enqueue(topic, payload, qos=QOS, retain=RETAIN)
 
     def on_message(self, client, userdata, msg):
         if msg.topic != IN_TOPIC:
             return
-        self.handle_in(msg.payload)
+        # bounded backlog: under overload the network thread waits here instead of queueing forever
+        self._slots.acquire()
+        try:
+            fut = self._pool.submit(self._handle_safe, msg.payload)
+        except Exception:
+            self._slots.release()
+            raise
+        fut.add_done_callback(lambda _f: self._slots.release())
+
+    def _handle_safe(self, payload_bytes: bytes):
+        try:
+            self.handle_in(payload_bytes)
+        except Exception as e:
+            # executor would swallow it silently otherwise
+            log.error("[ERR] handle_in failed: %s", e)
 
     def handle_in(self, payload_bytes: bytes):
         raw = payload_bytes.decode("utf-8", errors="replace").strip()
         try:
             data = json.loads(raw)
         except Exception:
-            print("[SKIP] incoming not JSON")
+            log.info("[SKIP] incoming not JSON")
             return
 
         if not isinstance(data, dict):
-            print("[SKIP] incoming JSON not object")
+            log.info("[SKIP] incoming JSON not object")
             return
 
         if data.get("ok") is False:
-            print("[SKIP] upstream ok=false")
+            log.info("[SKIP] upstream ok=false")
             return
 
         slots = data.get("slots") or {}
         if not isinstance(slots, dict):
-            print("[SKIP] slots missing/invalid")
+            log.info("[SKIP] slots missing/invalid")
             return
 
         text = data.get("text") or ""
@@ -287,9 +382,9 @@ class MapperBridge:
         # Scene inference (optional)
         scene_name = None
         if device_type == "scene":
-            scene_name = infer_scene_name_from_text(text, area)
+            scene_name, scene_index = infer_scene(text, area)
             if device_index is None:
-                device_index = infer_scene_index_from_text(text)
+                device_index = scene_index
 
  
         # ===============================
@@ -298,7 +393,7 @@ class MapperBridge:
         if device_index_raw is None and device_type in ("light", "fan", "ac", "board"):
             device_index_raw = 1
             device_index = 1
-            print("[DEFAULT] device_index -> 1")
+            log.info("[DEFAULT] device_index -> 1")
 
 
         # ===============================
@@ -314,43 +409,48 @@ class MapperBridge:
                 key = str(device_index)
 
         if missing:
-            print(f"[MISS] req_id={req_id} missing {missing} text='{text}' slots={slots}")
+            log.info("[MISS] req_id=%s missing %s text='%s' slots=%s", req_id, missing, text, slots)
             return
 
-        # ctx for payload templates
-        ctx = {
-            "cmd": action,
-            "text": text,
-            "area": area,
-            "device_type": device_type,
-            "device_index": device_index_raw if device_index_raw is not None else device_index,
-            "req_id": req_id if req_id is not None else "",
-            "user": user if user is not None else "",
-            "value": value if value is not None else ""
-        }
-
-        # lookup mapping entries
-        try:
-            entries = lookup_entries(area, device_type, key)
-            used_key = key
-        except KeyError:
-            # try named scene key
+        # ctx for payload templates: built on first use only, then shared by all entries
+        ctx: Optional[Dict[str, Any]] = None
+
+        def ctx_factory() -> Dict[str, Any]:
+            nonlocal ctx
+            if ctx is None:
+                ctx = {
+                    "cmd": action,
+                    "text": text,
+                    "area": area,
+                    "device_type": device_type,
+                    "device_index": device_index_raw if device_index_raw is not None else device_index,
+                    "req_id": req_id if req_id is not None else "",
+                    "user": user if user is not None else "",
+                    "value": value if value is not None else ""
+                }
+            return ctx
+
+        # lookup mapping entries (single dict probe; named scene key as fallback)
+        used_key = key
+        entries = _FLAT_ROUTES.get((area, device_type, key))
+        if entries is None:
             if device_type == "scene" and scene_name:
-                try:
-                    entries = lookup_entries(area, device_type, scene_name)
-                    used_key = scene_name
-                except KeyError:
-                    print(f"[NO_MAP] req_id={req_id} area={area} type={device_type} key={key}/{scene_name} text='{text}'")
+                used_key = scene_name
+                entries = _FLAT_ROUTES.get((area, device_type, scene_name))
+                if entries is None:
+                    log.info("[NO_MAP] req_id=%s area=%s type=%s key=%s/%s text='%s'",
+                             req_id, area, device_type, key, scene_name, text)
                     return
             else:
-                print(f"[NO_MAP] req_id={req_id} area={area} type={device_type} key={key} text='{text}'")
+                log.info("[NO_MAP] req_id=%s area=%s type=%s key=%s text='%s'",
+                         req_id, area, device_type, key, text)
                 return
 
         # publish each entry
         published = 0
         for i, ent in enumerate(entries, start=1):
             try:
-                topic, payload_str = build_publish_messages(ent, action, ctx, brightness)
+                topic, payload_str = build_publish_messages(ent, action, ctx_factory, brightness)
 
                 # board filter: only one of status/marquee per action
                 if device_type == "board" and "topic" in ent:
@@ -358,13 +458,14 @@ class MapperBridge:
                         continue
 
             except Exception as e:
-                print(f"[ERR] req_id={req_id} entry#{i} build failed: {e} entry={ent}")
+                log.error("[ERR] req_id=%s entry#%s build failed: %s entry=%s", req_id, i, e, ent)
                 continue
 
             self.publish(topic, payload_str)
             published += 1
 
-        print(f"[OK] req_id={req_id} published={published} area={area} type={device_type} key={used_key} action={action}")
+        log.info("[OK] req_id=%s published=%s area=%s type=%s key=%s action=%s",
+                 req_id, published, area, device_type, used_key, action)
 
     def run(self):
         self.client.connect(MQTT_HOST, MQTT_PORT, MQTT_KEEPALIVE)
@@ -372,7 +473,7 @@ class MapperBridge:
 
 
 def main():
-    print(f"[LOAD] {MAPPING_PATH}")
+    log.info("[LOAD] %s", MAPPING_PATH)
     MapperBridge().run()
 
 
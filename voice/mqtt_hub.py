@@ -0,0 +1,43 @@
+# mqtt_hub.py
+# ------------------------------------------------------------
+# text2cmd.py + tts_mp3_wamp.py on one MQTT connection
+#
+# Both bridges use the same broker. Running this instead of the two scripts
+# keeps one socket / keepalive and sends one SUBSCRIBE for all their topics.
+# TOPIC_IN (JJ/tts/cmd) goes to tts_mp3_wamp.on_message, everything else to
+# text2cmd.Bridge.
+# ------------------------------------------------------------
+
+import logging
+from typing import List, Tuple
+
+import text2cmd
+import tts_mp3_wamp as tts
+from async_log import ROOT_NAME
+
+
+class HubBridge(text2cmd.Bridge):
+    def subscriptions(self) -> List[Tuple[str, int]]:
+        return super().subscriptions() + [(tts.TOPIC_IN, 1)]
+
+    def on_message(self, client, userdata, msg):
+        if msg.topic == tts.TOPIC_IN:
+            tts.on_message(client, userdata, msg)
+            return
+        super().on_message(client, userdata, msg)
+
+
+def main():
+    if (text2cmd.MQTT_HOST, text2cmd.MQTT_PORT) != (tts.MQTT_HOST, tts.MQTT_PORT):
+        raise SystemExit("[FATAL] text2cmd / tts_mp3_wamp use different brokers: run the two scripts instead")
+    tts.check_web_dir()
+
+    print(f"VOICE_IN_TOPIC: {text2cmd.VOICE_IN_TOPIC}")
+    print(f"TTS TOPIC_IN: {tts.TOPIC_IN}")
+    if text2cmd.DEBUG_LOG:
+        logging.getLogger(ROOT_NAME).setLevel(logging.DEBUG)
+    HubBridge().run()
+
+
+if __name__ == "__main__":
+    main()
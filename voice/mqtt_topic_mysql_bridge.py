@@ -1,11 +1,35 @@
 import json
+import re
+import sys
 import time
 import threading
-from typing import Optional, Any, Dict, Tuple
+from collections import OrderedDict
+from typing import Optional, Any, Callable, Dict, NamedTuple, Tuple
 
 import paho.mqtt.client as mqtt
+import mysql.connector
 from mysql.connector import pooling
 
+from async_log import get_logger
+from publish_batcher import PublishBatcher
+
+log = get_logger("bridge")
+
+try:
+    import orjson  # 選用：有裝就用它序列化輸出 JSON（C 實作，比 json.dumps 快）
+except Exception:
+    orjson = None
+
+
+def _json_bytes(obj: Any) -> bytes:
+    """輸出 JSON 直接給 bytes（paho publish 收 bytes，不必再 encode 一次）"""
+    if orjson is not None:
+        try:
+            return orjson.dumps(obj)
+        except TypeError:  # orjson 不收的值（例如超過 64-bit 的整數）退回標準庫
+            pass
+    return json.dumps(obj, ensure_ascii=False).encode("utf-8")
+
 
 # =========================
 # 設定區：請改 MySQL 帳密
@@ -30,7 +54,12 @@ CONFIG = {
         "password": "jamesjian",    # <- 改成你的 MySQL 密碼
         "database": "mqtt_bridge",
         "pool_name": "mqtt_bridge_pool",
-        "pool_size": 5,
+        # 每條查詢執行緒長駐一條連線（見 MappingRepository），留足餘裕給重連
+        "pool_size": 8,
+        # 連線還回 pool 時不送 COM_RESET_CONNECTION（不用 session 變數/暫存表，重設沒意義）
+        "pool_reset_session": False,
+        # 注意：長駐連線閒置超過 MySQL wait_timeout 會被 server 斷掉，
+        # find_mapping 遇到斷線會自動重拿一次；wait_timeout 請保持遠大於 cache_ttl_sec
     },
     "behavior": {
         # 防迴圈 tag
@@ -51,6 +80,15 @@ CONFIG = {
     }
 }
 
+# on_message 每則都會用到的設定，先從 CONFIG 取出來放成模組層級常數
+BRIDGE_TAG_KEY = CONFIG["behavior"]["bridge_tag_key"]
+SKIP_ANY_BRIDGE_TAG = CONFIG["behavior"]["skip_any_bridge_tag"]
+BLOCK_RAW_TO_SUB = CONFIG["behavior"]["block_raw_to_subscribe_range"]
+SUB_PREFIX = CONFIG["behavior"]["subscribe_prefix"]
+LOG_UNMATCHED = CONFIG["behavior"]["log_unmatched"]
+PUB_QOS = CONFIG["mqtt"]["publish_qos"]
+RETAIN = CONFIG["mqtt"]["retain"]
+
 
 # =========================
 # 小工具：去重（避免 broker 重送）
@@ -59,15 +97,17 @@ class DedupWindow:
     def __init__(self, ttl_sec: int):
         self.ttl = ttl_sec
         self._lock = threading.Lock()
-        self._seen: Dict[Tuple[str, str], float] = {}
+        # TTL 固定 => 插入順序就是到期順序，過期的一定在最前面
+        self._seen: "OrderedDict[Tuple[str, str], float]" = OrderedDict()
 
     def seen_recently(self, topic: str, payload: str) -> bool:
-        now = time.time()
+        now = time.monotonic()  # 不受系統校時影響
         key = (topic, payload)
+        seen = self._seen
         with self._lock:
-            expired = [k for k, ts in self._seen.items() if now > ts]
-            for k in expired:
-                self._seen.pop(k, None)
+            # 只從頭部清掉已過期的，不必每則訊息掃整個 dict
+            while seen and next(iter(seen.values())) < now:
+                seen.popitem(last=False)
 
             if key in self._seen:
                 return True
@@ -79,99 +119,186 @@ class DedupWindow:
 # =========================
 # 小工具：mapping cache
 # =========================
+# out_topic / out_payload 模板變數
+_TEMPLATE_RE = re.compile(r"\{(in_topic|in_payload)\}")
+
+
+def _compile_template(text: Optional[str]) -> Callable[[str, str], str]:
+    """
+    載入規則時就決定模板要怎麼套，之後每則訊息直接呼叫：
+      - 沒有變數：固定回傳原字串
+      - 只有一種變數：一次 replace
+      - 兩種都有：一次 regex 掃描
+    """
+    s = text or ""
+    has_topic = "{in_topic}" in s
+    has_payload = "{in_payload}" in s
+    if not has_topic and not has_payload:
+        return lambda in_topic, in_payload: s
+    if not has_payload:
+        return lambda in_topic, in_payload: s.replace("{in_topic}", in_topic)
+    if not has_topic:
+        return lambda in_topic, in_payload: s.replace("{in_payload}", in_payload)
+    sub = _TEMPLATE_RE.sub
+    return lambda in_topic, in_payload: sub(
+        lambda m: in_topic if m.group(1) == "in_topic" else in_payload, s)
+
+
+class Mapping(NamedTuple):
+    """一筆 topic_payload_map 規則（固定欄位，用 tuple 取代 dict，cache 裡也直接存它）"""
+    out_topic: str
+    out_payload: str
+    out_format: str                  # RAW / JSON
+    json_payload_key: Optional[str]  # e.g. value/cmd/state
+    json_extra: Any                  # dict/None
+    json_bridge_mode: str            # TAG / NONE
+    match_mode: str                  # EXACT / ANY_PAYLOAD
+    render_topic: Callable[[str, str], str]    # (in_topic, in_payload) -> out_topic
+    render_payload: Callable[[str, str], str]  # (in_topic, in_payload) -> out_payload
+    raw_loop_prefix: Optional[str]             # RAW 且開了防自咬時 = SUB_PREFIX，否則 None
+
+# 負向快取的標記：get() 回傳 _MISS = 「已知查無 mapping」，回傳 None = 「沒快取，要查 DB」
+_MISS = object()
+
+
 class MappingCache:
     def __init__(self, ttl_sec: int):
         self.ttl = ttl_sec
+        self.neg_ttl = max(1, ttl_sec // 4)  # 查無的結果存短一點，新增規則後很快就會生效
         self._lock = threading.Lock()
-        self._cache: Dict[Tuple[str, str], Tuple[float, dict]] = {}
-
-    def get(self, in_topic: str, in_payload: str) -> Optional[dict]:
-        now = time.time()
-        key = (in_topic, in_payload)
-        with self._lock:
-            item = self._cache.get(key)
-            if not item:
-                return None
-            expire_ts, mapping = item
-            if now > expire_ts:
-                self._cache.pop(key, None)
-                return None
-            return mapping
-
-    def set(self, in_topic: str, in_payload: str, mapping: dict):
+        # 命中與查無放同一個 dict：(expire_ts, mapping 或 _MISS)
+        self._cache: Dict[Tuple[str, str], Tuple[float, Any]] = {}
+
+    def get(self, in_topic: str, in_payload: str) -> Any:
+        # 讀取不加鎖：dict.get 在 GIL 下是原子的，拿到的 tuple 也不會被改
+        item = self._cache.get((in_topic, in_payload))
+        if item is None:
+            return None
+        expire_ts, mapping = item
+        if time.time() > expire_ts:
+            # 過期不在這裡 pop（避免無鎖 pop 誤刪別的執行緒剛 set 的新值）；
+            # 呼叫端查完 DB 會 set/set_negative 直接覆蓋
+            return None
+        return mapping
+
+    def set(self, in_topic: str, in_payload: str, mapping: Mapping):
         with self._lock:
             self._cache[(in_topic, in_payload)] = (time.time() + self.ttl, mapping)
 
+    def set_negative(self, in_topic: str, in_payload: str):
+        with self._lock:
+            self._cache[(in_topic, in_payload)] = (time.time() + self.neg_ttl, _MISS)
+
 
 # =========================
 # DB Repo：支援 EXACT / ANY_PAYLOAD
 # =========================
+# 建議索引：(in_topic, match_mode, in_payload)，兩句都是純等值查詢、可直接走索引
+_MAP_COLS = """
+    SELECT out_topic, out_payload, out_format,
+           json_payload_key, json_extra, json_bridge_mode,
+           match_mode
+    FROM topic_payload_map
+"""
+SQL_EXACT = _MAP_COLS + "WHERE enabled=1 AND in_topic=%s AND match_mode='EXACT' AND in_payload=%s LIMIT 1"
+SQL_ANY = _MAP_COLS + "WHERE enabled=1 AND in_topic=%s AND match_mode='ANY_PAYLOAD' LIMIT 1"
+
+# CR_SERVER_GONE_ERROR / CR_SERVER_LOST / CR_SERVER_LOST_EXTENDED
+_CONN_LOST_ERRNOS = (2006, 2013, 2055)
+
+
+def _is_conn_lost(e: Exception) -> bool:
+    return (getattr(e, "errno", None) in _CONN_LOST_ERRNOS
+            or isinstance(e, (mysql.connector.InterfaceError, mysql.connector.OperationalError)))
+
+
 class MappingRepository:
     def __init__(self, pool: pooling.MySQLConnectionPool):
         self.pool = pool
-
-    def find_mapping(self, in_topic: str, in_payload: str) -> Optional[dict]:
+        # 每個執行緒一條長駐連線 + 兩個 prepared cursor（on_message 都在 paho 的同一條執行緒）
+        self._local = threading.local()
+
+    def _cursors(self):
+        loc = self._local
+        if getattr(loc, "conn", None) is None:
+            conn = self.pool.get_connection()
+            conn.autocommit = True  # 長駐連線：每次查詢都要看到最新的 mapping，不留在舊 snapshot
+            loc.conn = conn
+            loc.cur_exact = conn.cursor(prepared=True)
+            loc.cur_any = conn.cursor(prepared=True)
+        return loc.cur_exact, loc.cur_any
+
+    def _drop_conn(self):
+        loc = self._local
+        for name in ("cur_exact", "cur_any", "conn"):
+            try:
+                obj = getattr(loc, name, None)
+                if obj is not None:
+                    obj.close()
+            except Exception:
+                pass
+            setattr(loc, name, None)
+
+    def _query_row(self, in_topic: str, in_payload: str):
+        cur_exact, cur_any = self._cursors()
+        cur_exact.execute(SQL_EXACT, (in_topic, in_payload))
+        rows = cur_exact.fetchall()
+        if rows:
+            return rows[0]
+        cur_any.execute(SQL_ANY, (in_topic,))
+        rows = cur_any.fetchall()
+        return rows[0] if rows else None
+
+    def find_mapping(self, in_topic: str, in_payload: str) -> Optional[Mapping]:
         """
         match_mode:
           - EXACT: topic + payload 完全相同
           - ANY_PAYLOAD: 只比 topic，不管 payload
-        查詢優先序：EXACT 優先，找不到才用 ANY_PAYLOAD
+        查詢優先序：EXACT 優先，找不到才用 ANY_PAYLOAD（拆成兩句，不用 OR + ORDER BY CASE）
         """
-        conn = self.pool.get_connection()
-        try:
-            cur = conn.cursor()
-            cur.execute(
-                """
-                SELECT out_topic, out_payload, out_format,
-                       json_payload_key, json_extra, json_bridge_mode,
-                       match_mode
-                FROM topic_payload_map
-                WHERE enabled=1
-                  AND in_topic=%s
-                  AND (
-                        (match_mode='EXACT' AND in_payload=%s)
-                     OR (match_mode='ANY_PAYLOAD')
-                  )
-                ORDER BY CASE WHEN match_mode='EXACT' THEN 0 ELSE 1 END
-                LIMIT 1
-                """,
-                (in_topic, in_payload),
-            )
-            row = cur.fetchone()
-            if not row:
-                return None
-
-            (out_topic, out_payload, out_format,
-             json_payload_key, json_extra, json_bridge_mode,
-             match_mode) = row
-
-            # mysql-connector 可能把 JSON 欄位回傳成 str 或 dict
-            extra_obj: Optional[Any] = None
-            if json_extra is None:
-                extra_obj = None
-            elif isinstance(json_extra, (dict, list)):
-                extra_obj = json_extra
-            else:
-                try:
-                    extra_obj = json.loads(str(json_extra))
-                except Exception:
-                    extra_obj = None
-
-            return {
-                "out_topic": out_topic,
-                "out_payload": out_payload,
-                "out_format": (out_format or "RAW").upper(),          # RAW / JSON
-                "json_payload_key": json_payload_key,                # e.g. value/cmd/state
-                "json_extra": extra_obj,                             # dict/None
-                "json_bridge_mode": (json_bridge_mode or "TAG").upper(),  # TAG / NONE
-                "match_mode": (match_mode or "EXACT").upper(),       # EXACT / ANY_PAYLOAD
-            }
-        finally:
+        for attempt in (0, 1):
+            try:
+                row = self._query_row(in_topic, in_payload)
+                break
+            except mysql.connector.Error as e:
+                # 出錯的連線一律丟掉（下次重拿）；只有斷線才馬上再試一次，SQL 本身的錯誤直接往上丟
+                self._drop_conn()
+                if attempt or not _is_conn_lost(e):
+                    raise
+        if not row:
+            return None
+
+        (out_topic, out_payload, out_format,
+         json_payload_key, json_extra, json_bridge_mode,
+         match_mode) = row
+
+        # mysql-connector 可能把 JSON 欄位回傳成 str 或 dict
+        extra_obj: Optional[Any] = None
+        if isinstance(json_extra, (bytes, bytearray)):  # prepared cursor 可能回 bytes
+            json_extra = json_extra.decode("utf-8", "replace")
+        if json_extra is None:
+            extra_obj = None
+        elif isinstance(json_extra, (dict, list)):
+            extra_obj = json_extra
+        else:
             try:
-                cur.close()
+                extra_obj = json.loads(str(json_extra))
             except Exception:
-                pass
-            conn.close()
+                extra_obj = None
+
+        fmt = (out_format or "RAW").upper()
+        return Mapping(
+            out_topic=out_topic,
+            out_payload=out_payload,
+            out_format=fmt,
+            json_payload_key=json_payload_key,
+            json_extra=extra_obj,
+            json_bridge_mode=(json_bridge_mode or "TAG").upper(),
+            match_mode=(match_mode or "EXACT").upper(),
+            render_topic=_compile_template(out_topic),
+            render_payload=_compile_template(out_payload),
+            raw_loop_prefix=SUB_PREFIX if (BLOCK_RAW_TO_SUB and fmt == "RAW") else None,
+        )
 
 
 # =========================
@@ -195,24 +322,38 @@ class MqttBridge:
         self.client.on_message = self.on_message
         self.client.on_disconnect = self.on_disconnect
 
+        # 發佈交給 batcher 執行緒：on_message 只排入佇列，成敗由 _on_published 印 log
+        self.publisher = PublishBatcher(self.client, on_result=self._on_published)
+
+        # bridge tag 的 bytes 形式：on_message 先用它快篩，不必每則都 json.loads
+        self._tag_bytes = BRIDGE_TAG_KEY.encode("utf-8")
+
+        # __bridge__ 裡固定不變的部分先序列化好：'"tag_key":' 與 '{"id":"<client_id>"'
+        self._tag_key_fragment = _json_bytes(BRIDGE_TAG_KEY) + b":"
+        self._bridge_id_fragment = _json_bytes({"id": CONFIG["mqtt"]["client_id"]})[:-1]
+
     def start(self):
         mcfg = CONFIG["mqtt"]
+        self.publisher.start()
         self.client.connect(mcfg["host"], mcfg["port"], keepalive=60)
         self.client.loop_forever(retry_first_connection=True)
 
     def on_connect(self, client, userdata, flags, rc):
-        print(f"[MQTT] Connected rc={rc}")
+        log.info("[MQTT] Connected rc=%s", rc)
         if rc != 0:
             return
         for t, qos in CONFIG["mqtt"]["subscribe_topics"]:
             client.subscribe(t, qos=qos)
-            print(f"[MQTT] Subscribed: {t} qos={qos}")
+            log.info("[MQTT] Subscribed: %s qos=%s", t, qos)
 
     def on_disconnect(self, client, userdata, rc):
-        print(f"[MQTT] Disconnected rc={rc}")
+        log.info("[MQTT] Disconnected rc=%s", rc)
 
     @staticmethod
     def normalize_payload(payload_bytes: bytes) -> str:
+        # 不改用 decode("utf-8", "surrogateescape")：解出的 lone surrogate 拿去當 MySQL 參數、
+        # print 或 JSON encode 都會丟 UnicodeEncodeError；latin-1 退路永遠得到合法字串。
+        # 正常 UTF-8 訊息走 try 成功路徑，沒有額外成本（py3.11+ 的 try 是 zero-cost）。
         try:
             return payload_bytes.decode("utf-8")
         except UnicodeDecodeError:
@@ -220,13 +361,19 @@ class MqttBridge:
 
     def is_bridge_payload(self, payload_str: str) -> bool:
         """只要 payload 是 JSON 且含 __bridge__ 就視為 bridge 訊息"""
-        tag_key = CONFIG["behavior"]["bridge_tag_key"]
+        tag_key = BRIDGE_TAG_KEY
         try:
             obj = json.loads(payload_str)
         except Exception:
             return False
         return isinstance(obj, dict) and (tag_key in obj)
 
+    def is_bridge_payload_bytes(self, payload_bytes: bytes) -> bool:
+        """原始 bytes 裡連 tag 字樣都沒有（絕大多數訊息）就直接 False，不解碼也不 parse"""
+        if payload_bytes.find(self._tag_bytes) < 0:
+            return False
+        return self.is_bridge_payload(self.normalize_payload(payload_bytes))
+
     def build_out_json(
         self,
         in_topic: str,
@@ -235,14 +382,14 @@ class MqttBridge:
         json_payload_key: Optional[str],
         json_extra: Optional[Any],
         json_bridge_mode: str,
-    ) -> str:
+    ) -> bytes:
         """
         JSON 結構：
           - 主要值放在 json_payload_key（預設 payload）
           - json_extra (dict) 會 merge 進去
           - json_bridge_mode='TAG' 才會加 __bridge__
         """
-        tag_key = CONFIG["behavior"]["bridge_tag_key"]
+        tag_key = BRIDGE_TAG_KEY
         payload_key = (json_payload_key or "payload").strip() or "payload"
 
         out_obj: Dict[str, Any] = {payload_key: out_payload}
@@ -250,71 +397,66 @@ class MqttBridge:
         if isinstance(json_extra, dict):
             out_obj.update(json_extra)
 
-        if json_bridge_mode == "TAG":
-            out_obj[tag_key] = {
-                "id": CONFIG["mqtt"]["client_id"],
-                "ts": int(time.time()),
-                "src_topic": in_topic,
-                "src_payload": in_payload,
-            }
-
-        return json.dumps(out_obj, ensure_ascii=False)
-
-    @staticmethod
-    def apply_templates(text: Optional[str], in_topic: str, in_payload: str) -> str:
-        """
-        支援 out_payload/out_topic 的模板：
-          - {in_topic}
-          - {in_payload}
-        """
-        s = text or ""
-        return s.replace("{in_topic}", in_topic).replace("{in_payload}", in_payload)
+        if json_bridge_mode != "TAG":
+            return _json_bytes(out_obj)
+
+        # TAG：只序列化會變的 ts/src_*，接在預先做好的 id 片段後面，再接到主體的最後一個 } 前
+        out_obj.pop(tag_key, None)  # json_extra 若也帶同名 key，以 bridge tag 為準（同舊行為）
+        body = _json_bytes(out_obj)
+        return b"".join((
+            body[:-1], b"," if out_obj else b"", self._tag_key_fragment,
+            self._bridge_id_fragment,
+            b',"ts":', str(int(time.time())).encode("ascii"),
+            b',"src_topic":', _json_bytes(in_topic),
+            b',"src_payload":', _json_bytes(in_payload),
+            b"}}",
+        ))
 
     def on_message(self, client, userdata, msg):
-        in_topic = msg.topic
-        in_payload = self.normalize_payload(msg.payload)
+        # msg.topic 每次存取都會重新 decode；取一次並 intern，後面 dedup/cache 的 key 比對較快
+        in_topic = sys.intern(msg.topic)
 
-        # 防迴圈：收到帶 __bridge__ 的訊息直接忽略
-        if CONFIG["behavior"]["skip_any_bridge_tag"] and self.is_bridge_payload(in_payload):
+        # 防迴圈：收到帶 __bridge__ 的訊息直接忽略（先在 bytes 上快篩）
+        if SKIP_ANY_BRIDGE_TAG and self.is_bridge_payload_bytes(msg.payload):
             return
 
+        in_payload = self.normalize_payload(msg.payload)
+
         # 去重（避免短時間重送）
         if self.dedup.seen_recently(in_topic, in_payload):
             return
 
         # 查 mapping（cache -> DB）
         mapping = self.cache.get(in_topic, in_payload)
-        if not mapping:
+        if mapping is None:
             mapping = self.repo.find_mapping(in_topic, in_payload)
-            if mapping:
+            if mapping is not None:
                 self.cache.set(in_topic, in_payload, mapping)
+            else:
+                # 萬用字元訂閱下大量沒規則的雜訊 topic：記住查無，短時間內不再打 DB
+                self.cache.set_negative(in_topic, in_payload)
 
-        if not mapping:
-            if CONFIG["behavior"]["log_unmatched"]:
-                print(f"[MISS] {in_topic} -> {in_payload}")
+        if mapping is None or mapping is _MISS:
+            if LOG_UNMATCHED:
+                log.info("[MISS] %s -> %s", in_topic, in_payload)
             return
 
         # 取出規則
-        out_topic = mapping["out_topic"]
-        out_payload = mapping["out_payload"]
-        out_format = mapping["out_format"]
-        json_payload_key = mapping["json_payload_key"]
-        json_extra = mapping["json_extra"]
-        json_bridge_mode = mapping["json_bridge_mode"]
+        out_format = mapping.out_format
+        json_payload_key = mapping.json_payload_key
+        json_extra = mapping.json_extra
+        json_bridge_mode = mapping.json_bridge_mode
 
         # 支援 out_topic / out_payload 使用模板
-        out_topic = self.apply_templates(out_topic, in_topic, in_payload)
-        out_payload = self.apply_templates(out_payload, in_topic, in_payload)
-
-        # RAW 發佈到 JJ/ 範圍，可能自咬（因為沒 tag）
-        if (
-            out_format == "RAW"
-            and CONFIG["behavior"]["block_raw_to_subscribe_range"]
-            and out_topic.startswith(CONFIG["behavior"]["subscribe_prefix"])
-        ):
-            print(f"[BLOCK] RAW publish to JJ/: out_topic='{out_topic}'. "
-                  f"Use out_format='JSON' with json_bridge_mode='TAG', or change out_topic, "
-                  f"or narrow subscribe range.")
+        out_topic = mapping.render_topic(in_topic, in_payload)
+        out_payload = mapping.render_payload(in_topic, in_payload)
+
+        # RAW 發佈到 JJ/ 範圍，可能自咬（因為沒 tag）；RAW/開關兩個條件載入規則時已合併
+        loop_prefix = mapping.raw_loop_prefix
+        if loop_prefix is not None and out_topic.startswith(loop_prefix):
+            log.warning("[BLOCK] RAW publish to JJ/: out_topic='%s'. "
+                        "Use out_format='JSON' with json_bridge_mode='TAG', or change out_topic, "
+                        "or narrow subscribe range.", out_topic)
             return
 
         # 組 payload
@@ -331,14 +473,16 @@ class MqttBridge:
             payload_to_send = out_payload
 
         # 發佈
-        qos = CONFIG["mqtt"]["publish_qos"]
-        retain = CONFIG["mqtt"]["retain"]
-        res = client.publish(out_topic, payload_to_send, qos=qos, retain=retain)
+        self.publisher.enqueue(out_topic, payload_to_send, qos=PUB_QOS, retain=RETAIN,
+                               meta=(in_topic, in_payload, out_format))
 
+    @staticmethod
+    def _on_published(res, out_topic: str, payload: Any, meta: Tuple[str, str, str]):
+        in_topic, in_payload, out_format = meta
         if res.rc == mqtt.MQTT_ERR_SUCCESS:
-            print(f"[OK] ({in_topic}='{in_payload}') -> ({out_topic} format={out_format})")
+            log.info("[OK] (%s='%s') -> (%s format=%s)", in_topic, in_payload, out_topic, out_format)
         else:
-            print(f"[ERR] publish rc={res.rc} ({out_topic})")
+            log.error("[ERR] publish rc=%s (%s)", res.rc, out_topic)
 
 
 if __name__ == "__main__":
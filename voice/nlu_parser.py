@@ -12,13 +12,33 @@
 # ------------------------------------------------------------
 
 import json
+import logging
 import os
+import queue
 import re
+import threading
+import time
 from dataclasses import dataclass
+from functools import lru_cache
 from typing import Optional, Dict, Any, Tuple, List
 
-import joblib
-import paho.mqtt.client as mqtt
+try:
+    import ahocorasick  # optional: pyahocorasick, one C-level pass for synonym scanning
+except Exception:
+    ahocorasick = None
+
+try:
+    import numpy as np
+    import onnxruntime as ort  # optional: run the exported intent_clf.onnx instead of sklearn
+except Exception:
+    np = None
+    ort = None
+
+from async_log import get_logger
+from _common import (
+    BaseMqttBridge, CN_NUM, MODEL_PATH,
+    _alternation, extract_brightness, load_model, parse_incoming_json,
+)
 
 MQTT_HOST = "broker.emqx.io"
 MQTT_PORT = 1883
@@ -29,25 +49,35 @@ MQTT_PASSWORD = None
 VOICE_IN_TOPIC = "JJ/voice/in"
 DEFAULT_REPLY_TOPIC = "JJ/voice/out"
 
-DEFAULT_QOS = 1
-DEFAULT_RETAIN = False
+MAX_INFLIGHT = 1000  # QoS1 replies awaiting PUBACK before paho starts holding them back (default 20)
+DEBUG_PUB = False    # log every outgoing reply ([PUB] ..., DEBUG level)
 
-MODEL_PATH = "intent_clf.joblib"
+ONNX_MODEL_PATH = "intent_clf.onnx"  # written by train.py when skl2onnx is installed
 ALLOWED_ACTIONS = {
     "toggle", "turn_on", "turn_off", "set_brightness", "query_state",
     "board_marquee", "board_status"
 }
 ACTION_CONF_THRESHOLD = 0.55
 
+# voice messages are collected for up to BATCH_WINDOW_MS (or BATCH_MAX items)
+# and classified with one model call
+BATCH_MAX = 32
+BATCH_WINDOW_MS = 10
+
 
-def load_model(path: str):
+def load_onnx_session(path: str):
+    if ort is None or not os.path.exists(path):
+        return None
     try:
-        return joblib.load(path)
+        return ort.InferenceSession(path, providers=["CPUExecutionProvider"])
     except Exception:
         return None
 
 
-MODEL = load_model(MODEL_PATH)
+SESSION = load_onnx_session(ONNX_MODEL_PATH)
+SESSION_INPUT = SESSION.get_inputs()[0].name if SESSION is not None else None
+# the ONNX session replaces the sklearn pipeline; only unpickle it as the fallback
+MODEL = None if SESSION is not None else load_model(MODEL_PATH)
 
 BASE = os.path.dirname(os.path.abspath(__file__))
 SLOTS_PATH = os.path.join(BASE, "slots.json")
@@ -66,26 +96,6 @@ SCENE_NAME_ACTIONS = SLOTS.get("scene_name_actions", {}) or {}
 
 print("[SLOTS] loaded from:", SLOTS_PATH)
 
-CN_NUM = {
-    "一": 1, "二": 2, "三": 3, "四": 4, "五": 5, "六": 6,
-    "1": 1, "2": 2, "3": 3, "4": 4, "5": 5, "6": 6
-}
-
-# "所有/全部/全..." -> all
-ALL_RE = re.compile(r"(全部|所有|全(部)?)(?:的)?", re.IGNORECASE)
-
-INDEX_NEAR_DEVICE_RE = re.compile(
-    r"(?:第\s*)?([一二三四五六123456])\s*(?:盞|號|个|個|台|臺)?\s*"
-    r"(燈|電燈|燈光|LED|led|風扇|電扇|冷氣|空調|aircon|ac|布告欄|電子布告欄|公布欄|看板|公告欄|board)",
-    re.IGNORECASE
-)
-
-INDEX_LED_RE = re.compile(r"(?:LED|led|s)\s*([1-6])", re.IGNORECASE)
-INDEX_LOOSE_RE = re.compile(r"(?:第\s*)?([一二三四五六123456])\s*(?:盞|號|个|個|台|臺)", re.IGNORECASE)
-
-SCENE_INDEX_RE = re.compile(r"(?:場景|情境|模式|scene|mode)\s*([一二三四五六123456])", re.IGNORECASE)
-BOARD_INDEX_RE = re.compile(r"(?:電子布告欄|布告欄|公布欄|看板|公告欄|board)\s*([一二三四五六123456])", re.IGNORECASE)
-
 SCENE_NAME_TO_INDEX: Dict[str, int] = {
     "上課模式": 1,
     "下課模式": 2,
@@ -93,11 +103,37 @@ SCENE_NAME_TO_INDEX: Dict[str, int] = {
     "休息模式": 4,
     "展示模式": 5
 }
-
-BRIGHTNESS_PATTERNS = [
-    re.compile(r"(?:亮度|明亮|brightness)\s*(?:到|調到|調整到|設為|為)?\s*(\d{1,3})\s*%?"),
-    re.compile(r"(?:調亮|調暗|變亮|變暗)\s*(\d{1,3})\s*%?")
-]
+_SCENE_NAME_RANK = {name: i for i, name in enumerate(SCENE_NAME_TO_INDEX)}
+
+# Slot patterns stay on stdlib re: utterances are a few dozen chars and the patterns are
+# bounded, so google-re2's per-call overhead made every search slower here, and its ASCII-only
+# \d / \s would stop matching full-width digits and the ideographic space (U+3000).
+# All device-index forms in one pattern, alternatives listed in priority order:
+#   all   "辦公室所有的燈 / 全部燈 / 全開"
+#   name  named scene modes (上課模式 ...)
+#   scene "場景2"        board "布告欄1"
+#   near  "第二個燈 / 第一個布告欄"
+#   led   "LED3 / s3"    loose "第二個"
+# Each alternative sits inside a lookahead, so finditer tests every position in C without
+# consuming text: the first hit of every kind is seen, as with one .search() per pattern.
+_IDX = "[一二三四五六123456]"
+DEVICE_INDEX_RE = re.compile(
+    "(?=(?:"
+    r"(?P<all>全部|所有|全)"
+    "|(?P<name>" + "|".join(map(re.escape, SCENE_NAME_TO_INDEX)) + ")"
+    r"|(?:場景|情境|模式|scene|mode)\s*(?P<scene>" + _IDX + ")"
+    r"|(?:電子布告欄|布告欄|公布欄|看板|公告欄|board)\s*(?P<board>" + _IDX + ")"
+    r"|(?:第\s*)?(?P<near>" + _IDX + r")\s*(?:盞|號|个|個|台|臺)?\s*"
+    r"(?:燈|電燈|燈光|led|風扇|電扇|冷氣|空調|aircon|ac|布告欄|電子布告欄|公布欄|看板|公告欄|board)"
+    r"|(?:led|s)\s*(?P<led>[1-6])"
+    r"|(?:第\s*)?(?P<loose>" + _IDX + r")\s*(?:盞|號|个|個|台|臺)"
+    "))",
+    re.IGNORECASE
+)
+_INDEX_PRIORITY = ("scene", "board", "near", "led", "loose")
+# every alternative needs 全/所, an index digit or a scene name: text without any of these
+# characters (most plain commands, "開燈") can skip the scan
+_INDEX_TRIGGER = frozenset("全所一二三四五六123456") | {name[0] for name in SCENE_NAME_TO_INDEX}
 
 BOARD_TEXT_RE = re.compile(
     r"(?:跑馬燈|滾動顯示|滾動|顯示|公告|寫|marquee)\s*[:：]?\s*(.+)$",
@@ -109,49 +145,72 @@ BOARD_STATUS_RE = re.compile(
     re.IGNORECASE
 )
 
+_TRAIL_PUNCT_RE = re.compile(r"[。！!？?]+$")  # trailing sentence punctuation on board values
 
-def extract_brightness(text: str) -> Optional[int]:
-    t = text.strip()
-    for pat in BRIGHTNESS_PATTERNS:
-        m = pat.search(t)
-        if m:
-            try:
-                v = int(m.group(1))
-                return max(0, min(100, v))
-            except Exception:
-                return None
-    m2 = re.search(r"(?:到|調到|設到|設為)\s*(\d{1,3})\s*%?", t)
-    if m2:
-        v = int(m2.group(1))
-        if 0 <= v <= 100:
-            return v
-    return None
 
+def _has_any(rx: Optional["re.Pattern"], text: str) -> bool:
+    return rx is not None and rx.search(text) is not None
 
-def extract_area(text: str) -> Optional[str]:
-    t = text.strip()
-    candidates: List[Tuple[str, str]] = []
-    for canonical, syns in AREA_SYNONYMS.items():
+
+# run_nlu device-type fallbacks
+_SCENE_HINT_RE = _alternation(["場景", "情境", "模式", "scene", "mode"])
+_BOARD_HINT_RE = _alternation(["電子布告欄", "布告欄", "公布欄", "看板", "公告欄", "跑馬燈", "board", "marquee"])
+
+# guard_action keyword sets
+_GUARD_RE: Dict[str, Optional["re.Pattern"]] = {
+    a: _alternation(ACTION_GUARD.get(a) or [])
+    for a in ("board_status", "board_marquee", "toggle", "set_brightness", "query_state")
+}
+_OFF_WORDS_RE = _alternation(["關閉", "關掉", "關燈", "OFF", "off", "全關"])
+_ON_WORDS_RE = _alternation(["打開", "開啟", "開燈", "ON", "on", "全開"])
+
+
+def _build_synonym_automaton(synonyms: Dict[str, List[str]]):
+    """
+    value = (len, -rank, canonical): max() over the matches picks the longest synonym,
+    ties going to the one listed first in slots.json (same as the sorted-candidates loop)
+    """
+    if ahocorasick is None:
+        return None
+    ac = ahocorasick.Automaton()
+    rank = 0
+    for canonical, syns in synonyms.items():
         for s in syns:
-            if s and s in t:
-                candidates.append((canonical, s))
-    if not candidates:
+            if s and not ac.exists(s):  # duplicate synonym: first canonical keeps it
+                ac.add_word(s, (len(s), -rank, canonical))
+            rank += 1
+    if len(ac) == 0:
         return None
-    candidates.sort(key=lambda x: len(x[1]), reverse=True)
-    return candidates[0][0]
+    ac.make_automaton()
+    return ac
 
 
-def extract_device_type(text: str) -> Optional[str]:
-    t = text.strip()
-    candidates: List[Tuple[str, str]] = []
-    for canonical, syns in DEVICE_TYPE_SYNONYMS.items():
+AREA_AC = _build_synonym_automaton(AREA_SYNONYMS)
+DEVTYPE_AC = _build_synonym_automaton(DEVICE_TYPE_SYNONYMS)
+
+
+def _longest_synonym(t: str, ac, synonyms: Dict[str, List[str]]) -> Optional[str]:
+    if ac is not None:
+        best = max((v for _end, v in ac.iter(t)), default=None)
+        return best[2] if best else None
+
+    # fallback without pyahocorasick: one pass keeping the longest hit (strict >, so ties
+    # go to the synonym listed first); shorter synonyms skip the substring test entirely
+    best: Optional[str] = None
+    best_len = 0
+    for canonical, syns in synonyms.items():
         for s in syns:
-            if s and s in t:
-                candidates.append((canonical, s))
-    if not candidates:
-        return None
-    candidates.sort(key=lambda x: len(x[1]), reverse=True)
-    return candidates[0][0]
+            if len(s) > best_len and s in t:
+                best, best_len = canonical, len(s)
+    return best
+
+
+def extract_area(text: str) -> Optional[str]:
+    return _longest_synonym(text, AREA_AC, AREA_SYNONYMS)
+
+
+def extract_device_type(text: str) -> Optional[str]:
+    return _longest_synonym(text, DEVTYPE_AC, DEVICE_TYPE_SYNONYMS)
 
 
 def extract_scene_index_by_name(text: str) -> Optional[int]:
@@ -162,114 +221,128 @@ def extract_scene_index_by_name(text: str) -> Optional[int]:
 
 
 def extract_device_index(text: str) -> Optional[Any]:
-    t = text.strip()
-
-    # 0) ALL scope first: "辦公室所有的燈 / 全部燈 / 全開"
-    if ALL_RE.search(t):
-        return "all"
-
-    # 1) named scene modes -> index
-    idx_named = extract_scene_index_by_name(t)
-    if idx_named is not None:
-        return idx_named
-
-    # 2) scene index
-    m = SCENE_INDEX_RE.search(t)
-    if m:
-        return CN_NUM.get(m.group(1))
-
-    # 3) board index
-    m = BOARD_INDEX_RE.search(t)
-    if m:
-        return CN_NUM.get(m.group(1))
-
-    # 4) "第二個燈/第一個布告欄"
-    m = INDEX_NEAR_DEVICE_RE.search(t)
-    if m:
-        return CN_NUM.get(m.group(1))
-
-    # 5) LED3 / s3
-    m = INDEX_LED_RE.search(t)
-    if m:
-        try:
-            return int(m.group(1))
-        except Exception:
-            pass
-
-    # 6) loose number
-    m = INDEX_LOOSE_RE.search(t)
-    if m:
-        return CN_NUM.get(m.group(1))
-
+    if _INDEX_TRIGGER.isdisjoint(text):
+        return None
+    first: Dict[str, str] = {}
+    name: Optional[str] = None
+    for m in DEVICE_INDEX_RE.finditer(text):
+        kind = m.lastgroup
+        if kind == "all":
+            return "all"  # ALL scope beats everything
+        v = m.group(kind)
+        if kind == "name":
+            # several names: the first one in SCENE_NAME_TO_INDEX wins
+            if name is None or _SCENE_NAME_RANK[v] < _SCENE_NAME_RANK[name]:
+                name = v
+        elif kind not in first:
+            first[kind] = v
+
+    if name is not None:
+        return SCENE_NAME_TO_INDEX[name]
+    for kind in _INDEX_PRIORITY:
+        v = first.get(kind)
+        if v is not None:
+            return CN_NUM.get(v)  # CN_NUM covers 一..六 and 1..6: one dict probe, no int()
     return None
 
 
-def extract_board_value(text: str, action: str) -> Optional[str]:
-    t = text.strip()
+def extract_board_value(t: str, action: str) -> Optional[str]:
     m = BOARD_STATUS_RE.search(t) if action == "board_status" else BOARD_TEXT_RE.search(t)
     if not m:
         return None
     s = m.group(1).strip()
-    s = re.sub(r"[。！!？?]+$", "", s).strip()
+    s = _TRAIL_PUNCT_RE.sub("", s).strip()
     return s if s else None
 
 
-def guard_action(text: str) -> Optional[str]:
-    t = text.strip()
-
+def guard_action(t: str) -> Optional[str]:
     # board actions priority
-    if any(k in t for k in (ACTION_GUARD.get("board_status") or [])):
+    if _has_any(_GUARD_RE["board_status"], t):
         return "board_status"
-    if any(k in t for k in (ACTION_GUARD.get("board_marquee") or [])):
+    if _has_any(_GUARD_RE["board_marquee"], t):
         return "board_marquee"
 
     # toggle
-    if any(k in t for k in (ACTION_GUARD.get("toggle") or [])):
+    if _has_any(_GUARD_RE["toggle"], t):
         return "toggle"
 
     # brightness
-    if any(k in t for k in (ACTION_GUARD.get("set_brightness") or [])) or extract_brightness(t) is not None:
+    if _has_any(_GUARD_RE["set_brightness"], t) or extract_brightness(t) is not None:
         return "set_brightness"
 
     # off before on
-    if any(k in t for k in ["關閉", "關掉", "關燈", "OFF", "off", "全關"]):
+    if _OFF_WORDS_RE.search(t):
         return "turn_off"
     if "關" in t and "開關" not in t:
         return "turn_off"
 
-    if any(k in t for k in ["打開", "開啟", "開燈", "ON", "on", "全開"]):
+    if _ON_WORDS_RE.search(t):
         return "turn_on"
     if "開" in t and "關" not in t:
         return "turn_on"
 
-    if any(k in t for k in (ACTION_GUARD.get("query_state") or [])):
+    if _has_any(_GUARD_RE["query_state"], t):
         return "query_state"
 
     return None
 
 
-def _model_predict_with_confidence(text: str) -> Tuple[Optional[str], Optional[float]]:
-    if MODEL is None:
-        return None, None
+def _model_predict_many(texts: List[str]) -> List[Tuple[Optional[str], Optional[float]]]:
+    # one inference pass yields both label and confidence (label = argmax of proba) for every text
+    if SESSION is not None:
+        try:
+            labels, probas = SESSION.run(None, {SESSION_INPUT: np.array(texts, dtype=object)})[:2]
+            raw = [(str(l), float(np.max(p))) for l, p in zip(labels, probas)]
+        except Exception:
+            return [(None, None)] * len(texts)
+    elif MODEL is not None:
+        try:
+            raw = []
+            for proba in MODEL.predict_proba(texts):
+                i = max(range(len(proba)), key=proba.__getitem__)
+                raw.append((str(MODEL.classes_[i]), float(proba[i])))
+        except Exception:
+            # classifier without predict_proba
+            try:
+                raw = [(str(l), None) for l in MODEL.predict(texts)]
+            except Exception:
+                return [(None, None)] * len(texts)
+    else:
+        return [(None, None)] * len(texts)
 
-    try:
-        pred = MODEL.predict([text])[0]
-    except Exception:
-        return None, None
+    return [(pred, conf) if pred in ALLOWED_ACTIONS else (None, None) for pred, conf in raw]
 
-    if pred not in ALLOWED_ACTIONS:
-        return None, None
 
-    try:
-        proba = MODEL.predict_proba([text])[0]
-        return pred, float(max(proba))
-    except Exception:
-        return pred, None
+# predictions computed ahead by run_nlu_batch; only touched from the NLU worker thread
+_PREDICTED: Dict[str, Tuple[Optional[str], Optional[float]]] = {}
+
+
+@lru_cache(maxsize=2048)
+def _cached_model(text: str) -> Tuple[Optional[str], Optional[float]]:
+    # device commands are formulaic: repeated utterances cost a dict lookup instead of an inference
+    return _model_predict_many([text])[0]
 
 
-def predict_action(text: str) -> Tuple[str, Optional[str], Optional[float], bool]:
-    t = text.strip()
+def _model_predict_with_confidence(text: str) -> Tuple[Optional[str], Optional[float]]:
+    hit = _PREDICTED.get(text)
+    if hit is not None:
+        return hit
+    # the TF-IDF step lowercases its input anyway, so case variants share one entry
+    return _cached_model(text.lower())
+
+
+def reload_model() -> None:
+    """Reload the ONNX session / joblib pipeline from disk and drop every cached prediction."""
+    global SESSION, SESSION_INPUT, MODEL
+    load_model.cache_clear()
+    SESSION = load_onnx_session(ONNX_MODEL_PATH)
+    SESSION_INPUT = SESSION.get_inputs()[0].name if SESSION is not None else None
+    MODEL = None if SESSION is not None else load_model(MODEL_PATH)
+    _cached_model.cache_clear()
+    _run_nlu_text.cache_clear()
 
+
+def predict_action(t: str) -> Tuple[str, Optional[str], Optional[float], bool]:
     g = guard_action(t)
     if g in ALLOWED_ACTIONS:
         mp, mc = _model_predict_with_confidence(t)
@@ -303,19 +376,8 @@ class ParsedNLU:
     notes: List[str]
 
 
-def parse_incoming_json(payload_bytes: bytes) -> Dict[str, Any]:
-    s = payload_bytes.decode("utf-8", errors="replace").strip()
-    try:
-        obj = json.loads(s)
-    except Exception:
-        raise ValueError("VOICE payload must be JSON")
-    if not isinstance(obj, dict):
-        raise ValueError("VOICE JSON must be an object")
-    return obj
-
-
 def run_nlu(obj: Dict[str, Any]) -> ParsedNLU:
-    text = str(obj.get("text", "")).strip()
+    text = str(obj.get("text", "")).strip()  # the only strip: every extractor below takes it as-is
     if not text:
         raise ValueError("missing 'text' in JSON")
 
@@ -323,6 +385,50 @@ def run_nlu(obj: Dict[str, Any]) -> ParsedNLU:
     req_id = obj.get("req_id")
     user = obj.get("user")
 
+    slots_items, model_pred, model_conf, used_guard, notes = _run_nlu_text(text)
+
+    return ParsedNLU(
+        text=text,
+        reply_to=reply_to,
+        req_id=str(req_id) if req_id is not None else None,
+        user=str(user) if user is not None else None,
+        slots=dict(slots_items),  # fresh copies: callers may mutate them
+        model_pred=model_pred,
+        model_conf=model_conf,
+        used_guard=used_guard,
+        notes=list(notes),
+    )
+
+
+def run_nlu_batch(objs: List[Dict[str, Any]]) -> List[Any]:
+    """
+    run_nlu over a batch with one vectorized model call for all distinct texts.
+    Returns ParsedNLU or the raised Exception per input, in input order.
+    """
+    texts = {str(o.get("text", "")).strip() for o in objs}
+    texts.discard("")
+    if len(texts) > 1 and (SESSION is not None or MODEL is not None):
+        batch = list(texts)
+        _PREDICTED.update(zip(batch, _model_predict_many(batch)))
+    try:
+        out: List[Any] = []
+        for obj in objs:
+            try:
+                out.append(run_nlu(obj))
+            except Exception as e:
+                out.append(e)
+        return out
+    finally:
+        _PREDICTED.clear()
+
+
+@lru_cache(maxsize=512)
+def _run_nlu_text(text: str) -> Tuple[Tuple[Tuple[str, Any], ...], Optional[str], Optional[float], bool, Tuple[str, ...]]:
+    """
+    Pure text -> slots part of run_nlu (regex + synonyms + model), cached per stripped text
+    so repeated utterances (retries, wake-word repeats) skip the model entirely.
+    Returns immutable values: (slots items, model_pred, model_conf, used_guard, notes).
+    """
     notes: List[str] = []
 
     area = extract_area(text)
@@ -332,10 +438,10 @@ def run_nlu(obj: Dict[str, Any]) -> ParsedNLU:
     device_type = extract_device_type(text)
 
     if device_type is None:
-        if any(k in text for k in ["場景", "情境", "模式", "scene", "mode"]):
+        if _SCENE_HINT_RE.search(text):
             device_type = "scene"
             notes.append("device_type_forced_scene")
-        elif any(k in text for k in ["電子布告欄", "布告欄", "公布欄", "看板", "公告欄", "跑馬燈", "board", "marquee"]):
+        elif _BOARD_HINT_RE.search(text):
             device_type = "board"
             notes.append("device_type_forced_board")
 
@@ -391,53 +497,66 @@ def run_nlu(obj: Dict[str, Any]) -> ParsedNLU:
     if value is not None:
         slots["value"] = value
 
-    return ParsedNLU(
-        text=text,
-        reply_to=reply_to,
-        req_id=str(req_id) if req_id is not None else None,
-        user=str(user) if user is not None else None,
-        slots=slots,
-        model_pred=model_pred,
-        model_conf=model_conf,
-        used_guard=used_guard,
-        notes=notes,
-    )
+    return tuple(slots.items()), model_pred, model_conf, used_guard, tuple(notes)
 
 
-class NLUBridge:
+class NLUBridge(BaseMqttBridge):
     def __init__(self):
-        try:
-            self.client = mqtt.Client(mqtt.CallbackAPIVersion.VERSION2)
-        except Exception:
-            self.client = mqtt.Client()
+        super().__init__(MQTT_HOST, MQTT_PORT, MQTT_KEEPALIVE, MQTT_USERNAME, MQTT_PASSWORD)
+        self.client.max_inflight_messages_set(MAX_INFLIGHT)
+        self.client.max_queued_messages_set(0)  # 0 = unbounded local queue
 
-        if MQTT_USERNAME:
-            self.client.username_pw_set(MQTT_USERNAME, MQTT_PASSWORD)
-
-        self.client.on_connect = self.on_connect
-        self.client.on_message = self.on_message
+        # on_message only enqueues; the batch worker runs NLU and publishes replies
+        self._inbox: "queue.SimpleQueue[bytes]" = queue.SimpleQueue()
+        threading.Thread(target=self._batch_loop, name="nlu-batch", daemon=True).start()
 
     def on_connect(self, client, userdata, flags, reason_code, properties=None):
         ok = (reason_code == 0)
         print(f"[MQTT] connected={ok} reason_code={reason_code}")
         client.subscribe(VOICE_IN_TOPIC, qos=1)
 
-    def publish(self, topic: str, payload: str, qos: int = DEFAULT_QOS, retain: bool = DEFAULT_RETAIN):
-        print(f"[PUB] topic={topic} qos={qos} payload={payload}")
-        self.client.publish(topic, payload, qos=qos, retain=retain)
-
-    def reply(self, topic: str, obj: Dict[str, Any]):
-        self.publish(topic, json.dumps(obj, ensure_ascii=False), qos=1, retain=False)
-
     def on_message(self, client, userdata, msg):
         if msg.topic != VOICE_IN_TOPIC:
             return
-        self.handle_voice(msg.payload)
+        self._inbox.put(msg.payload)
+
+    def _batch_loop(self):
+        while True:
+            batch = [self._inbox.get()]
+            deadline = time.monotonic() + BATCH_WINDOW_MS / 1000.0
+            while len(batch) < BATCH_MAX:
+                wait = deadline - time.monotonic()
+                if wait <= 0:
+                    break
+                try:
+                    batch.append(self._inbox.get(timeout=wait))
+                except queue.Empty:
+                    break
+            try:
+                self.handle_voice_batch(batch)
+            except Exception as e:
+                print(f"[ERR] voice batch failed: {e}")
 
     def handle_voice(self, payload_bytes: bytes):
+        self.handle_voice_batch([payload_bytes])
+
+    def handle_voice_batch(self, payloads: List[bytes]):
+        # replies go out in arrival order; bad JSON keeps its slot as an error
+        objs: List[Any] = []
+        for p in payloads:
+            try:
+                objs.append(parse_incoming_json(p))
+            except Exception as e:
+                objs.append(e)
+        results = iter(run_nlu_batch([o for o in objs if not isinstance(o, Exception)]))
+        for o in objs:
+            self._reply_result(o if isinstance(o, Exception) else next(results))
+
+    def _reply_result(self, result: Any):
         try:
-            obj = parse_incoming_json(payload_bytes)
-            parsed = run_nlu(obj)
+            if isinstance(result, Exception):
+                raise result
+            parsed = result
 
             print(f"[IN] {parsed.text}")
             print(f"[SLOTS] {parsed.slots} notes={parsed.notes}")
@@ -460,19 +579,19 @@ class NLUBridge:
         except Exception as e:
             self.reply(DEFAULT_REPLY_TOPIC, {"ok": False, "error": str(e)})
 
-    def run(self):
-        self.client.connect(MQTT_HOST, MQTT_PORT, MQTT_KEEPALIVE)
-        self.client.loop_forever()
-
 
 def main():
-    if MODEL is None:
+    if SESSION is not None:
+        print("[OK] 已載入 intent_clf.onnx（onnxruntime，action=模型+護欄）。")
+    elif MODEL is None:
         print("[WARN] 找不到 intent_clf.joblib，action 主要依賴規則護欄（仍可用）。")
     else:
         print("[OK] 已載入 intent_clf.joblib（action=模型+護欄）。")
 
     print(f"VOICE_IN_TOPIC: {VOICE_IN_TOPIC}")
     print(f"DEFAULT_REPLY_TOPIC: {DEFAULT_REPLY_TOPIC}")
+    if DEBUG_PUB:
+        get_logger("mqtt").setLevel(logging.DEBUG)
     NLUBridge().run()
 
 
@@ -0,0 +1,68 @@
+# publish_batcher.py
+# ------------------------------------------------------------
+# Shared by iot_mapper.py / mqtt_topic_mysql_bridge.py
+#
+# MQTT callbacks only enqueue, so on_message returns immediately; one
+# worker thread drains the queue and calls client.publish() once per
+# message. The worker only blocks while the queue is empty; once woken
+# it publishes everything already queued in one pass, without waiting.
+# ------------------------------------------------------------
+
+import queue
+import threading
+from typing import Any, Callable, Optional
+
+from async_log import get_logger
+
+log = get_logger("publish")
+
+QUEUE_MAX = 10000  # publishes waiting for the worker; new ones are dropped (and counted) beyond this
+
+
+class PublishBatcher:
+    def __init__(self, client, on_result: Optional[Callable[[Any, str, Any, Any], None]] = None,
+                 maxlen: int = QUEUE_MAX):
+        self.client = client
+        self.on_result = on_result  # (publish result, topic, payload, meta), called on the worker thread
+        self.maxlen = maxlen
+        self.dropped = 0
+        self._q: "queue.Queue[tuple]" = queue.Queue(maxsize=maxlen)
+        self._thread: Optional[threading.Thread] = None
+
+    def start(self):
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._run, name="mqtt-publish", daemon=True)
+            self._thread.start()
+
+    def enqueue(self, topic: str, payload: Any, qos: int = 0, retain: bool = False, meta: Any = None):
+        try:
+            self._q.put_nowait((topic, payload, qos, retain, meta))
+        except queue.Full:
+            self.dropped += 1
+            log.warning("[DROP] publish queue full (%s), dropped=%s topic=%s", self.maxlen, self.dropped, topic)
+
+    def _run(self):
+        q = self._q
+        while True:
+            # block only when idle; anything queued meanwhile goes out in the same pass
+            self._publish(q.get())
+            self.flush()
+
+    def flush(self):
+        q = self._q
+        while True:
+            try:
+                item = q.get_nowait()
+            except queue.Empty:
+                break
+            self._publish(item)
+
+    def _publish(self, item):
+        topic, payload, qos, retain, meta = item
+        try:
+            res = self.client.publish(topic, payload, qos=qos, retain=retain)
+        except Exception as e:
+            log.error("[ERR] publish %s failed: %s", topic, e)
+            return
+        if self.on_result is not None:
+            self.on_result(res, topic, payload, meta)
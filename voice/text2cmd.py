@@ -20,15 +20,24 @@
 # Reply (JSON) to reply_to (default JJ/voice/out) includes parse + cmd info.
 # ------------------------------------------------------------
 import time
-import hashlib
 
 import json
+import logging
+import queue
 import re
+import threading
+from collections import OrderedDict
 from dataclasses import dataclass
-from typing import Optional, Dict, Any, Tuple
+from functools import lru_cache
+from typing import Optional, Dict, Any, List, Tuple
 
-import joblib
-import paho.mqtt.client as mqtt
+from async_log import ROOT_NAME, get_logger
+from _common import (
+    BaseMqttBridge, CN_NUM, MODEL_PATH,
+    _alternation, extract_brightness, load_model, parse_incoming_json,
+)
+
+log = get_logger("text2cmd")
 
 # =========================
 # MQTT Broker
@@ -41,6 +50,11 @@ MQTT_PASSWORD = None
 
 DEFAULT_QOS = 1
 DEFAULT_RETAIN = False
+REPLY_QOS = 0  # replies are status echoes (the device command itself stays DEFAULT_QOS)
+MAX_INFLIGHT = 100  # QoS1 device commands awaiting PUBACK before paho holds them back (default 20)
+VOICE_QUEUE_MAX = 1024  # voice commands waiting for the worker; new ones are dropped beyond this
+BATCH_MAX = 32  # the worker takes up to this many already-queued commands per model call (no extra wait)
+DEBUG_LOG = False  # per-message [PUB]/[STATE]/[IN]/[MODEL]/[PARSE]/[CMD]/[DEDUPE] lines (DEBUG level)
 
 # =========================
 # MQTT Topics (INPUT/REPLY)
@@ -87,18 +101,11 @@ DEFAULT_DEVICE_KEY = "DEV_A"
 # =========================
 # Intent Model (5 intents)
 # =========================
-MODEL_PATH = "intent_clf.joblib"
 ALLOWED_INTENTS = {"toggle", "turn_on", "turn_off", "set_brightness", "query_state"}
 
 # Model confidence threshold (if predict_proba exists)
 INTENT_CONF_THRESHOLD = 0.65
 
-def load_model(path: str):
-    try:
-        return joblib.load(path)
-    except Exception:
-        return None
-
 MODEL = load_model(MODEL_PATH)
 
 # =========================
@@ -123,7 +130,13 @@ def build_payload(intent: str, channel: int, brightness: Optional[int]) -> str:
 
 def format_out_payload(cmd: str, device_cfg: dict) -> str:
     # Always JSON in this version
-    key = device_cfg.get("json_key") or "payload"
+    return _out_payload_json(cmd, device_cfg.get("json_key") or "payload")
+
+@lru_cache(maxsize=1024)
+def _out_payload_json(cmd: str, key: str) -> str:
+    # only a few hundred distinct (cmd, key) pairs exist (s1..s4 x on/off/toggle/bri_0..100),
+    # so each device payload is serialized once; json.dumps keeps the exact bytes devices expect.
+    # cmd_topic stays a str: paho 2.x calls topic.encode() itself and rejects pre-encoded bytes.
     obj = {key: cmd}
     if BRIDGE_SRC_TAG:
         obj["src"] = BRIDGE_SRC_TAG
@@ -132,8 +145,8 @@ def format_out_payload(cmd: str, device_cfg: dict) -> str:
 # =========================
 # Slot Extraction
 # =========================
-CN_NUM = {"一": 1, "二": 2, "三": 3, "四": 4, "1": 1, "2": 2, "3": 3, "4": 4}
-
+# (stdlib re on purpose, see nlu_parser.py: re2 is slower on short utterances and its
+# ASCII-only \d / \s miss full-width digits and U+3000)
 # Detect device phrase (supports: 第二裝置 / 第二個裝置 / 二號裝置 / 裝置二 / 第2裝置 / 設備二 ...)
 DEVICE_PHRASE_RE = re.compile(
     r"(第?\s*(一|二|1|2)\s*(?:號|个|個)?\s*(?:台|臺)?\s*(?:裝置|設備|device))|"
@@ -141,15 +154,15 @@ DEVICE_PHRASE_RE = re.compile(
     re.IGNORECASE
 )
 
-# Brightness patterns
-BRIGHTNESS_PATTERNS = [
-    re.compile(r"(?:亮度|明亮|brightness)\s*(?:到|調到|調整到|設為|為)?\s*(\d{1,3})\s*%?"),
-    re.compile(r"(?:調亮|調暗|變亮|變暗)\s*(\d{1,3})\s*%?"),
-]
-
-def detect_device_key(text: str) -> str:
-    t = text.strip()
+# Channel patterns (extract_channel), compiled once instead of on every call
+CHANNEL_NEAR_LIGHT_RE = re.compile(
+    r"(?:第\s*)?([一二三四1234])\s*(?:盞|號|个|個)\s*(?:燈|led)",
+    re.IGNORECASE
+)
+CHANNEL_LED_RE = re.compile(r"(?:led|s)\s*([1234])", re.IGNORECASE)
+CHANNEL_LOOSE_RE = re.compile(r"(?:第\s*)?([一二三四1234])\s*(?:盞|號|个|個)?", re.IGNORECASE)
 
+def detect_device_key(t: str) -> str:
     # 1) strong device phrase match first
     m = DEVICE_PHRASE_RE.search(t)
     if m:
@@ -168,50 +181,23 @@ def detect_device_key(text: str) -> str:
 
     return DEFAULT_DEVICE_KEY
 
-def extract_brightness(text: str) -> Optional[int]:
-    t = text.strip()
-    for pat in BRIGHTNESS_PATTERNS:
-        m = pat.search(t)
-        if m:
-            try:
-                v = int(m.group(1))
-                return max(0, min(100, v))
-            except Exception:
-                return None
-
-    # also support "調到 80"
-    m2 = re.search(r"(?:到|調到|設到|設為)\s*(\d{1,3})\s*%?", t)
-    if m2:
-        v = int(m2.group(1))
-        if 0 <= v <= 100:
-            return v
-    return None
-
-def extract_channel(text: str) -> int:
-    t = text.strip()
-
+def extract_channel(t: str) -> int:
     # IMPORTANT: remove device phrase first (avoid "第二裝置" -> channel=2)
     t_wo_device = DEVICE_PHRASE_RE.sub(" ", t)
 
     # 1) prefer patterns near 灯/LED
-    pat_near_light = re.compile(
-        r"(?:第\s*)?([一二三四1234])\s*(?:盞|號|个|個)\s*(?:燈|led|LED)",
-        re.IGNORECASE
-    )
-    m = pat_near_light.search(t_wo_device)
+    m = CHANNEL_NEAR_LIGHT_RE.search(t_wo_device)
     if m:
         s = m.group(1)
         return CN_NUM.get(s, 1)
 
     # 2) LED3 / s3
-    pat_led = re.compile(r"(?:LED|led|s)\s*([1234])", re.IGNORECASE)
-    m = pat_led.search(t_wo_device)
+    m = CHANNEL_LED_RE.search(t_wo_device)
     if m:
         return int(m.group(1))
 
     # 3) fallback (loose) but AFTER removing device phrase
-    pat_loose = re.compile(r"(?:第\s*)?([一二三四1234])\s*(?:盞|號|个|個)?", re.IGNORECASE)
-    m = pat_loose.search(t_wo_device)
+    m = CHANNEL_LOOSE_RE.search(t_wo_device)
     if m:
         s = m.group(1)
         return CN_NUM.get(s, 1)
@@ -221,64 +207,95 @@ def extract_channel(text: str) -> int:
 # =========================
 # Intent Prediction: model + hard guard + confidence fallback
 # =========================
-def rule_intent(text: str) -> Optional[str]:
-    t = text.strip()
-
+# rule_intent keyword sets, one compiled search each
+_TOGGLE_RE = _alternation(["切換", "切一下", "toggle", "翻轉"])
+_BRIGHTNESS_WORDS_RE = _alternation(["亮度", "明亮", "brightness", "調亮", "調暗", "變亮", "變暗"])
+_OFF_WORDS_RE = _alternation(["關閉", "關掉", "關燈", "OFF", "off"])
+_ON_WORDS_RE = _alternation(["打開", "開啟", "開燈", "ON", "on"])
+_QUERY_WORDS_RE = _alternation(["狀態", "是開的嗎", "有開嗎", "開了沒"])
+
+def rule_intent(t: str) -> Optional[str]:
     # toggle first
-    if any(x in t for x in ["切換", "切一下", "toggle", "翻轉"]):
+    if _TOGGLE_RE.search(t):
         return "toggle"
 
     # brightness
-    if any(x in t for x in ["亮度", "明亮", "brightness", "調亮", "調暗", "變亮", "變暗"]) or extract_brightness(t) is not None:
+    if _BRIGHTNESS_WORDS_RE.search(t) or extract_brightness(t) is not None:
         return "set_brightness"
 
     # turn_off MUST be before turn_on
-    if any(x in t for x in ["關閉", "關掉", "關燈", "OFF", "off"]):
+    if _OFF_WORDS_RE.search(t):
         return "turn_off"
     if "關" in t and "開關" not in t:
         return "turn_off"
 
     # turn_on strong words
-    if any(x in t for x in ["打開", "開啟", "開燈", "ON", "on"]):
+    if _ON_WORDS_RE.search(t):
         return "turn_on"
     # single char "開" last, and must not include "關"
     if "開" in t and "關" not in t:
         return "turn_on"
 
     # query
-    if any(x in t for x in ["狀態", "是開的嗎", "有開嗎", "開了沒"]):
+    if _QUERY_WORDS_RE.search(t):
         return "query_state"
 
     return None
 
-def _model_predict_with_confidence(text: str) -> Tuple[Optional[str], Optional[float]]:
+def _model_predict_many(texts: List[str]) -> List[Tuple[Optional[str], Optional[float]]]:
+    # one inference pass yields both label and confidence (label = argmax of proba) for the whole list
     if MODEL is None:
-        return None, None
-
-    try:
-        pred = MODEL.predict([text])[0]
-    except Exception:
-        return None, None
-
-    if pred not in ALLOWED_INTENTS:
-        return None, None
+        return [(None, None)] * len(texts)
 
     # If model supports predict_proba
     try:
-        proba = MODEL.predict_proba([text])[0]
-        conf = float(max(proba))
-        return pred, conf
+        raw = []
+        for proba in MODEL.predict_proba(texts):
+            i = max(range(len(proba)), key=proba.__getitem__)
+            raw.append((MODEL.classes_[i], float(proba[i])))
     except Exception:
         # No probability available
-        return pred, None
+        try:
+            raw = [(pred, None) for pred in MODEL.predict(texts)]
+        except Exception:
+            return [(None, None)] * len(texts)
+
+    return [(pred, conf) if pred in ALLOWED_INTENTS else (None, None) for pred, conf in raw]
 
-def predict_intent(text: str) -> Tuple[str, Optional[str], Optional[float]]:
+# predictions computed ahead by prefetch_predictions; only touched from the voice worker thread
+_PREDICTED: Dict[str, Tuple[Optional[str], Optional[float]]] = {}
+
+@lru_cache(maxsize=2048)
+def _cached_model(text: str) -> Tuple[Optional[str], Optional[float]]:
+    # device commands are formulaic: repeated utterances cost a dict lookup instead of an inference
+    return _model_predict_many([text])[0]
+
+def _model_predict_with_confidence(text: str) -> Tuple[Optional[str], Optional[float]]:
+    # the TF-IDF step lowercases its input anyway, so case variants share one entry
+    key = text.lower()
+    hit = _PREDICTED.get(key)
+    if hit is not None:
+        return hit
+    return _cached_model(key)
+
+def prefetch_predictions(texts: List[str]) -> None:
+    """Predict every distinct text in one model call; the next lookups are served from _PREDICTED."""
+    keys = list({t.lower() for t in texts if t})
+    if len(keys) > 1 and MODEL is not None:
+        _PREDICTED.update(zip(keys, _model_predict_many(keys)))
+
+def reload_model() -> None:
+    """Reload the joblib pipeline from disk and drop every cached prediction."""
+    global MODEL
+    load_model.cache_clear()
+    MODEL = load_model(MODEL_PATH)
+    _cached_model.cache_clear()
+
+def predict_intent(t: str) -> Tuple[str, Optional[str], Optional[float]]:
     """
     Returns: (intent, model_pred, model_conf)
     intent is the final decision.
     """
-    t = text.strip()
-
     # A) hard guard
     guard = rule_intent(t)
     if guard in ALLOWED_INTENTS:
@@ -320,18 +337,8 @@ class ParsedCommand:
     model_pred: Optional[str]
     model_conf: Optional[float]
 
-def parse_incoming_json(payload_bytes: bytes) -> Dict[str, Any]:
-    s = payload_bytes.decode("utf-8", errors="replace").strip()
-    try:
-        obj = json.loads(s)
-    except Exception:
-        raise ValueError("VOICE payload must be JSON")
-    if not isinstance(obj, dict):
-        raise ValueError("VOICE JSON must be an object")
-    return obj
-
 def parse_command(obj: Dict[str, Any]) -> ParsedCommand:
-    text = str(obj.get("text", "")).strip()
+    text = str(obj.get("text", "")).strip()  # the only strip: every extractor below takes it as-is
     if not text:
         raise ValueError("missing 'text' in JSON")
 
@@ -368,67 +375,109 @@ def parse_command(obj: Dict[str, Any]) -> ParsedCommand:
 # =========================
 # MQTT Bridge (compat old/new paho-mqtt)
 # =========================
-class Bridge:
-    def __init__(self):
-        # Compatibility: paho-mqtt 2.x has CallbackAPIVersion, older doesn't
-        try:
-            self.client = mqtt.Client(mqtt.CallbackAPIVersion.VERSION2)
-        except Exception:
-            self.client = mqtt.Client()
-
-        if MQTT_USERNAME:
-            self.client.username_pw_set(MQTT_USERNAME, MQTT_PASSWORD)
+class Bridge(BaseMqttBridge):
+    reply_qos = REPLY_QOS
 
-        self.client.on_connect = self.on_connect
-        self.client.on_message = self.on_message
+    def __init__(self):
+        super().__init__(MQTT_HOST, MQTT_PORT, MQTT_KEEPALIVE, MQTT_USERNAME, MQTT_PASSWORD)
+        self.client.max_inflight_messages_set(MAX_INFLIGHT)
+        self.client.max_queued_messages_set(0)  # 0 = unbounded local queue
 
         
-        self.recent_cmd = {}   # key -> last_ts
+        self.recent_cmd: "OrderedDict[Tuple[str, str], float]" = OrderedDict()   # (device_id, cmd) -> last_ts, oldest first
         self.dedupe_window_sec = 3.0
 
 
-        self.last_states: Dict[str, str] = {}
+        # raw payload per state topic (bounded: only the DEVICES state topics are subscribed);
+        # decoded when a query_state reply needs it, not on every state message
+        self.last_states: Dict[str, bytes] = {}
         self.connected = False
 
+        # on_message only enqueues; one worker parses and actuates, so commands keep their arrival
+        # order and the dedupe window is never touched concurrently
+        self._inbox: "queue.Queue[bytes]" = queue.Queue(maxsize=VOICE_QUEUE_MAX)
+        self.dropped = 0
+        threading.Thread(target=self._voice_loop, name="voice-worker", daemon=True).start()
+
     def on_connect(self, client, userdata, flags, reason_code, properties=None):
         # Some old versions use different callback signature; accept properties=None
         self.connected = (reason_code == 0)
-        print(f"[MQTT] connected={self.connected} reason_code={reason_code}")
-        client.subscribe(VOICE_IN_TOPIC, qos=1)
+        log.info("[MQTT] connected=%s reason_code=%s", self.connected, reason_code)
+        client.subscribe(self.subscriptions())  # one SUBSCRIBE packet for every topic
+
+    def subscriptions(self) -> List[Tuple[str, int]]:
+        subs = [(VOICE_IN_TOPIC, 1)]
         for _, cfg in DEVICES.items():
             st = cfg.get("state_topic")
             if st:
-                client.subscribe(st, qos=1)
-
-    def publish(self, topic: str, payload: str, qos: int = DEFAULT_QOS, retain: bool = DEFAULT_RETAIN):
-        print(f"[PUB] topic={topic} qos={qos} payload={payload}")
-        self.client.publish(topic, payload, qos=qos, retain=retain)
-
-    def reply(self, topic: str, obj: Dict[str, Any]):
-        self.publish(topic, json.dumps(obj, ensure_ascii=False), qos=1, retain=False)
+                subs.append((st, 1))
+        return subs
 
     def on_message(self, client, userdata, msg):
         if msg.topic == VOICE_IN_TOPIC:
-            self.handle_voice(msg.payload)
+            try:
+                self._inbox.put_nowait(msg.payload)
+            except queue.Full:
+                self.dropped += 1
+                log.warning("[DROP] voice queue full (%s), dropped=%s", VOICE_QUEUE_MAX, self.dropped)
             return
 
-        payload = msg.payload.decode("utf-8", errors="replace")
-        self.last_states[msg.topic] = payload
-        print(f"[STATE] {msg.topic} -> {payload}")
+        if self.last_states.get(msg.topic) == msg.payload:
+            return  # re-retained / repeated state: nothing changed
+        self.last_states[msg.topic] = msg.payload
+        if log.isEnabledFor(logging.DEBUG):
+            log.debug("[STATE] %s -> %s", msg.topic, msg.payload.decode("utf-8", errors="replace"))
+
+    def _voice_loop(self):
+        while True:
+            # block for one command, then take whatever else is already waiting: an idle
+            # bridge answers immediately, a backlog is drained BATCH_MAX at a time
+            batch = [self._inbox.get()]
+            while len(batch) < BATCH_MAX:
+                try:
+                    batch.append(self._inbox.get_nowait())
+                except queue.Empty:
+                    break
+            try:
+                self.handle_voice_batch(batch)
+            except Exception as e:
+                log.error("[ERR] voice worker: %s", e)
 
     def handle_voice(self, payload_bytes: bytes):
+        self.handle_voice_batch([payload_bytes])
+
+    def handle_voice_batch(self, payloads: List[bytes]):
+        # parse everything first so the model sees all texts of the batch in one call;
+        # the commands themselves still run one by one, in arrival order (dedupe depends on it)
+        objs: List[Any] = []
+        for payload_bytes in payloads:
+            try:
+                objs.append(parse_incoming_json(payload_bytes))
+            except Exception as e:
+                objs.append(e)
+        prefetch_predictions([str(o.get("text", "")).strip() for o in objs if isinstance(o, dict)])
+        try:
+            for obj in objs:
+                self._handle_obj(obj)
+        finally:
+            _PREDICTED.clear()
+
+    def _handle_obj(self, obj: Any):
         try:
-            obj = parse_incoming_json(payload_bytes)
+            if isinstance(obj, Exception):
+                raise obj
             parsed = parse_command(obj)
 
             device_cfg = DEVICES[parsed.device_key]
 
-            print(f"[IN] {parsed.text}")
-            if parsed.model_conf is not None:
-                print(f"[MODEL] pred={parsed.model_pred} conf={parsed.model_conf:.3f}")
-            else:
-                print(f"[MODEL] pred={parsed.model_pred} conf=None")
-            print(f"[PARSE] intent={parsed.intent} device={parsed.device_id} ch={parsed.channel} bri={parsed.brightness}")
+            if log.isEnabledFor(logging.DEBUG):
+                log.debug("[IN] %s", parsed.text)
+                if parsed.model_conf is not None:
+                    log.debug("[MODEL] pred=%s conf=%.3f", parsed.model_pred, parsed.model_conf)
+                else:
+                    log.debug("[MODEL] pred=%s conf=None", parsed.model_pred)
+                log.debug("[PARSE] intent=%s device=%s ch=%s bri=%s",
+                          parsed.intent, parsed.device_id, parsed.channel, parsed.brightness)
 
             base_reply = {
                 "ok": True,
@@ -447,6 +496,8 @@ class Bridge:
             if parsed.intent == "query_state":
                 st = device_cfg.get("state_topic")
                 last = self.last_states.get(st) if st else None
+                if last is not None:
+                    last = last.decode("utf-8", errors="replace")
                 base_reply.update({
                     "type": "query_state",
                     "state_topic": st,
@@ -471,13 +522,17 @@ class Bridge:
             out_payload = format_out_payload(cmd, device_cfg)
 
             # --- dedupe: same (device_id + cmd) within window -> ignore ---
-            key_raw = f"{parsed.device_id}|{cmd}"
-            key = hashlib.md5(key_raw.encode("utf-8")).hexdigest()
-            now = time.time()
+            key = (parsed.device_id, cmd)
+            now = time.monotonic()
+
+            # expired entries sit at the head: drop them so the dict only holds the current window
+            recent = self.recent_cmd
+            while recent and (now - next(iter(recent.values()))) >= self.dedupe_window_sec:
+                recent.popitem(last=False)
 
-            last = self.recent_cmd.get(key)
+            last = recent.get(key)
             if last is not None and (now - last) < self.dedupe_window_sec:
-                print(f"[DEDUPE] ignore duplicate cmd within {self.dedupe_window_sec}s: {key_raw}")
+                log.debug("[DEDUPE] ignore duplicate cmd within %ss: %s|%s", self.dedupe_window_sec, parsed.device_id, cmd)
                 base_reply.update({
                     "type": "deduped",
                     "cmd": cmd,
@@ -487,9 +542,10 @@ class Bridge:
                 self.reply(parsed.reply_to, base_reply)
                 return
 
-            self.recent_cmd[key] = now
+            recent[key] = now
+            recent.move_to_end(key)
 
-            print(f"[CMD] topic={device_cfg['cmd_topic']} cmd={cmd} out_format=JSON")
+            log.debug("[CMD] topic=%s cmd=%s out_format=JSON", device_cfg["cmd_topic"], cmd)
             self.publish(device_cfg["cmd_topic"], out_payload, qos=DEFAULT_QOS, retain=DEFAULT_RETAIN)
 
             base_reply.update({
@@ -503,10 +559,6 @@ class Bridge:
         except Exception as e:
             self.reply(DEFAULT_REPLY_TOPIC, {"ok": False, "error": str(e)})
 
-    def run(self):
-        self.client.connect(MQTT_HOST, MQTT_PORT, MQTT_KEEPALIVE)
-        self.client.loop_forever()
-
 def main():
     if MODEL is None:
         print("[提示] 找不到 intent_clf.joblib，將使用規則護欄（仍可用，但模型效果會更好）。")
@@ -515,6 +567,8 @@ def main():
 
     print(f"VOICE_IN_TOPIC: {VOICE_IN_TOPIC}")
     print(f"DEFAULT_REPLY_TOPIC: {DEFAULT_REPLY_TOPIC}")
+    if DEBUG_LOG:
+        logging.getLogger(ROOT_NAME).setLevel(logging.DEBUG)
     Bridge().run()
 
 if __name__ == "__main__":
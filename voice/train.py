@@ -1,9 +1,12 @@
 import os
+import sys
 print("CWD =", os.getcwd())
 print("FILES =", os.listdir("."))
 
 
+import json
 import pandas as pd
+import numpy as np
 import joblib
 from sklearn.model_selection import train_test_split
 from sklearn.pipeline import Pipeline
@@ -20,6 +23,8 @@ X_train, X_test, y_train, y_test = train_test_split(
 )
 
 # 中文短句：char n-gram 很好用、免斷詞
+# 保留 TfidfVectorizer（不換 HashingVectorizer）：下面的 numpy / ONNX 匯出都要用它的詞表與 idf，
+# 而且這份資料量訓練只要幾十毫秒，雜湊化省不到什麼
 model = Pipeline([
     ("tfidf", TfidfVectorizer(analyzer="char", ngram_range=(2, 4), min_df=1)),
     ("clf", LogisticRegression(max_iter=2000))
@@ -28,6 +33,76 @@ model = Pipeline([
 model.fit(X_train, y_train)
 pred = model.predict(X_test)
 
-print(classification_report(y_test, pred))
+# 逐類別報表只在 python train.py --report 時印；平常只印整體準確率，反覆訓練比較快
+if "--report" in sys.argv[1:]:
+    print(classification_report(y_test, pred))
+else:
+    print(f"test accuracy: {float((pred == y_test.to_numpy()).mean()):.4f}  (--report for per-class details)")
 joblib.dump(model, "intent_clf.joblib")
 print("Saved: intent_clf.joblib")
+
+# 另存 numpy 版（_common.LinearIntentModel 直接 mmap 讀，不必 import sklearn，啟動快很多）
+# 權重：idf / coef / intercept 各一個 .npy；詞表與類別放 intent_clf.linear.json
+try:
+    from _common import LinearIntentModel  # 同目錄；會連帶 import paho
+except ImportError as e:
+    print(f"numpy export skipped: {e}")
+else:
+    LINEAR_FILES = ["intent_clf.linear.json", "intent_clf.idf.npy", "intent_clf.coef.npy", "intent_clf.intercept.npy"]
+    tfidf = model.named_steps["tfidf"]
+    clf = model.named_steps["clf"]
+    meta = {
+        "classes": [str(c) for c in clf.classes_],
+        "vocabulary": {k: int(v) for k, v in tfidf.vocabulary_.items()},
+        "ngram_range": list(tfidf.ngram_range),
+        "lowercase": bool(tfidf.lowercase),
+    }
+    linear = LinearIntentModel(meta, tfidf.idf_.astype(np.float64), clf.coef_.astype(np.float64), clf.intercept_.astype(np.float64))
+    linear_ok = (
+        list(linear.predict(list(X_test))) == [str(p) for p in pred]
+        and np.allclose(linear.predict_proba(list(X_test)), model.predict_proba(X_test), atol=1e-9)
+    )
+    print(f"numpy model matches sklearn on test set: {linear_ok}")
+    if linear_ok:
+        with open(LINEAR_FILES[0], "w", encoding="utf-8") as f:
+            json.dump(meta, f, ensure_ascii=False)
+        np.save(LINEAR_FILES[1], linear.idf)
+        np.save(LINEAR_FILES[2], linear.coef)  # 不量化成 int8：才 5 類 x 幾百個特徵（約 11 KB），信心值卻會偏移
+        np.save(LINEAR_FILES[3], linear.intercept)
+        print("Saved: " + ", ".join(LINEAR_FILES))
+    else:
+        # 不一致就刪掉舊的匯出，load_model 會回頭用 joblib，不會讀到過期權重
+        for name in LINEAR_FILES:
+            if os.path.exists(name):
+                os.remove(name)
+        print("numpy model differs from sklearn: numpy export not written")
+
+# 另存 ONNX（nlu_parser 有 onnxruntime 時優先用它，一次呼叫就拿到 label + 機率）
+# 需要 pip install skl2onnx onnxruntime；沒裝就只用 joblib
+try:
+    import onnxruntime as ort
+    from skl2onnx import convert_sklearn
+    from skl2onnx.common.data_types import StringTensorType
+except ImportError:
+    print("skl2onnx/onnxruntime not installed: skip intent_clf.onnx")
+else:
+    onx = convert_sklearn(
+        model,
+        initial_types=[("text", StringTensorType([None]))],
+        options={
+            id(model): {"zipmap": False},  # 機率輸出成矩陣，不要 list of dict
+            # 小寫化只影響英文字母；用 "C" locale，免得機器沒裝 en_US.UTF-8 時 onnxruntime 載不起來
+            id(model.named_steps["tfidf"]): {"locale": "C"},
+        },
+    )
+    sess = ort.InferenceSession(onx.SerializeToString(), providers=["CPUExecutionProvider"])
+    onnx_pred = sess.run(None, {"text": np.array(list(X_test), dtype=object)})[0]
+    agree = float((np.asarray(onnx_pred).astype(str) == np.asarray(pred).astype(str)).mean())
+    print(f"ONNX vs sklearn agreement on test set: {agree:.4f}")
+    # char n-gram 斷字若和 sklearn 不一致就不輸出，nlu_parser 會繼續用 joblib
+    if agree == 1.0:
+        with open("intent_clf.onnx", "wb") as f:
+            f.write(onx.SerializeToString())
+        print("Saved: intent_clf.onnx")
+    else:
+        print("ONNX predictions differ from sklearn: intent_clf.onnx not written")
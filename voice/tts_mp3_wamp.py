@@ -1,13 +1,23 @@
+import io
+import os
 import time
 import json
 import uuid
 import shutil
+import hashlib
 import subprocess
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache
 from pathlib import Path
 
 import paho.mqtt.client as mqtt
 from gtts import gTTS
 
+try:
+    import orjson  # 選用：直接從 bytes 解析 JSON（C 實作），沒裝就用 json
+except Exception:
+    orjson = None
+
 # =========================
 # 設定區
 # =========================
@@ -29,64 +39,118 @@ GTTS_LANG = "zh-TW"
 # 需要 ffmpeg 才能生效（下面會自動偵測，沒有就跳過加速）
 SPEECH_SPEED = 1.15
 
+# 快取：同一句話（同語言、同速度）直接重用之前產生的 mp3，不再呼叫 gTTS（連 Google）和 ffmpeg
+TTS_CACHE_DIR = Path(WEB_TTS_DIR) / "cache"
+TTS_CACHE_MAX = 500  # 最多保留幾個快取檔，超過就刪最舊的
+
 CLIENT_ID = "tts_bridge_" + uuid.uuid4().hex[:8]
 
+# FIXED_FILENAME 目前內容對應的快取 key（同一句連續播放時連複製都省掉）
+_fixed_key = None
+
 
 def ensure_dir():
     Path(WEB_TTS_DIR).mkdir(parents=True, exist_ok=True)
 
+@lru_cache(maxsize=1)
 def ffmpeg_exists() -> bool:
+    # 只偵測一次，不要每句話都多跑一個 ffmpeg -version
     try:
         subprocess.run(["ffmpeg", "-version"], stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL, check=False)
         return True
     except Exception:
         return False
 
-def speedup_mp3_inplace(mp3_path: Path, speed: float):
+def synth_mp3(text: str, out_path: Path, speed: float):
     """
-    使用 ffmpeg atempo 加速（0.5~2.0）
+    gTTS 產生 mp3 寫到 out_path；有 ffmpeg 時用 atempo 加速（0.5~2.0）
+    gTTS 的 mp3 直接從 stdin（pipe:0）餵給 ffmpeg，不用先寫一個中間檔再讀回來
     Windows 請先安裝 ffmpeg 並加入 PATH
     """
-    if speed <= 0:
-        return
-    if speed == 1.0:
+    tts = gTTS(text=text, lang=GTTS_LANG, slow=False)
+    if speed <= 0 or speed == 1.0 or not ffmpeg_exists():
+        tts.save(str(out_path))
         return
     if not (0.5 <= speed <= 2.0):
         raise ValueError("SPEECH_SPEED 必須在 0.5 ~ 2.0 之間")
 
-    tmp_out = mp3_path.with_suffix(".tmp.mp3")
+    buf = io.BytesIO()
+    tts.write_to_fp(buf)
 
+    out_path.unlink(missing_ok=True)  # 上次失敗留下的檔不能被當成成功
     # -y 覆蓋、atempo 改速度
-    cmd = ["ffmpeg", "-y", "-i", str(mp3_path), "-filter:a", f"atempo={speed}", str(tmp_out)]
-    p = subprocess.run(cmd, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    cmd = ["ffmpeg", "-y", "-f", "mp3", "-i", "pipe:0", "-filter:a", f"atempo={speed}", "-f", "mp3", str(out_path)]
+    p = subprocess.run(cmd, input=buf.getvalue(), stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
 
-    if p.returncode != 0 or not tmp_out.exists():
+    if p.returncode != 0 or not out_path.exists():
         raise RuntimeError("ffmpeg 加速失敗（請確認 ffmpeg 已安裝且可在命令列使用）")
 
-    # 以加速後檔案覆蓋原檔
-    tmp_out.replace(mp3_path)
+def tts_cache_key(text: str) -> str:
+    # 沒有 ffmpeg 時實際是原速，key 也要跟著變，免得之後裝了 ffmpeg 還拿到原速的檔
+    # sha1 一句不到 1 µs（後面還有 gTTS/ffmpeg），不必為此另裝 xxhash；換雜湊會讓快取檔名全部失效
+    speed = SPEECH_SPEED if ffmpeg_exists() else 1.0
+    return hashlib.sha1(f"{GTTS_LANG}|{speed}|{text}".encode("utf-8")).hexdigest()[:16]
+
+def link_or_copy(src: Path, dst: Path):
+    """
+    dst 建成 src 的 hard link（同一顆磁碟只多一筆目錄項，不用把整個 mp3 再寫一次）；
+    檔案系統不支援 hard link（FAT/exFAT、跨磁碟）才真的複製
+    兩邊之後都只會被整個替換、不會原地改寫，所以共用同一份資料沒問題
+    """
+    dst.unlink(missing_ok=True)
+    try:
+        os.link(src, dst)
+    except OSError:
+        shutil.copyfile(src, dst)
+
+def save_to_cache(mp3_path: Path, cache_path: Path):
+    """
+    把剛產生的 mp3 存進快取（一樣先寫暫存檔再替換）；快取寫不進去不影響播放
+    """
+    try:
+        TTS_CACHE_DIR.mkdir(parents=True, exist_ok=True)
+        tmp = cache_path.with_suffix(".tmp")
+        link_or_copy(mp3_path, tmp)
+        tmp.replace(cache_path)
+
+        files = sorted(TTS_CACHE_DIR.glob("*.mp3"), key=lambda f: f.stat().st_mtime)
+        for old in files[:max(0, len(files) - TTS_CACHE_MAX)]:
+            old.unlink(missing_ok=True)
+    except OSError as e:
+        print(f"[WARN] TTS 快取寫入失敗：{e}")
 
 def gen_fixed_mp3_and_url(text: str) -> str:
     """
     永遠輸出同一檔案 FIXED_FILENAME（覆蓋寫入）
     回傳公開 URL
     """
+    global _fixed_key
+
     ensure_dir()
     out_path = Path(WEB_TTS_DIR) / FIXED_FILENAME
+    url = f"{PUBLIC_BASE_URL.rstrip('/')}/{FIXED_FILENAME}"
+
+    key = tts_cache_key(text)
+    if key == _fixed_key and out_path.exists():
+        return url  # 檔案內容已經是這句
 
     # 先寫到暫存檔，再原子替換，避免音箱抓到半寫入的檔
     tmp_path = out_path.with_suffix(".gen.tmp.mp3")
+    tmp_path.unlink(missing_ok=True)  # 上次替換失敗留下的可能是快取檔的 hard link，不能被原地覆寫
 
-    gTTS(text=text, lang=GTTS_LANG, slow=False).save(str(tmp_path))
-
-    # 可選：加速
-    if ffmpeg_exists():
-        speedup_mp3_inplace(tmp_path, SPEECH_SPEED)
+    cache_path = TTS_CACHE_DIR / f"{key}.mp3"
+    if cache_path.exists():
+        link_or_copy(cache_path, tmp_path)
+        cache_path.touch()  # 更新 mtime：清快取時刪的是最久沒用的
+    else:
+        synth_mp3(text, tmp_path, SPEECH_SPEED)  # 可選：加速（有 ffmpeg 才會）
+        save_to_cache(tmp_path, cache_path)
 
     # 原子替換
     tmp_path.replace(out_path)
+    _fixed_key = key
 
-    return f"{PUBLIC_BASE_URL.rstrip('/')}/{FIXED_FILENAME}"
+    return url
 
 def parse_incoming(payload_bytes: bytes):
     """
@@ -95,10 +159,19 @@ def parse_incoming(payload_bytes: bytes):
     {"device_id":"...","text":"..."}
     {"dev_id":"...","params":{"text":"..."}}
     """
-    try:
-        doc = json.loads(payload_bytes.decode("utf-8", errors="ignore"))
-    except Exception:
-        return None
+    doc = None
+    if orjson is not None:
+        try:
+            doc = orjson.loads(payload_bytes)  # 不必先 decode 成 str
+        except Exception:
+            doc = None  # 例如非法 UTF-8：交給下面的寬鬆解碼
+    if doc is None:
+        try:
+            doc = json.loads(payload_bytes.decode("utf-8", errors="ignore"))
+        except Exception:
+            return None
+    if not isinstance(doc, dict):
+        return None  # 例如 [...] 或 "..."：不是物件就沒有欄位可取
 
     dev_id = doc.get("dev_id") or doc.get("device_id") or "all"
     if not isinstance(dev_id, str):
@@ -123,6 +196,10 @@ def build_speaker_cmd(dev_id: str, url: str) -> str:
 
 mqttc = mqtt.Client(client_id=CLIENT_ID, protocol=mqtt.MQTTv311)
 
+# gTTS（連 Google）+ ffmpeg 要好幾百 ms，不能在 paho 的網路執行緒裡做（做的時候收不到別的訊息，也回不了 PING）
+# 只開 1 個 worker：每句都寫同一個 FIXED_FILENAME，音箱下載時檔案必須還是這句，所以照順序一次做一句
+TTS_EXEC = ThreadPoolExecutor(max_workers=1, thread_name_prefix="tts")
+
 def on_connect(client, userdata, flags, rc):
     client.subscribe(TOPIC_IN, qos=1)
 
@@ -131,20 +208,20 @@ def on_message(client, userdata, msg):
     if not parsed:
         return
 
-    dev_id = parsed["dev_id"]
-    text = parsed["text"]
+    TTS_EXEC.submit(tts_job, client, parsed["dev_id"], parsed["text"])
 
+def tts_job(client, dev_id: str, text: str):
     try:
         url = gen_fixed_mp3_and_url(text)
     except Exception as e:
-        # 出錯時也用同格式回報（url 留空）
+        # 出錯時也用同格式回報（url 留空）；只是通知，QoS 0 即可（正常的播放指令仍用 QoS 1）
         err = {"dev_id": dev_id, "url": "", "error": str(e)}
-        client.publish(TOPIC_OUT, json.dumps(err, ensure_ascii=False), qos=1, retain=False)
+        client.publish(TOPIC_OUT, json.dumps(err, ensure_ascii=False), qos=0, retain=False)
         return
 
     client.publish(TOPIC_OUT, build_speaker_cmd(dev_id, url), qos=1, retain=False)
 
-def main():
+def check_web_dir():
     ensure_dir()
 
     # 檢查可寫
@@ -155,8 +232,17 @@ def main():
     except Exception as e:
         raise SystemExit(f"[FATAL] WEB_TTS_DIR 無法寫入：{WEB_TTS_DIR}\n原因：{e}")
 
+    # 啟動時就偵測 ffmpeg（結果有快取），第一句播報不用再等一個 ffmpeg -version
+    if not ffmpeg_exists():
+        print("[提示] 找不到 ffmpeg，語音維持原速（SPEECH_SPEED 不生效）")
+
+def main():
+    # 單獨執行；和 text2cmd 同機時可改跑 mqtt_hub.py，共用一條 MQTT 連線
+    check_web_dir()
+
     mqttc.on_connect = on_connect
     mqttc.on_message = on_message
+    mqttc.reconnect_delay_set(min_delay=1, max_delay=5)  # 預設會一路退避到 120 秒，斷線期間的播報都收不到
     mqttc.connect(MQTT_HOST, MQTT_PORT, keepalive=30)
     mqttc.loop_forever()
 